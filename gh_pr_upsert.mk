@@ -0,0 +1,4 @@
+.PHONY: zipapp
+$(call help,make zipapp,"build gh-pr-upsert as a single-file zipapp in dist/")
+zipapp: python
+	@pyenv exec tox -qe zipapp
@@ -0,0 +1,655 @@
+"""asyncio versions of gh-pr-upsert's helpers, for embedding in async programs.
+
+These mirror the functions in git.py and core.py but run their commands with
+run_async() so that many upserts can be in flight on one event loop without
+tying up a thread each. Cancelling a task that's in one of these functions
+kills any subprocesses that it's waiting for.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import os
+import time
+from contextlib import asynccontextmanager
+from functools import update_wrapper
+from subprocess import CalledProcessError
+from typing import Optional
+
+from gh_pr_upsert import git, history, metrics
+from gh_pr_upsert.core import (
+    Action,
+    Inspection,
+    Result,
+    decide,
+    get_other_contributors,
+    print_result,
+)
+from gh_pr_upsert.exceptions import SameBranchError, TimedOutError
+from gh_pr_upsert.run import run_async, stream_async
+
+# How long lock_branch() waits between attempts to take a lock, in seconds.
+LOCK_POLL_INTERVAL = 0.1
+
+
+class _Cache:
+    """Like functools.cache but for coroutine functions."""
+
+    def __init__(self, function):
+        self.function = function
+        self.results = {}
+        update_wrapper(self, function)
+
+    async def __call__(self, *args):
+        if args not in self.results:
+            self.results[args] = await self.function(*args)
+        return self.results[args]
+
+    def cache_clear(self):
+        self.results.clear()
+
+
+def cache(function):
+    return _Cache(function)
+
+
+async def graphql(query: str, variables: dict) -> dict:
+    """Send a GraphQL query or mutation to GitHub and return its data."""
+    return (
+        await run_async(
+            ["gh", "api", "graphql", "--input", "-"],
+            json=True,
+            json_input={"query": query, "variables": variables},
+        )
+    )["data"]
+
+
+async def get_node_ids(repo, labels, users, teams):
+    """Return the GraphQL node IDs of the given labels, users and teams.
+
+    See git.get_node_ids().
+    """
+    labels, users, teams = (
+        list(dict.fromkeys(names)) for names in (labels, users, teams)
+    )
+
+    if not (labels or users or teams):
+        return {}, {}, {}
+
+    data = await graphql(*git.node_ids_query(repo, labels, users, teams))
+
+    return git.parse_node_ids(data, labels, users, teams)
+
+
+@cache
+async def get_repo(remote: str) -> git.GitHubRepo:
+    """Return the GitHub repo of the given git `remote`."""
+    remote_url = await run_async(["git", "remote", "get-url", remote])
+
+    json = await run_async(
+        ["gh", "repo", "view", "--json", git.REPO_JSON_FIELDS, remote_url], json=True
+    )
+
+    return git.GitHubRepo.from_json(remote, json)
+
+
+@cache
+async def get_pull_request(base_repo, base_branch, head_repo, head_branch):
+    """Return the open PR from `head_branch` to `base_branch`, or None.
+
+    Like git.PullRequest.get() this looks in git.use_pr_index()'s index first.
+    """
+    pr_index = git.current_pr_index()
+
+    if pr_index is not None:
+        hit, pull_request = pr_index.get(base_repo, base_branch, head_repo, head_branch)
+        if hit:
+            return pull_request
+
+    matching_prs = (
+        await run_async(
+            [
+                "gh",
+                "api",
+                "--header",
+                "X-GitHub-Api-Version:2022-11-28",
+                "--paginate",
+                "--method",
+                "GET",
+                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
+                "-f",
+                f"base={base_branch}",
+                "-f",
+                f"head={head_repo.owner}:{head_branch}",
+                "-f",
+                "state=open",
+                "--jq",
+                f".[] | {git.PR_RECORD_JQ}",
+            ]
+        )
+    ).splitlines()
+
+    if not matching_prs:
+        return None
+
+    assert len(matching_prs) == 1
+
+    return git.PullRequest.from_record(base_repo, head_repo, matching_prs[0])
+
+
+async def create_pull_request(
+    base_repo,
+    base_branch,
+    head_repo,
+    head_branch,
+    title,
+    body,
+    *,
+    draft=False,
+    labels=(),
+    reviewers=(),
+    assignees=(),
+    auto_merge=None,
+):  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    """Create and return a new PR. See git.PullRequest.create()."""
+    user_reviewers = [reviewer for reviewer in reviewers if "/" not in reviewer]
+    team_reviewers = [reviewer for reviewer in reviewers if "/" in reviewer]
+
+    label_ids, user_ids, team_ids = await get_node_ids(
+        base_repo, labels, [*user_reviewers, *assignees], team_reviewers
+    )
+
+    record = await run_async(
+        [
+            "gh",
+            "api",
+            "--header",
+            "X-GitHub-Api-Version:2022-11-28",
+            "--method",
+            "POST",
+            f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
+            "--input",
+            "-",
+            "--jq",
+            git.PR_RECORD_JQ,
+        ],
+        json_input={
+            "base": base_branch,
+            "head": f"{head_repo.owner}:{head_branch}",
+            "title": title,
+            "body": git.add_marker(body),
+            "draft": draft,
+        },
+    )
+
+    pull_request = git.PullRequest.from_record(base_repo, head_repo, record)
+
+    if git.current_pr_index() is not None:
+        git.current_pr_index().record(pull_request)
+
+    mutation = pull_request.configure_mutation(
+        label_ids=[label_ids[label] for label in labels],
+        reviewer_ids=[user_ids[user] for user in user_reviewers],
+        team_reviewer_ids=[team_ids[team] for team in team_reviewers],
+        assignee_ids=[user_ids[user] for user in assignees],
+        auto_merge=auto_merge,
+    )
+
+    if mutation:
+        await graphql(*mutation)
+
+    return pull_request
+
+
+async def update_pull_request(pull_request, title, body):
+    """Update a PR's title and body. See git.PullRequest.update()."""
+    changed_fields = pull_request.changed_fields(title, body)
+
+    if not changed_fields:
+        return pull_request
+
+    base_repo = pull_request.base_repo
+
+    record = await run_async(
+        [
+            "gh",
+            "api",
+            "--header",
+            "X-GitHub-Api-Version:2022-11-28",
+            "--method",
+            "PATCH",
+            f"/repos/{base_repo.owner}/{base_repo.name}/pulls/{pull_request.number}",
+            "--input",
+            "-",
+            "--jq",
+            git.PR_RECORD_JQ,
+        ],
+        json_input=changed_fields,
+    )
+
+    updated = git.PullRequest.from_record(base_repo, pull_request.head_repo, record)
+
+    if git.current_pr_index() is not None:
+        git.current_pr_index().record(updated)
+
+    return updated
+
+
+async def close_pull_requests(pull_requests, comment) -> None:
+    """Comment on, close, and delete the head branches of `pull_requests`.
+
+    See git.PullRequest.close_many().
+    """
+    if pull_requests:
+        data = await graphql(*git.PullRequest.close_mutation(pull_requests, comment))
+
+        if git.current_pr_index() is not None:
+            for i, pull_request in enumerate(pull_requests):
+                git.current_pr_index().record(
+                    pull_request,
+                    state="closed",
+                    updated_at=data[f"close{i}"]["pullRequest"]["updatedAt"],
+                )
+
+
+@cache
+async def branch_exists(remote: str, branch: str) -> bool:
+    """Return True if `remote` has a branch named `branch`."""
+    try:
+        await run_async(["git", "show-ref", f"refs/remotes/{remote}/{branch}"])
+    except CalledProcessError as err:
+        if err.returncode == 1:
+            return False
+        raise
+
+    return True
+
+
+async def bound(revs) -> tuple:
+    """Return `revs` bounded at their merge bases.
+
+    The asyncio version of history.bound(). Unlike history.bound(), other
+    walks in the same clone don't wait for the first one to maintain() it:
+    they go ahead without the commit-graph and bitmaps.
+    """
+    ends = history.split_revs(revs)
+
+    if ends is None:
+        return revs
+
+    positives, negatives = ends
+
+    if history.claim(await common_dir()):
+        await maintain()
+
+    try:
+        outputs = await _gather(
+            *(
+                run_async(["git", "merge-base", "--all", positive, *negatives])
+                for positive in positives
+            )
+        )
+    except CalledProcessError:
+        return revs
+
+    merge_bases = {merge_base for output in outputs for merge_base in output.split()}
+
+    return (*positives, *(f"^{merge_base}" for merge_base in sorted(merge_bases)))
+
+
+async def maintain():
+    """Write or refresh the current repo's commit-graph and reachability bitmaps.
+
+    The asyncio version of history.maintain().
+    """
+    await _best_effort(history.COMMIT_GRAPH_COMMAND)
+
+    pack_dir = await run_async(["git", "rev-parse", "--git-path", "objects/pack"])
+
+    if history.bitmaps_are_stale(pack_dir):
+        await _best_effort(history.BITMAPS_COMMAND)
+
+
+@cache
+async def common_dir() -> str:
+    """Return the absolute path to the git directory shared by all worktrees."""
+    return os.path.abspath(await run_async(["git", "rev-parse", "--git-common-dir"]))
+
+
+async def compare_commits(base_repo, base_branch, head_repo, head_branch) -> list:
+    """Return the commits on `head_branch` that aren't on `base_branch`.
+
+    See git.compare_commits().
+    """
+    output = await run_async(
+        git.compare_commits_command(base_repo, base_branch, head_repo, head_branch)
+    )
+    return [git.Commit.from_record(line) for line in output.splitlines()]
+
+
+@cache
+async def configured_user() -> git.User:
+    """Return the configured git user."""
+    name, email = await _gather(
+        run_async(["git", "config", "--get", "user.name"]),
+        run_async(["git", "config", "--get", "user.email"]),
+    )
+    return git.User(name=name, email=email)
+
+
+@cache
+async def diff(branches: tuple, paths: tuple = ()) -> str:
+    """Return a digest of `git diff <branch>...` for the given `branches`.
+
+    Like git.diff() this returns an empty string if there are no changes and
+    otherwise a SHA-256 hex digest of the diff, hashed as git produces it.
+    """
+    digest = hashlib.sha256()
+    size = 0
+
+    async for chunk in stream_async(["git", "diff", *branches, *git.pathspec(paths)]):
+        digest.update(chunk)
+        size += len(chunk)
+
+    metrics.DIFF_BYTES.inc(size)
+    return digest.hexdigest() if size else ""
+
+
+async def fetch_branch(remote: str, branch: str) -> None:
+    """Fetch <remote>/<branch> into its remote-tracking branch."""
+    await run_async(
+        ["git", "fetch", remote, f"+refs/heads/{branch}:refs/remotes/{remote}/{branch}"]
+    )
+
+
+@cache
+async def log(branches: tuple, paths: tuple = ()) -> list:
+    """Return the commits from `git log <branch>...` for the given `branches`."""
+    output = await run_async(
+        [
+            "git",
+            "log",
+            "--ignore-missing",
+            *branches,
+            "--format=%H%x00%an%x00%ae%x00%cn%x00%ce",
+            *git.pathspec(paths),
+        ]
+    )
+    return [git.Commit.from_record(line) for line in output.splitlines()]
+
+
+@asynccontextmanager
+async def lock_branch(remote: str, branch: str):
+    """Hold an exclusive lock on `remote`/`branch` for the duration of the context.
+
+    This takes the same lock as git.lock_branch() does.
+
+    The lock is polled for rather than waited for so that the event loop
+    isn't blocked while another run (in this or another process) holds it.
+    """
+    lock_path = git.lock_path(await common_dir(), remote, branch)
+
+    with open(lock_path, "w", encoding="utf-8") as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+            else:
+                break
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+async def push(remote: str, local_branch: str, remote_branch: str) -> None:
+    """Force-push <local_branch> to <remote>/<remote_branch>."""
+    start = time.monotonic()
+    await run_async(
+        ["git", "push", "--force-with-lease", remote, f"{local_branch}:{remote_branch}"]
+    )
+    metrics.PUSH_DURATION.observe(time.monotonic() - start)
+
+
+async def rev_parse(*revs: str) -> list:
+    """Return the SHAs of the given `revs`, in the same order."""
+    return (await run_async(["git", "rev-parse", *revs])).splitlines()
+
+
+async def rev_list(*revs: str) -> list:
+    """Return the SHAs of the commits in `git rev-list <rev>...`."""
+    return (await run_async(["git", "rev-list", *revs])).split()
+
+
+def clear_ref_caches() -> None:
+    """Clear the cached results that depend on where branches and PRs are."""
+    for function in (get_pull_request, branch_exists, diff, log):
+        function.cache_clear()
+
+
+async def upsert(  # pylint:disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    base_repo,
+    base_branch,
+    local_branch,
+    head_repo,
+    head_branch,
+    title,
+    body,
+    close_comment,
+    *,
+    draft=False,
+    labels=(),
+    reviewers=(),
+    assignees=(),
+    auto_merge=None,
+    update=False,
+    paths=(),
+) -> Result:
+    """Upsert a PR and return a Result saying what was done.
+
+    The asyncio version of core.upsert(). The lookups that core.upsert() does
+    one after another (the local diff, the existing PR, ...) are done
+    concurrently, and then what to do is decided by the same rules as
+    core.upsert() (see core.decide()).
+    """
+    # You can't send a PR to merge a branch into itself.
+    if base_repo == head_repo and base_branch == head_branch:
+        raise SameBranchError()
+
+    timings: dict[str, float] = {}
+
+    with metrics.timed(timings, "total"):
+        async with lock_branch(head_repo.remote, head_branch):
+            with metrics.timed(timings, "inspect"):
+                inspection = await inspect(
+                    base_repo, base_branch, local_branch, head_repo, head_branch, paths
+                )
+
+            action, _, needs_push = decide(inspection, title, body, update)
+            pull_request = inspection.pull_request
+
+            def result(action):
+                return Result(
+                    action=action,
+                    has_changes=bool(inspection.local_diff),
+                    pull_request=pull_request,
+                    local_sha=inspection.local_sha,
+                    base_sha=inspection.base_sha,
+                    remote_sha=inspection.remote_sha,
+                    timings=timings,
+                )
+
+            if action in (Action.NOOP, Action.REFUSED):
+                return result(action)
+
+            # Force-push any local changes to the remote branch.
+            if needs_push:
+                with metrics.timed(timings, "push"):
+                    await push(head_repo.remote, local_branch, head_branch)
+                    clear_ref_caches()
+
+                if pull_request is not None:
+                    pull_request = pull_request.pushed(inspection.local_sha)
+
+            # Create a PR if there isn't one already.
+            if action == Action.CREATED:
+                with metrics.timed(timings, "create"):
+                    pull_request = await create_pull_request(
+                        base_repo,
+                        base_branch,
+                        head_repo,
+                        head_branch,
+                        title,
+                        body,
+                        draft=draft,
+                        labels=labels,
+                        reviewers=reviewers,
+                        assignees=assignees,
+                        auto_merge=auto_merge,
+                    )
+                    clear_ref_caches()
+
+                return result(Action.CREATED)
+
+            # Every other action is taken on the existing PR.
+            assert pull_request is not None
+
+            # If there are no local changes then close the existing PR.
+            if action == Action.CLOSED:
+                with metrics.timed(timings, "close"):
+                    await close_pull_requests([pull_request], close_comment)
+                    clear_ref_caches()
+
+                return result(Action.CLOSED)
+
+            # Update the existing PR's title and body if asked to.
+            if update:
+                with metrics.timed(timings, "update"):
+                    pull_request = await update_pull_request(pull_request, title, body)
+
+            return result(action)
+
+
+async def inspect(  # pylint:disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    base_repo, base_branch, local_branch, head_repo, head_branch, paths
+) -> Inspection:
+    """Read everything that upsert() decides what to do from.
+
+    The asyncio version of core.inspect(), with the lookups done
+    concurrently.
+    """
+    base = f"{base_repo.remote}/{base_branch}"
+    remote = f"{head_repo.remote}/{head_branch}"
+
+    local_diff, pull_request, remote_exists = await _gather(
+        diff((local_branch, f"^{base}"), paths),
+        get_pull_request(base_repo, base_branch, head_repo, head_branch),
+        branch_exists(head_repo.remote, head_branch),
+    )
+
+    remote_sha: Optional[str] = None
+
+    if remote_exists:
+        local_sha, base_sha, remote_sha = await rev_parse(local_branch, base, remote)
+    else:
+        local_sha, base_sha = await rev_parse(local_branch, base)
+
+    remote_diff, commits, user = await _gather(
+        (
+            diff((remote, f"^{base}"), paths)
+            if remote_exists and local_diff
+            else _none()
+        ),
+        remote_commits(
+            base_repo,
+            base_branch,
+            local_branch,
+            head_repo,
+            head_branch,
+            pull_request,
+            remote_sha,
+            paths,
+        ),
+        configured_user(),
+    )
+
+    return Inspection(
+        local_diff=local_diff,
+        pull_request=pull_request,
+        local_sha=local_sha,
+        base_sha=base_sha,
+        remote_sha=remote_sha,
+        remote_diff=remote_diff,
+        other_contributors=get_other_contributors(commits, user),
+    )
+
+
+async def remote_commits(  # pylint:disable=too-many-arguments,too-many-positional-arguments
+    base_repo,
+    base_branch,
+    local_branch,
+    head_repo,
+    head_branch,
+    pull_request,
+    remote_sha,
+    paths=(),
+):
+    """Return the commits on the remote branch that aren't on the local or base branches.
+
+    The asyncio version of core.remote_commits().
+    """
+    base = f"{base_repo.remote}/{base_branch}"
+
+    if pull_request and remote_sha != pull_request.head_sha:
+        if not paths:
+            local_commits, commits = await _gather(
+                rev_list(*await bound((local_branch, f"^{base}"))),
+                compare_commits(base_repo, base_branch, head_repo, head_branch),
+            )
+            local_shas = set(local_commits)
+            return [commit for commit in commits if commit.sha not in local_shas]
+
+        await fetch_branch(head_repo.remote, head_branch)
+
+    return await log(
+        await bound(
+            (f"{head_repo.remote}/{head_branch}", f"^{local_branch}", f"^{base}")
+        ),
+        paths,
+    )
+
+
+@metrics.record_outcome
+async def pr_upsert(*args, **kwargs):
+    """Upsert a PR the way the command line interface does.
+
+    The asyncio version of core.pr_upsert().
+    """
+    print_result(await upsert(*args, **kwargs))
+
+
+async def _best_effort(cmd):
+    """Run `cmd`, ignoring it if it fails or times out."""
+    try:
+        await run_async(cmd)
+    except (CalledProcessError, TimedOutError):
+        pass
+
+
+async def _gather(*awaitables):
+    """Like asyncio.gather() but cancels the others if any of them fails."""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _none():
+    return None
@@ -0,0 +1,155 @@
+"""Record the commands that gh-pr-upsert runs and replay them later.
+
+A cassette is a file with one JSON object per line for each command that
+run() or run_async() ran: its argv, stdin, exit status, stdout, stderr and
+how long it took. Replaying a cassette answers each command from the file
+instead of running it, so a recorded run can be reproduced (and profiled or
+benchmarked) without network access or the original repo.
+"""
+
+import json
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from gh_pr_upsert import run
+from gh_pr_upsert.exceptions import CassetteError
+
+# The command that finds the git directory that branch locks are kept in.
+# When replaying, its answer is replaced with a scratch directory so that
+# locks aren't taken in (or created inside) the recording machine's repo.
+GIT_COMMON_DIR_CMD = ["git", "rev-parse", "--git-common-dir"]
+
+
+@dataclass(frozen=True)
+class Interaction:
+    cmd: list
+    stdin: Optional[str]
+    returncode: int
+    stdout: str
+    stderr: str
+    duration: float
+
+    @classmethod
+    def from_bytes(
+        cls, cmd, stdin, returncode, stdout, stderr, duration
+    ):  # pylint:disable=too-many-arguments,too-many-positional-arguments
+        return cls(
+            cmd=[str(arg) for arg in cmd],
+            stdin=_decode(stdin),
+            returncode=returncode,
+            stdout=_decode(stdout),
+            stderr=_decode(stderr),
+            duration=duration,
+        )
+
+
+class Recorder:
+    """Appends the commands that are run to a cassette file."""
+
+    replaying = False
+
+    def __init__(self, path):
+        self.path = path
+        # Commands can be run from several threads at once (see sweeper.sweep()).
+        self.lock = threading.Lock()
+        with open(path, "w", encoding="utf-8"):
+            pass
+
+    def record(
+        self, cmd, stdin, returncode, stdout, stderr, duration
+    ):  # pylint:disable=too-many-arguments,too-many-positional-arguments
+        interaction = Interaction.from_bytes(
+            cmd, stdin, returncode, stdout, stderr, duration
+        )
+        # Each command is written as soon as it's finished so that the
+        # cassette of a run that crashes or hangs is still useful.
+        with self.lock, open(self.path, "a", encoding="utf-8") as cassette_file:
+            cassette_file.write(json.dumps(asdict(interaction)) + "\n")
+
+
+class Player:
+    """Answers commands from a cassette file instead of running them."""
+
+    replaying = True
+
+    def __init__(self, path, git_dir, simulate_timing=False):
+        with open(path, encoding="utf-8") as cassette_file:
+            self.interactions = [
+                Interaction(**json.loads(line))
+                for line in cassette_file
+                if line.strip()
+            ]
+        self.git_dir = git_dir
+        self.simulate_timing = simulate_timing
+        self.lock = threading.Lock()
+
+    def play(self, cmd, stdin):
+        """Return the recorded (returncode, stdout, stderr, delay) for `cmd`.
+
+        Commands are matched by their argv and stdin rather than strictly in
+        order because commands run in parallel threads can be recorded in a
+        different order than they're replayed in. Each recorded command is
+        only replayed once.
+
+        `delay` is how long the command took when it was recorded if timing
+        is being simulated, otherwise 0.
+        """
+        cmd, stdin = [str(arg) for arg in cmd], _decode(stdin)
+
+        with self.lock:
+            for i, interaction in enumerate(self.interactions):
+                if interaction.cmd == cmd and interaction.stdin == stdin:
+                    del self.interactions[i]
+                    break
+            else:
+                raise CassetteError(f"No recorded interaction for: {cmd}")
+
+        stdout = interaction.stdout
+        if cmd == GIT_COMMON_DIR_CMD and not interaction.returncode:
+            stdout = self.git_dir
+
+        return (
+            interaction.returncode,
+            _encode(stdout),
+            _encode(interaction.stderr),
+            interaction.duration if self.simulate_timing else 0,
+        )
+
+
+@contextmanager
+def record(path):
+    """Record all the commands run inside the context to the cassette at `path`."""
+    previous = run.use_cassette(Recorder(path))
+    try:
+        yield
+    finally:
+        run.use_cassette(previous)
+
+
+@contextmanager
+def replay(path, simulate_timing=False):
+    """Answer all the commands run inside the context from the cassette at `path`.
+
+    If `simulate_timing` is True each command takes as long as it did when
+    it was recorded.
+
+    :raise CassetteError: if a command that wasn't recorded is run
+    """
+    with tempfile.TemporaryDirectory() as git_dir:
+        previous = run.use_cassette(Player(path, git_dir, simulate_timing))
+        try:
+            yield
+        finally:
+            run.use_cassette(previous)
+
+
+def _decode(data):
+    # surrogateescape lets output that isn't valid UTF-8 survive a round trip.
+    return None if data is None else data.decode("utf-8", "surrogateescape")
+
+
+def _encode(text):
+    return text.encode("utf-8", "surrogateescape")
@@ -1,13 +1,40 @@
+import os
 import sys
-from argparse import ArgumentParser
-from importlib.metadata import version
-from subprocess import CalledProcessError
+from argparse import SUPPRESS, ArgumentParser, ArgumentTypeError
+from contextlib import contextmanager, nullcontext
+from string import Formatter
 
-from gh_pr_upsert import core, git
 from gh_pr_upsert.exceptions import PRUpsertError
+from gh_pr_upsert.lazy import lazy_import
 
+# Only the modules that the chosen command uses get loaded. For example
+# --help and --version don't load any of them, and a normal upsert doesn't
+# load asyncio (for aio) or what's needed for cassettes, watching or batches.
+cassette = lazy_import("gh_pr_upsert.cassette")
+core = lazy_import("gh_pr_upsert.core")
+git = lazy_import("gh_pr_upsert.git")
+history = lazy_import("gh_pr_upsert.history")
+manifest = lazy_import("gh_pr_upsert.manifest")
+metrics = lazy_import("gh_pr_upsert.metrics")
+pr_index = lazy_import("gh_pr_upsert.pr_index")
+run = lazy_import("gh_pr_upsert.run")
+sweeper = lazy_import("gh_pr_upsert.sweeper")
+watcher = lazy_import("gh_pr_upsert.watcher")
 
-def cli(_argv=None):  # pylint:disable=too-complex
+DEFAULT_CLOSE_COMMENT = "It looks like this PR isn't needed anymore, closing it."
+
+# The fields that can be used in --body-template.
+BODY_TEMPLATE_FIELDS = (
+    "body",
+    "files",
+    "insertions",
+    "deletions",
+    "binary_files",
+    "top_directories",
+)
+
+
+def cli(_argv=None):  # pylint:disable=too-many-statements,too-many-branches,too-complex
     parser = ArgumentParser(description="Create or update a GitHub pull request.")
     parser.add_argument("-v", "--version", action="store_true")
     parser.add_argument(
@@ -44,20 +71,405 @@ def cli(_argv=None):  # pylint:disable=too-complex
     )
     parser.add_argument(
         "--body-file",
-        help="path to a file containing the body text to use when creating new pull requests",
+        help="path to a file containing the body text to use when creating new pull requests ('-' to read the body from stdin)",
+    )
+    parser.add_argument(
+        "--body-template",
+        type=body_template,
+        help="render the body from this template of the diff's stats, with the fields: "
+        + ", ".join(f"{{{field}}}" for field in BODY_TEMPLATE_FIELDS)
+        + " ({body} is --body or --body-file)",
+    )
+    parser.add_argument(
+        "--close-comment",
+        help="the comment to leave on PRs when closing them",
+        default=DEFAULT_CLOSE_COMMENT,
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="also update the title and body of existing pull requests to --title and --body",
+    )
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="create new pull requests as drafts",
+    )
+    parser.add_argument(
+        "--label",
+        action="append",
+        dest="labels",
+        default=[],
+        help="a label to add to new pull requests (can be given multiple times)",
+    )
+    parser.add_argument(
+        "--reviewer",
+        action="append",
+        dest="reviewers",
+        default=[],
+        help="a user login or org/team to request reviews on new pull requests from (can be given multiple times)",
+    )
+    parser.add_argument(
+        "--assignee",
+        action="append",
+        dest="assignees",
+        default=[],
+        help="a user login to assign new pull requests to (can be given multiple times)",
+    )
+    parser.add_argument(
+        "--path",
+        action="append",
+        dest="paths",
+        default=[],
+        help="only consider changes to and commits that touch files matching this git pathspec (can be given multiple times)",
+    )
+    parser.add_argument(
+        "--auto-merge",
+        choices=["merge", "squash", "rebase"],
+        help="enable auto-merge on new pull requests with the given merge method",
     )
     parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="don't push or change anything on GitHub, just print what would be done (and why) as JSON",
+    )
+
+    add_global_arguments(parser)
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    sweep_parser = subparsers.add_parser(
+        "sweep",
+        description="Close all PRs created by gh-pr-upsert whose branches no longer have any changes.",
+        help="close all PRs created by gh-pr-upsert whose branches no longer have any changes",
+    )
+    # Suppress the defaults of the sweep command's arguments so that the same
+    # arguments given before the "sweep" command aren't overwritten (the main
+    # parser has the defaults).
+    sweep_parser.add_argument(
+        "--base-remote",
+        help="the git remote of the repo whose PRs to close (default: 'origin')",
+        default=SUPPRESS,
+    )
+    sweep_parser.add_argument(
+        "--head-remote",
+        help="only close PRs whose head branches are on this git remote (default: 'origin')",
+        default=SUPPRESS,
+    )
+    sweep_parser.add_argument(
         "--close-comment",
         help="the comment to leave on PRs when closing them",
-        default="It looks like this PR isn't needed anymore, closing it.",
+        default=SUPPRESS,
+    )
+    add_global_arguments(sweep_parser, default=SUPPRESS)
+
+    stack_parser = subparsers.add_parser(
+        "stack",
+        description="Create or update a stack of pull requests in which each pull request is based on the one before it.",
+        help="create or update a stack of pull requests in which each pull request is based on the one before it",
+    )
+    stack_parser.add_argument(
+        "branches",
+        nargs="+",
+        help="the local git branches to push, from the bottom of the stack to the top",
+    )
+    add_global_arguments(stack_parser, default=SUPPRESS)
+
+    watch_parser = subparsers.add_parser(
+        "watch",
+        description="Create or update a pull request, then update it again each time the local branch changes.",
+        help="create or update a pull request, then update it again each time the local branch changes",
+    )
+    watch_parser.add_argument(
+        "--debounce",
+        type=float,
+        default=1.0,
+        help="wait until the branch hasn't changed for this many seconds before updating the pull request (default: 1)",
+    )
+    add_global_arguments(watch_parser, default=SUPPRESS)
+
+    batch_parser = subparsers.add_parser(
+        "batch",
+        description="Create or update a pull request for each entry in a manifest file.",
+        help="create or update a pull request for each entry in a manifest file",
+    )
+    batch_parser.add_argument(
+        "manifest",
+        help="a JSON Lines file with an object of options for each pull request (options that an entry doesn't give are taken from the command line)",
+    )
+    batch_parser.add_argument(
+        "--shard",
+        type=shard,
+        default=(1, 1),
+        help="only upsert the entries in this shard of the manifest, for example 2/4 for the second of four shards (default: 1/1)",
+    )
+    batch_parser.add_argument(
+        "--summary-file",
+        help="append a JSON line with the result of each entry to this file",
+    )
+    batch_parser.add_argument(
+        "--journal",
+        help="journal the run's progress to this file, and skip the entries that an interrupted run with the same journal already did (unless they failed or have changed since)",
+    )
+    add_global_arguments(batch_parser, default=SUPPRESS)
+
+    pr_index_parser = subparsers.add_parser(
+        "pr-index",
+        description="Maintain the --pr-index of open pull requests.",
+        help="maintain the --pr-index of open pull requests",
+    )
+    pr_index_subparsers = pr_index_parser.add_subparsers(
+        dest="pr_index_command", required=True
+    )
+    serve_parser = pr_index_subparsers.add_parser(
+        "serve",
+        description="Receive GitHub's pull_request webhooks and write them to the --pr-index. "
+        "Deliveries must be signed with the secret in the GH_PR_UPSERT_WEBHOOK_SECRET environment variable.",
+        help="receive GitHub's pull_request webhooks and write them to the --pr-index",
+    )
+    serve_parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="the address to listen on (default: 127.0.0.1)",
+    )
+    serve_parser.add_argument(
+        "--port",
+        type=int,
+        default=8000,
+        help="the port to listen on (default: 8000)",
+    )
+    serve_parser.add_argument(
+        "--record",
+        help="append each webhook delivery to this file, so that it can be replayed later",
+    )
+    replay_parser = pr_index_subparsers.add_parser(
+        "replay",
+        description="Write recorded webhook deliveries to the --pr-index.",
+        help="write recorded webhook deliveries to the --pr-index",
+    )
+    replay_parser.add_argument(
+        "files",
+        nargs="+",
+        help="JSON Lines files of webhook deliveries (as recorded by serve --record) or pull_request payloads",
+    )
+    sync_parser = pr_index_subparsers.add_parser(
+        "sync",
+        description="List the open pull requests of GitHub repos and write them to the --pr-index.",
+        help="list the open pull requests of GitHub repos and write them to the --pr-index",
     )
+    sync_parser.add_argument(
+        "repos", nargs="+", help="the GitHub repos to sync, as OWNER/NAME"
+    )
+    for pr_index_command_parser in (serve_parser, replay_parser, sync_parser):
+        add_global_arguments(pr_index_command_parser, default=SUPPRESS)
 
     args = parser.parse_args(_argv)
 
     if args.version:
+        # importlib.metadata is slow to import and only needed here.
+        from importlib.metadata import version  # pylint:disable=import-outside-toplevel
+
         print(version("gh-pr-upsert"))
         sys.exit()
 
+    run.set_timeouts(args.timeout, args.deadline)
+
+    if args.history_indexes:
+        history.use_history_indexes(True)
+
+    try:
+        with use_cassette(args), use_pr_index(args), handle_errors():
+            if args.plan and args.command not in (None, "batch"):
+                parser.error(f"{args.command} doesn't support --plan")
+
+            if args.command == "sweep":
+                sweep(args)
+            elif args.command == "stack":
+                if args.head_remote != args.base_remote:
+                    parser.error("stack doesn't support --head-remote")
+                if args.body_template is not None:
+                    parser.error("stack doesn't support --body-template")
+                stack(args)
+            elif args.command == "watch":
+                if args.body_template is not None:
+                    parser.error("watch doesn't support --body-template")
+                watch(args)
+            elif args.command == "batch":
+                if args.body_template is not None:
+                    parser.error("batch doesn't support --body-template")
+                batch(args)
+            elif args.command == "pr-index":
+                if not args.pr_index:
+                    parser.error("pr-index needs --pr-index")
+                if args.pr_index_command == "serve" and not os.environ.get(
+                    "GH_PR_UPSERT_WEBHOOK_SECRET"
+                ):
+                    parser.error(
+                        "pr-index serve needs the GH_PR_UPSERT_WEBHOOK_SECRET environment variable"
+                    )
+                maintain_pr_index(args)
+            else:
+                upsert(args)
+    finally:
+        export_metrics(args)
+
+
+def add_global_arguments(parser, default=None):
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=default,
+        help="the maximum number of seconds that any one git or gh command can take (default: no limit)",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=default,
+        help="the maximum number of seconds that the whole run can take (default: no limit)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=default,
+        help="write Prometheus metrics about the run to this file (for node_exporter's textfile collector)",
+    )
+    parser.add_argument(
+        "--metrics-pushgateway",
+        default=default,
+        help="push Prometheus metrics about the run to the Pushgateway at this URL",
+    )
+    parser.add_argument(
+        "--pr-index",
+        default=default,
+        help="look pull requests up in the index of open pull requests kept at this path (see the pr-index command) before asking GitHub",
+    )
+    parser.add_argument(
+        "--pr-index-max-age",
+        type=float,
+        default=default,
+        help="how many seconds the --pr-index's data is trusted for (default: 3600)",
+    )
+    parser.add_argument(
+        "--history-indexes",
+        action="store_true",
+        default=default,
+        help="make sure the repo has a commit-graph and reachability bitmaps (refreshing them incrementally) and use them to stop history walks at merge bases, for repos with long histories",
+    )
+    parser.add_argument(
+        "--record-cassette",
+        default=default,
+        help="record every git and gh command that's run, and its output, to this file",
+    )
+    parser.add_argument(
+        "--replay-cassette",
+        default=default,
+        help="answer git and gh commands from this file (recorded with --record-cassette) instead of running them",
+    )
+    parser.add_argument(
+        "--simulate-timing",
+        action="store_true",
+        default=default,
+        help="with --replay-cassette, make each command take as long as it did when it was recorded",
+    )
+
+
+def use_cassette(args):
+    if args.replay_cassette:
+        return cassette.replay(args.replay_cassette, args.simulate_timing)
+
+    if args.record_cassette:
+        return cassette.record(args.record_cassette)
+
+    return nullcontext()
+
+
+@contextmanager
+def use_pr_index(args):
+    if not args.pr_index:
+        yield
+        return
+
+    previous = git.use_pr_index(open_pr_index(args))
+    try:
+        yield
+    finally:
+        git.use_pr_index(previous)
+
+
+def open_pr_index(args):
+    if args.pr_index_max_age is None:
+        return pr_index.PRIndex(args.pr_index)
+
+    return pr_index.PRIndex(args.pr_index, args.pr_index_max_age)
+
+
+def maintain_pr_index(args):
+    index = open_pr_index(args)
+
+    if args.pr_index_command == "serve":
+        server = pr_index.WebhookServer(
+            (args.host, args.port),
+            index,
+            os.environ["GH_PR_UPSERT_WEBHOOK_SECRET"],
+            args.record,
+        )
+        print(f"Listening for webhooks on http://{args.host}:{server.server_port}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    elif args.pr_index_command == "replay":
+        for path in args.files:
+            print(f"{path}: applied {pr_index.replay(index, path)} pull_request events")
+    else:
+        for repo in args.repos:
+            print(f"{repo}: {index.sync(repo)} open pull requests")
+
+
+def export_metrics(args):
+    if not (args.metrics_file or args.metrics_pushgateway):
+        return
+
+    metrics.record_cache_info(git.cached_functions())
+
+    if args.metrics_file:
+        metrics.write_textfile(args.metrics_file)
+
+    if args.metrics_pushgateway:
+        metrics.push(args.metrics_pushgateway)
+
+
+def sweep(args):
+    sweeper.sweep(
+        git.GitHubRepo.get(args.base_remote),
+        git.GitHubRepo.get(args.head_remote),
+        args.close_comment,
+    )
+
+
+def upsert(args):
+    upsert_args, upsert_kwargs = get_upsert_args(args)
+
+    if args.plan:
+        # json is only needed here.
+        import json  # pylint:disable=import-outside-toplevel
+
+        print(json.dumps(core.plan(*upsert_args, **upsert_kwargs).to_dict()))
+    else:
+        core.pr_upsert(*upsert_args, **upsert_kwargs)
+
+
+def watch(args):
+    upsert_args, upsert_kwargs = get_upsert_args(args)
+    try:
+        watcher.watch(*upsert_args, debounce=args.debounce, **upsert_kwargs)
+    except KeyboardInterrupt:
+        pass
+
+
+def get_upsert_args(args):
+    """Return the args and kwargs for core.upsert() from the command line `args`."""
     base_repo = git.GitHubRepo.get(args.base_remote)
     head_repo = git.GitHubRepo.get(args.head_remote)
 
@@ -70,22 +482,123 @@ def cli(_argv=None):  # pylint:disable=too-complex
     if args.head_branch is None:
         args.head_branch = args.local_branch
 
-    if args.body_file is not None:  # pragma: no cover
+    read_body(args)
+
+    if args.body_template is not None:
+        diffstat = git.diffstat(
+            (args.local_branch, f"^{base_repo.remote}/{args.base_branch}"),
+            tuple(args.paths),
+        )
+        args.body = args.body_template.format(
+            body=args.body, **diffstat.template_fields()
+        )
+
+    return (
+        base_repo,
+        args.base_branch,
+        args.local_branch,
+        head_repo,
+        args.head_branch,
+        args.title,
+        args.body,
+        args.close_comment,
+    ), {
+        "draft": args.draft,
+        "labels": args.labels,
+        "reviewers": args.reviewers,
+        "assignees": args.assignees,
+        "auto_merge": args.auto_merge.upper() if args.auto_merge else None,
+        "update": args.update,
+        "paths": tuple(args.paths),
+    }
+
+
+def stack(args):
+    repo = git.GitHubRepo.get(args.base_remote)
+
+    if args.base_branch is None:
+        args.base_branch = repo.default_branch
+
+    read_body(args)
+
+    core.pr_upsert_stack(
+        repo,
+        args.base_branch,
+        args.branches,
+        args.title,
+        args.body,
+        args.close_comment,
+        draft=args.draft,
+        labels=args.labels,
+        reviewers=args.reviewers,
+        assignees=args.assignees,
+        auto_merge=args.auto_merge.upper() if args.auto_merge else None,
+        update=args.update,
+        paths=tuple(args.paths),
+    )
+
+
+def batch(args):
+    read_body(args)
+
+    entries = manifest.read(
+        args.manifest,
+        defaults={
+            name: value
+            for name, value in vars(args).items()
+            if name in manifest.ENTRY_FIELDS and value is not None
+        },
+    )
+
+    if args.plan:
+        manifest.plan_all(entries, args.shard)
+    else:
+        manifest.upsert_all(entries, args.shard, args.summary_file, args.journal)
+
+
+def shard(value):
+    """Return the (index, count) tuple of a --shard."""
+    try:
+        return manifest.parse_shard(value)
+    except ValueError as err:
+        raise ArgumentTypeError(str(err)) from err
+
+
+def body_template(template):
+    """Return `template` if it's a valid --body-template."""
+    try:
+        fields = {
+            field for _, field, _, _ in Formatter().parse(template) if field is not None
+        }
+    except ValueError as err:
+        raise ArgumentTypeError(str(err)) from err
+
+    unknown = fields - set(BODY_TEMPLATE_FIELDS)
+    if unknown:
+        raise ArgumentTypeError(
+            f"unknown fields: {', '.join(repr(field) for field in sorted(unknown))}"
+        )
+
+    return template
+
+
+def read_body(args):
+    if args.body_file == "-":
+        args.body = sys.stdin.read()
+    elif args.body_file is not None:
         # --body-file overrides --body if both are given at once.
         with open(args.body_file, "r", encoding="utf-8") as body_file:
             args.body = body_file.read()
 
+
+@contextmanager
+def handle_errors():
+    """Turn errors from gh-pr-upsert into printed messages and exit statuses."""
+    # subprocess is slow to import and isn't needed by --help or --version.
+    from subprocess import CalledProcessError  # pylint:disable=import-outside-toplevel
+
     try:
-        core.pr_upsert(
-            base_repo,
-            args.base_branch,
-            args.local_branch,
-            head_repo,
-            args.head_branch,
-            args.title,
-            args.body,
-            args.close_comment,
-        )
+        yield
     except PRUpsertError as err:
         print(err.message)
         sys.exit(err.exit_status)
@@ -1,8 +1,57 @@
-from gh_pr_upsert import git
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Optional
+
+from gh_pr_upsert import git, history, metrics
 from gh_pr_upsert.exceptions import NoChangesError, OtherPeopleError, SameBranchError
 
 
-def pr_upsert(
+class Action(str, Enum):
+    """What upsert() did."""
+
+    # A new PR was created (and the branch may have been pushed first).
+    CREATED = "created"
+    # The branch of an existing PR was pushed.
+    PUSHED = "pushed"
+    # An existing PR's title or body was updated but nothing was pushed.
+    UPDATED = "updated"
+    # Nothing needed doing.
+    NOOP = "noop"
+    # The existing PR was closed because there are no changes.
+    CLOSED = "closed"
+    # Nothing was done because the remote branch has other people's commits.
+    REFUSED = "refused"
+
+
+@dataclass(frozen=True)
+class Result:
+    """What upsert() did and the state of things when it did it."""
+
+    action: Action
+    # Whether the local branch has any changes compared to the base branch.
+    has_changes: bool
+    # The PR (possibly just closed) or None if there isn't one.
+    pull_request: Optional[git.PullRequest]
+    # The SHAs of the local branch, the base branch, and the remote branch
+    # before anything was pushed (None if the remote branch didn't exist).
+    local_sha: str
+    base_sha: str
+    remote_sha: Optional[str]
+    # How long each step took in seconds, keyed by step name.
+    timings: dict = field(default_factory=dict, compare=False)
+
+    @property
+    def url(self) -> Optional[str]:
+        return self.pull_request.html_url if self.pull_request else None
+
+    @property
+    def number(self) -> Optional[int]:
+        return self.pull_request.number if self.pull_request else None
+
+
+def upsert(  # pylint:disable=too-many-arguments,too-many-positional-arguments,too-many-locals
     base_repo,
     base_branch,
     local_branch,
@@ -11,65 +60,606 @@ def pr_upsert(
     title,
     body,
     close_comment,
-):  # pylint:disable=too-many-arguments,too-many-positional-arguments
+    *,
+    draft=False,
+    labels=(),
+    reviewers=(),
+    assignees=(),
+    auto_merge=None,
+    update=False,
+    paths=(),
+) -> Result:
+    """Upsert a PR and return a Result saying what was done.
+
+    This is the in-process API. Unlike pr_upsert() it doesn't print anything,
+    and having no changes or finding other people's commits on the remote
+    branch are reported in the returned Result rather than raised.
+    SameBranchError and errors from git and gh are still raised.
+
+    If `paths` (a tuple of git pathspecs) is given then only changes to and
+    commits that touch matching files are considered: the branch has no
+    changes if it doesn't change any of them, and other people's commits
+    only block the upsert if they touch them. The whole branch is still
+    pushed.
+
+    Other people's commits are normally found in the remote-tracking branch,
+    but if there's a PR and its remote-tracking branch is missing or stale
+    they're asked for from GitHub instead (see remote_commits()).
+    """
     # You can't send a PR to merge a branch into itself.
     if base_repo == head_repo and base_branch == head_branch:
         raise SameBranchError()
 
-    # The list of users who have commits on the remote branch.
-    commits = git.log(
-        (
-            f"{head_repo.remote}/{head_branch}",
-            f"^{local_branch}",
-            f"^{base_repo.remote}/{base_branch}",
-        )
-    )
+    timings: dict[str, float] = {}
 
-    other_authors = {
-        commit.author for commit in commits if commit.author != git.configured_user()
-    }
+    # Hold a lock on the head branch so that concurrent gh-pr-upsert runs in
+    # other worktrees of this clone can't push to it or create a PR for it
+    # at the same time as us.
+    with (
+        metrics.timed(timings, "total"),
+        git.lock_branch(head_repo.remote, head_branch),
+    ):
+        with metrics.timed(timings, "inspect"):
+            inspection = inspect(
+                base_repo, base_branch, local_branch, head_repo, head_branch, paths
+            )
+
+        action, _, push = decide(inspection, title, body, update)
+        pull_request = inspection.pull_request
+
+        def result(action):
+            return Result(
+                action=action,
+                has_changes=bool(inspection.local_diff),
+                pull_request=pull_request,
+                local_sha=inspection.local_sha,
+                base_sha=inspection.base_sha,
+                remote_sha=inspection.remote_sha,
+                timings=timings,
+            )
+
+        if action in (Action.NOOP, Action.REFUSED):
+            return result(action)
+
+        # Force-push any local changes to the remote branch.
+        if push:
+            with metrics.timed(timings, "push"):
+                git.push(head_repo.remote, local_branch, head_branch)
+                git.clear_ref_caches()
+
+            if pull_request is not None:
+                pull_request = pull_request.pushed(inspection.local_sha)
+
+        # Create a PR if there isn't one already.
+        if action == Action.CREATED:
+            with metrics.timed(timings, "create"):
+                pull_request = git.PullRequest.create(
+                    base_repo,
+                    base_branch,
+                    head_repo,
+                    head_branch,
+                    title,
+                    body,
+                    draft=draft,
+                    labels=labels,
+                    reviewers=reviewers,
+                    assignees=assignees,
+                    auto_merge=auto_merge,
+                )
+                git.clear_ref_caches()
+
+            return result(Action.CREATED)
+
+        # Every other action is taken on the existing PR.
+        assert pull_request is not None
+
+        # If there are no local changes then close the existing PR.
+        if action == Action.CLOSED:
+            with metrics.timed(timings, "close"):
+                pull_request.close(close_comment)
+                git.clear_ref_caches()
+
+            return result(Action.CLOSED)
+
+        # Update the existing PR's title and body if asked to.
+        if update:
+            with metrics.timed(timings, "update"):
+                pull_request = pull_request.update(title, body)
+
+        return result(action)
+
+
+@dataclass(frozen=True)
+class Plan:  # pylint:disable=too-many-instance-attributes
+    """What upsert() would do, see plan()."""
+
+    action: Action
+    # Why upsert() would do it, in words.
+    reason: str
+    # Whether the local branch would be pushed.
+    push: bool
+    # Whether the local branch has any changes compared to the base branch.
+    has_changes: bool
+    # The existing PR or None if there isn't one.
+    pull_request: Optional[git.PullRequest]
+    # The SHAs of the local branch, the base branch, and the remote branch
+    # (None if the remote branch doesn't exist).
+    local_sha: str
+    base_sha: str
+    remote_sha: Optional[str]
+
+    def to_dict(self) -> dict:
+        """Return the plan as a JSON-serializable dict."""
+        return {
+            "action": self.action.value,
+            "reason": self.reason,
+            "push": self.push,
+            "has_changes": self.has_changes,
+            "url": self.pull_request.html_url if self.pull_request else None,
+            "number": self.pull_request.number if self.pull_request else None,
+            "local_sha": self.local_sha,
+            "base_sha": self.base_sha,
+            "remote_sha": self.remote_sha,
+        }
 
-    other_committers = {
-        commit.committer
-        for commit in commits
-        if commit.committer != git.configured_user()
-    }
 
-    other_contributors = other_authors | other_committers
+def plan(  # pylint:disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    base_repo,
+    base_branch,
+    local_branch,
+    head_repo,
+    head_branch,
+    title,
+    body,
+    close_comment=None,
+    *,
+    draft=False,
+    labels=(),
+    reviewers=(),
+    assignees=(),
+    auto_merge=None,
+    update=False,
+    paths=(),
+) -> Plan:
+    """Return a Plan of what upsert() would do, without doing any of it.
+
+    Takes the same arguments as upsert() and does all of the same reading
+    (the diffs, the PR lookup and the remote branch's commits) but never
+    pushes anything or changes anything on GitHub. The arguments that only
+    affect how PRs are created or closed are ignored, so `close_comment` is
+    optional.
+    """
+    # These don't change what upsert() would do, only how it would do it.
+    del close_comment, draft, labels, reviewers, assignees, auto_merge
+
+    # You can't send a PR to merge a branch into itself.
+    if base_repo == head_repo and base_branch == head_branch:
+        raise SameBranchError()
+
+    inspection = inspect(
+        base_repo, base_branch, local_branch, head_repo, head_branch, paths
+    )
+    action, reason, push = decide(inspection, title, body, update)
+
+    return Plan(
+        action=action,
+        reason=reason,
+        push=push,
+        has_changes=bool(inspection.local_diff),
+        pull_request=inspection.pull_request,
+        local_sha=inspection.local_sha,
+        base_sha=inspection.base_sha,
+        remote_sha=inspection.remote_sha,
+    )
+
 
-    # The changes that we have locally.
-    local_diff = git.diff((local_branch, f"^{base_repo.remote}/{base_branch}"))
+@dataclass(frozen=True)
+class Inspection:
+    """The state of a branch and its PR, see inspect() and aio.inspect()."""
 
+    # A digest of the changes that we have locally (see git.diff()).
+    local_diff: str
     # The existing PR or None.
+    pull_request: Optional[git.PullRequest]
+    local_sha: str
+    base_sha: str
+    remote_sha: Optional[str]
+    # A digest of the changes that already exist on the remote branch, or None
+    # if there's no remote branch or no local changes to compare it to.
+    remote_diff: Optional[str]
+    # The users who have commits on the remote branch.
+    other_contributors: set
+
+
+def inspect(  # pylint:disable=too-many-arguments,too-many-positional-arguments
+    base_repo, base_branch, local_branch, head_repo, head_branch, paths
+) -> Inspection:
+    """Read everything that upsert() and plan() decide what to do from."""
+    base = f"{base_repo.remote}/{base_branch}"
+    remote = f"{head_repo.remote}/{head_branch}"
+
+    local_diff = git.diff((local_branch, f"^{base}"), paths)
     pull_request = git.PullRequest.get(base_repo, base_branch, head_repo, head_branch)
+    remote_sha: Optional[str] = None
+    remote_diff: Optional[str] = None
+
+    if git.branch_exists(head_repo.remote, head_branch):
+        local_sha, base_sha, remote_sha = git.rev_parse(local_branch, base, remote)
+        remote_diff = git.diff((remote, f"^{base}"), paths) if local_diff else None
+    else:
+        local_sha, base_sha = git.rev_parse(local_branch, base)
+
+    return Inspection(
+        local_diff=local_diff,
+        pull_request=pull_request,
+        local_sha=local_sha,
+        base_sha=base_sha,
+        remote_sha=remote_sha,
+        remote_diff=remote_diff,
+        other_contributors=get_other_contributors(
+            remote_commits(
+                base_repo,
+                base_branch,
+                local_branch,
+                head_repo,
+                head_branch,
+                pull_request,
+                remote_sha,
+                paths,
+            )
+        ),
+    )
+
+
+def decide(  # pylint:disable=too-many-return-statements
+    inspection, title, body, update
+):
+    """Return the (action, reason, push) that upsert() should take.
+
+    aio.upsert() uses this too, so that both make the same decisions.
+    """
+    if not inspection.local_diff:
+        if not inspection.pull_request:
+            return Action.NOOP, "the branch has no changes and there's no PR", False
+
+        if inspection.other_contributors:
+            return (
+                Action.REFUSED,
+                "the branch has no changes but the remote branch has other people's commits",
+                False,
+            )
+
+        return Action.CLOSED, "the branch has no changes", False
+
+    push = inspection.local_diff != inspection.remote_diff
+
+    if push and inspection.other_contributors:
+        return Action.REFUSED, "the remote branch has other people's commits", False
+
+    if not inspection.pull_request:
+        return Action.CREATED, "there's no PR", push
 
-    # If there are no local changes then close any existing PR.
-    if not local_diff:
-        if pull_request and not other_contributors:
-            print(f"Closed PR {pull_request.html_url}")
-            pull_request.close(close_comment)
+    if push:
+        return Action.PUSHED, "the remote branch doesn't have the changes", True
+
+    if update and inspection.pull_request.changed_fields(title, body):
+        return Action.UPDATED, "the PR's title or body is out of date", False
+
+    return Action.NOOP, "the PR is up to date", False
+
+
+@metrics.record_outcome
+def pr_upsert(*args, **kwargs):
+    """Upsert a PR the way the command line interface does.
+
+    Takes the same arguments as upsert(). Prints the PR's URL and raises
+    NoChangesError or OtherPeopleError instead of returning a Result.
+    """
+    print_result(upsert(*args, **kwargs))
+
+
+def print_result(result):
+    """Print `result` the way the CLI does and raise if nothing could be done."""
+    if not result.has_changes:
+        if result.action == Action.CLOSED:
+            print(f"Closed PR {result.url}")
 
         raise NoChangesError()
 
-    # The changes that already exist on the remote branch.
-    if git.branch_exists(head_repo.remote, head_branch):
-        remote_diff = git.diff(
-            (f"{head_repo.remote}/{head_branch}", f"^{base_repo.remote}/{base_branch}")
+    if result.action == Action.REFUSED:
+        raise OtherPeopleError()
+
+    print(result.url)
+
+
+@dataclass
+class _StackLevel:  # pylint:disable=too-many-instance-attributes
+    """The state of one branch of a stack, see upsert_stack()."""
+
+    local_branch: str
+    # The ref that the branch's changes are compared to.
+    base: str
+    # The branch that the branch's PR is sent to.
+    base_branch: str
+    remote_exists: bool = False
+    local_diff: str = ""
+    remote_diff: Optional[str] = None
+    other_contributors: set = field(default_factory=set)
+    pull_request: Optional[git.PullRequest] = None
+
+
+def upsert_stack(  # pylint:disable=too-many-arguments,too-many-positional-arguments,too-many-locals,too-complex,too-many-branches,too-many-statements
+    repo,
+    base_branch,
+    local_branches,
+    title,
+    body,
+    close_comment,
+    *,
+    draft=False,
+    labels=(),
+    reviewers=(),
+    assignees=(),
+    auto_merge=None,
+    update=False,
+    paths=(),
+) -> list[Result]:
+    """Upsert a stack of PRs in which each PR is based on the one before it.
+
+    `local_branches` are in order from the bottom of the stack to the top.
+    Each branch is pushed to the branch with the same name in `repo`. The
+    first branch's PR is sent to `base_branch` and each of the others is sent
+    to the branch before it. Returns a Result for each branch.
+
+    All the branches are inspected in one parallel pass and all the branches
+    that need pushing are pushed with one atomic `git push`, so either all of
+    them are updated or none are. If any of them has commits from other
+    people nothing at all is pushed, created or closed. PRs are then created
+    or updated from the bottom of the stack up.
+
+    Only the PRs of branches at the top of the stack that have no changes
+    are closed: closing a PR lower down would delete the branch that the PRs
+    above it are based on.
+
+    `paths` limits the changes and commits that are considered the same way
+    as it does for upsert().
+    """
+    if len(set(local_branches)) != len(local_branches) or base_branch in (
+        local_branches
+    ):
+        raise SameBranchError()
+
+    timings: dict[str, float] = {}
+    levels = [
+        _StackLevel(local_branch, base, level_base_branch)
+        for local_branch, base, level_base_branch in zip(
+            local_branches,
+            [f"{repo.remote}/{base_branch}", *local_branches[:-1]],
+            [base_branch, *local_branches[:-1]],
         )
-    else:
-        remote_diff = None
+    ]
+
+    def inspect_level(level):
+        remote = f"{repo.remote}/{level.local_branch}"
+        level.other_contributors = get_other_contributors(
+            git.log(
+                history.bound((remote, f"^{level.local_branch}", f"^{level.base}")),
+                paths,
+            )
+        )
+        level.local_diff = git.diff((level.local_branch, f"^{level.base}"), paths)
+        level.pull_request = git.PullRequest.get(
+            repo, level.base_branch, repo, level.local_branch
+        )
+        level.remote_exists = git.branch_exists(repo.remote, level.local_branch)
+        if level.remote_exists:
+            level.remote_diff = git.diff((remote, f"^{level.base}"), paths)
+
+    with metrics.timed(timings, "total"), ExitStack() as locks:
+        # Lock the branches in a consistent order so that two overlapping
+        # stacks can't deadlock.
+        for local_branch in sorted(local_branches):
+            locks.enter_context(git.lock_branch(repo.remote, local_branch))
+
+        with metrics.timed(timings, "inspect"):
+            with ThreadPoolExecutor() as executor:
+                list(executor.map(inspect_level, levels))
+
+            remote_refs = [
+                f"{repo.remote}/{level.local_branch}"
+                for level in levels
+                if level.remote_exists
+            ]
+            shas = dict(
+                zip(
+                    [f"{repo.remote}/{base_branch}", *local_branches, *remote_refs],
+                    git.rev_parse(
+                        f"{repo.remote}/{base_branch}", *local_branches, *remote_refs
+                    ),
+                )
+            )
+
+        # The branches at the top of the stack that have no changes.
+        top = len(levels)
+        while top and not levels[top - 1].local_diff:
+            top -= 1
+        empty_top_levels = levels[top:]
+
+        # Push every other branch whose remote branch doesn't match, even if it
+        # has no changes itself, because the PRs above it are based on it.
+        to_push = [
+            level
+            for level in levels[:top]
+            if not level.remote_exists or level.local_diff != level.remote_diff
+        ]
+        refused = any(level.other_contributors for level in to_push)
+        to_close = [
+            level
+            for level in empty_top_levels
+            if level.pull_request and not level.other_contributors
+        ]
 
-    # Force-push any local changes to the remote branch.
-    if local_diff != remote_diff:
-        if other_contributors:
-            raise OtherPeopleError()
+        actions = {}
 
-        git.push(head_repo.remote, local_branch, head_branch)
+        if refused:
+            for level in to_push:
+                actions[level.local_branch] = Action.REFUSED
+        else:
+            if to_close:
+                with metrics.timed(timings, "close"):
+                    git.PullRequest.close_many(
+                        [level.pull_request for level in to_close], close_comment
+                    )
+                    git.clear_ref_caches()
+                for level in to_close:
+                    actions[level.local_branch] = Action.CLOSED
 
-    # Create a PR if there isn't one already.
-    if not pull_request:
-        pull_request = git.PullRequest.create(
-            base_repo, base_branch, head_repo, head_branch, title, body
+            if to_push:
+                with metrics.timed(timings, "push"):
+                    git.push_many(
+                        repo.remote,
+                        [(level.local_branch, level.local_branch) for level in to_push],
+                    )
+                    git.clear_ref_caches()
+                for level in to_push:
+                    actions[level.local_branch] = Action.PUSHED
+                    if level.pull_request:
+                        level.pull_request = level.pull_request.pushed(
+                            shas[level.local_branch]
+                        )
+
+            for i, level in enumerate(levels[:top], 1):
+                if not level.local_diff:
+                    continue
+
+                if not level.pull_request:
+                    with metrics.timed(timings, "create"):
+                        level.pull_request = git.PullRequest.create(
+                            repo,
+                            level.base_branch,
+                            repo,
+                            level.local_branch,
+                            f"{title} ({i}/{len(levels)})",
+                            body,
+                            draft=draft,
+                            labels=labels,
+                            reviewers=reviewers,
+                            assignees=assignees,
+                            auto_merge=auto_merge,
+                        )
+                        git.clear_ref_caches()
+                    actions[level.local_branch] = Action.CREATED
+                elif update:
+                    with metrics.timed(timings, "update"):
+                        updated_pull_request = level.pull_request.update(
+                            f"{title} ({i}/{len(levels)})", body
+                        )
+                    if updated_pull_request is not level.pull_request:
+                        level.pull_request = updated_pull_request
+                        actions.setdefault(level.local_branch, Action.UPDATED)
+
+        for level in empty_top_levels:
+            if level.pull_request and level.other_contributors:
+                actions[level.local_branch] = Action.REFUSED
+
+    return [
+        Result(
+            action=actions.get(level.local_branch, Action.NOOP),
+            has_changes=bool(level.local_diff),
+            pull_request=level.pull_request,
+            local_sha=shas[level.local_branch],
+            base_sha=shas[level.base],
+            remote_sha=shas.get(f"{repo.remote}/{level.local_branch}"),
+            timings=timings,
         )
+        for level in levels
+    ]
+
+
+@metrics.record_outcome
+def pr_upsert_stack(*args, **kwargs):
+    """Upsert a stack of PRs and print the results.
+
+    Takes the same arguments as upsert_stack().
+    """
+    print_stack_results(upsert_stack(*args, **kwargs))
+
+
+def print_stack_results(results):
+    """Print the results of upsert_stack() the way the CLI does.
+
+    Raises OtherPeopleError if the stack couldn't be pushed because of other
+    people's commits, or NoChangesError if none of the branches have changes.
+    """
+    for result in results:
+        if result.action == Action.CLOSED:
+            print(f"Closed PR {result.url}")
+        elif result.url:
+            print(result.url)
+
+    if any(result.action == Action.REFUSED for result in results):
+        raise OtherPeopleError()
+
+    if not any(result.has_changes for result in results):
+        raise NoChangesError()
+
+
+def remote_commits(  # pylint:disable=too-many-arguments,too-many-positional-arguments
+    base_repo,
+    base_branch,
+    local_branch,
+    head_repo,
+    head_branch,
+    pull_request,
+    remote_sha,
+    paths=(),
+):
+    """Return the commits on the remote branch that aren't on the local or base branches.
+
+    The commits are normally read from the remote-tracking branch with
+    `git log`. But if there's a PR and the remote-tracking branch is missing
+    (`remote_sha` is None) or stale (it isn't at the PR's head commit), for
+    example in a CI clone that hasn't fetched the head branch, they're got
+    from GitHub's compare API instead so that nothing has to be fetched.
+
+    The compare API can't tell which commits touch `paths` though, so if
+    `paths` are given the head branch is fetched and read with `git log`.
+    """
+    base = f"{base_repo.remote}/{base_branch}"
+
+    if pull_request and remote_sha != pull_request.head_sha:
+        if not paths:
+            local_shas = set(git.rev_list(*history.bound((local_branch, f"^{base}"))))
+            return [
+                commit
+                for commit in git.compare_commits(
+                    base_repo, base_branch, head_repo, head_branch
+                )
+                if commit.sha not in local_shas
+            ]
+
+        git.fetch_branch(head_repo.remote, head_branch)
+
+    return git.log(
+        history.bound(
+            (f"{head_repo.remote}/{head_branch}", f"^{local_branch}", f"^{base}")
+        ),
+        paths,
+    )
+
+
+def get_other_contributors(commits, user=None):
+    """Return the authors and committers of `commits` other than `user`.
+
+    `user` defaults to the configured git user.
+    """
+    if user is None:
+        user = git.configured_user()
+
+    other_authors = {commit.author for commit in commits if commit.author != user}
+
+    other_committers = {
+        commit.committer for commit in commits if commit.committer != user
+    }
 
-    print(pull_request.html_url)
+    return other_authors | other_committers
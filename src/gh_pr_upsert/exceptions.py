@@ -18,3 +18,43 @@ class NoChangesError(PRUpsertError):
 class OtherPeopleError(PRUpsertError):
     message = "Other people have pushed commits to the branch, not updating it"
     exit_status = 4
+
+
+class NotFoundError(PRUpsertError):
+    exit_status = 5
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class TimedOutError(PRUpsertError):
+    exit_status = 6
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class CassetteError(PRUpsertError):
+    exit_status = 7
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class ManifestError(PRUpsertError):
+    exit_status = 8
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class BatchError(PRUpsertError):
+    exit_status = 9
+
+    def __init__(self, failures, total):
+        self.message = f"{failures} of {total} entries failed"
+        super().__init__(self.message)
@@ -1,180 +1,128 @@
-"""Helpers for working with Git and GitHub."""
+"""Helpers for working with Git and GitHub.
 
+The GitHub API helpers live in github.py and are re-exported here.
+"""
+
+import fcntl
+import hashlib
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from functools import cache
 from subprocess import CalledProcessError
-from typing import Optional
-
-from gh_pr_upsert.run import run
-
-
-@dataclass(frozen=True)
+from urllib.parse import quote
+
+from gh_pr_upsert import metrics
+from gh_pr_upsert.github import (  # pylint:disable=unused-import
+    ADD_ASSIGNEES_MUTATION,
+    ADD_LABELS_MUTATION,
+    CLOSE_PR_MUTATIONS,
+    ENABLE_AUTO_MERGE_MUTATION,
+    PR_MARKER,
+    PR_RECORD_JQ,
+    REPO_JSON_FIELDS,
+    REQUEST_REVIEWS_MUTATION,
+    SLOTS,
+    GitHubRepo,
+    PullRequest,
+    add_marker,
+    current_pr_index,
+    get_node_ids,
+    graphql,
+    node_ids_query,
+    parse_node_ids,
+    use_pr_index,
+)
+from gh_pr_upsert.run import run, stream
+
+
+@dataclass(frozen=True, **SLOTS)
 class User:
     name: str
     email: str
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **SLOTS)
 class Commit:
     sha: str
     author: User
     committer: User
 
     @classmethod
-    @cache
-    def get(cls, sha: str):
-        def git_show(format_string: str) -> str:
-            return run(["git", "show", "--no-patch", f"--format={format_string}", sha])
-
-        # `git show` doesn't have a machine-readable output mode (like a --json
-        # mode) and I don't fancy writing code to parse its human-readable
-        # output. So call `git show` multiple times with a different --format
-        # string each time to extract the different attributes of the commit.
-        return cls(
-            sha=git_show("%H"),  # Call git to make sure we get the full SHA.
-            author=User(
-                name=git_show("%an"),
-                email=git_show("%ae"),
-            ),
-            committer=User(
-                name=git_show("%cn"),
-                email=git_show("%ce"),
-            ),
-        )
-
-
-@dataclass(frozen=True)
-class GitHubRepo:
-    remote: str
-    owner: str
-    name: str
-    name_with_owner: str = field(repr=False, compare=False)
-    default_branch: str = field(repr=False, compare=False)
-    url: str = field(repr=False, compare=False)
-    json: Optional[dict] = field(repr=False, compare=False)
-
-    @classmethod
-    @cache
-    def get(cls, remote: str):
-        remote_url = run(["git", "remote", "get-url", remote])
-
-        json = run(
-            [
-                "gh",
-                "repo",
-                "view",
-                "--json",
-                "owner,name,nameWithOwner,defaultBranchRef,url",
-                remote_url,
-            ],
-            json=True,
+    def from_record(cls, record):
+        """Return a Commit from a line of NUL-separated SHA, author and committer."""
+        sha, author_name, author_email, committer_name, committer_email = record.split(
+            "\0"
         )
-
         return cls(
-            remote=remote,
-            owner=json["owner"]["login"],
-            name=json["name"],
-            name_with_owner=json["nameWithOwner"],
-            default_branch=json["defaultBranchRef"]["name"],
-            url=json["url"],
-            json=json,
+            sha=sha,
+            author=User(name=author_name, email=author_email),
+            committer=User(name=committer_name, email=committer_email),
         )
 
 
-@dataclass(frozen=True)
-class PullRequest:
-    base_repo: GitHubRepo
-    head_repo: GitHubRepo
-    head_branch: str
-    number: int
-    html_url: str = field(compare=False, repr=False)
-    json: Optional[dict] = field(compare=False, repr=False)
+@dataclass(**SLOTS)
+class DiffStat:
+    """Summary statistics of a diff (see diffstat())."""
 
-    @classmethod
-    def from_json(cls, base_repo, head_repo, head_branch, json):
-        """Return a PullRequest from the given GitHub API JSON data."""
-        return cls(
-            base_repo=base_repo,
-            head_repo=head_repo,
-            head_branch=head_branch,
-            number=json["number"],
-            html_url=json["html_url"],
-            json=json,
-        )
+    files: int = 0
+    insertions: int = 0
+    deletions: int = 0
+    binary_files: int = 0
+    # Maps top-level directories ("." for files at the top level) to the
+    # number of lines changed in them.
+    directories: Counter = field(default_factory=Counter)
 
     @classmethod
-    def create(
-        cls, base_repo, base_branch, head_repo, head_branch, title, body
-    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
-        json = run(
-            [
-                "gh",
-                "api",
-                "--header",
-                "X-GitHub-Api-Version:2022-11-28",
-                "--method",
-                "POST",
-                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
-                "-f",
-                f"base={base_branch}",
-                "-f",
-                f"head={head_repo.owner}:{head_branch}",
-                "-f",
-                f"title={title}",
-                "-f",
-                f"body={body}",
-            ],
-            json=True,
-        )
-
-        return cls.from_json(base_repo, head_repo, head_branch, json)
-
-    @classmethod
-    @cache
-    def get(cls, base_repo, base_branch, head_repo, head_branch):
-        matching_prs = run(
-            [
-                "gh",
-                "api",
-                "--header",
-                "X-GitHub-Api-Version:2022-11-28",
-                "--paginate",
-                "--method",
-                "GET",
-                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
-                "-f",
-                f"base={base_branch}",
-                "-f",
-                f"head={head_repo.owner}:{head_branch}",
-                "-f",
-                "state=open",
-            ],
-            json=True,
-        )
-
-        if not matching_prs:
-            return None
-
-        assert len(matching_prs) == 1
-
-        json = matching_prs[0]
-
-        return cls.from_json(base_repo, head_repo, head_branch, json)
-
-    def close(self, comment) -> None:
-        run(
-            [
-                "gh",
-                "pr",
-                "close",
-                "--repo",
-                self.base_repo.name_with_owner,
-                "--delete-branch",
-                "--comment",
-                comment,
-                str(self.number),
-            ]
-        )
+    def from_numstat(cls, records):
+        """Return the stats of the records of `git diff --numstat -z`.
+
+        `records` can be any iterable of records (such as a stream()) and
+        only one record is held in memory at a time.
+        """
+        stats = cls()
+        records = iter(records)
+
+        for record in records:
+            insertions, deletions, path = record.split("\t", 2)
+
+            if not path:
+                # For renames and copies the old and new paths are the next
+                # two records.
+                next(records)
+                path = next(records)
+
+            stats.files += 1
+            directory = path.split("/", 1)[0] if "/" in path else "."
+
+            if insertions == "-":
+                stats.binary_files += 1
+                stats.directories[directory] += 0
+            else:
+                stats.insertions += int(insertions)
+                stats.deletions += int(deletions)
+                stats.directories[directory] += int(insertions) + int(deletions)
+
+        return stats
+
+    def template_fields(self, top=5) -> dict:
+        """Return the fields that can be used in a --body-template.
+
+        `top_directories` is a Markdown list of the `top` directories with
+        the most lines changed.
+        """
+        return {
+            "files": self.files,
+            "insertions": self.insertions,
+            "deletions": self.deletions,
+            "binary_files": self.binary_files,
+            "top_directories": "\n".join(
+                f"- `{directory}`: {lines} lines changed"
+                for directory, lines in self.directories.most_common(top)
+            ),
+        }
 
 
 @cache
@@ -190,6 +138,45 @@ def branch_exists(remote: str, branch: str) -> bool:
     return True
 
 
+def compare_commits(base_repo, base_branch, head_repo, head_branch) -> list[Commit]:
+    """Return the commits on `head_branch` that aren't on `base_branch`.
+
+    The commits are got from GitHub's compare API rather than from git, so
+    nothing needs to have been fetched. They're read a commit at a time as gh
+    outputs them, rather than all of the pages being buffered first.
+    """
+    return [
+        Commit.from_record(line)
+        for line in stream(
+            compare_commits_command(base_repo, base_branch, head_repo, head_branch)
+        )
+    ]
+
+
+def compare_commits_command(base_repo, base_branch, head_repo, head_branch):
+    """Return the `gh api` command that compare_commits() runs."""
+    return [
+        "gh",
+        "api",
+        "--header",
+        "X-GitHub-Api-Version:2022-11-28",
+        "--paginate",
+        "--method",
+        "GET",
+        f"/repos/{base_repo.owner}/{base_repo.name}/compare/"
+        + quote(f"{base_branch}...{head_repo.owner}:{head_branch}", safe="/:."),
+        "--jq",
+        ".commits[] | [.sha, .commit.author.name, .commit.author.email,"
+        ' .commit.committer.name, .commit.committer.email] | join("\\u0000")',
+    ]
+
+
+@cache
+def common_dir() -> str:
+    """Return the absolute path to the git directory shared by all worktrees."""
+    return os.path.abspath(run(["git", "rev-parse", "--git-common-dir"]))
+
+
 @cache
 def configured_user():
     """Return the configured git user."""
@@ -206,24 +193,218 @@ def current_branch() -> str:
 
 
 @cache
-def diff(branches: list[str]) -> str:
-    """Return the output of `git diff <branch>...` for the given `branches`."""
-    return run(["git", "diff", *branches])
+def diff(branches: list[str], paths: tuple = ()) -> str:
+    """Return a digest of `git diff <branch>...` for the given `branches`.
+
+    Returns an empty string if there are no changes. Otherwise returns a
+    SHA-256 hex digest of the diff, which is all that's needed to tell
+    whether two diffs are the same. The diff is hashed as git produces it so
+    it's never all held in memory.
+
+    If `paths` is given only changes to the files that match those git
+    pathspecs are included.
+    """
+    digest = hashlib.sha256()
+    size = 0
+
+    for chunk in stream(["git", "diff", *branches, *pathspec(paths)], separator=None):
+        digest.update(chunk)
+        size += len(chunk)
+
+    metrics.DIFF_BYTES.inc(size)
+    return digest.hexdigest() if size else ""
+
+
+def diffstat(branches: list[str], paths: tuple = ()) -> DiffStat:
+    """Return the stats of `git diff <branch>...` for the given `branches`.
+
+    The stats are aggregated from `git diff --numstat` as git produces it,
+    without ever holding the whole diff (or even the whole list of files)
+    in memory.
+    """
+    return DiffStat.from_numstat(
+        stream(
+            ["git", "diff", "--numstat", "-z", *branches, *pathspec(paths)],
+            separator=b"\0",
+        )
+    )
+
+
+@cache
+def diff_is_empty(branches: list[str], paths: tuple = ()) -> bool:
+    """Return True if `git diff <branch>...` for `branches` is empty.
+
+    This is cheaper than checking whether diff() returns an empty string
+    because git stops at the first difference and doesn't produce any output.
+    """
+    try:
+        run(["git", "diff", "--quiet", *branches, *pathspec(paths)])
+    except CalledProcessError as err:
+        if err.returncode == 1:
+            return False
+        raise
+
+    return True
+
+
+def fetch(*remotes: str) -> None:
+    """Fetch all of the given `remotes` at once."""
+    run(["git", "fetch", "--multiple", *remotes])
+
+
+def fetch_branch(remote: str, branch: str) -> None:
+    """Fetch <remote>/<branch> into its remote-tracking branch.
+
+    The refspec is given in full so that this works even in clones whose
+    configured refspecs don't include the branch, like single-branch clones.
+    """
+    run(
+        ["git", "fetch", remote, f"+refs/heads/{branch}:refs/remotes/{remote}/{branch}"]
+    )
 
 
 @cache
-def log(branches: list[str]) -> list[Commit]:
-    """Return the commits from `git log <branch>...` for the given `branches`."""
+def log(branches: list[str], paths: tuple = ()) -> list[Commit]:
+    """Return the commits from `git log <branch>...` for the given `branches`.
+
+    If `paths` is given only commits that touch files that match those git
+    pathspecs are returned.
+
+    All the commits' details are read from a single `git log` command, a
+    commit at a time.
+    """
     return [
-        Commit.get(sha)
-        for sha in run(
-            ["git", "log", "--ignore-missing", *branches, "--format=%H"]
-        ).split()
+        Commit.from_record(line)
+        for line in stream(
+            [
+                "git",
+                "log",
+                "--ignore-missing",
+                *branches,
+                "--format=%H%x00%an%x00%ae%x00%cn%x00%ce",
+                *pathspec(paths),
+            ]
+        )
     ]
 
 
+def pathspec(paths: tuple) -> list[str]:
+    """Return the args that limit a git diff or log command to `paths`."""
+    return ["--", *paths] if paths else []
+
+
+@contextmanager
+def lock_branch(remote: str, branch: str):
+    """Hold an exclusive lock on `remote`/`branch` for the duration of the context.
+
+    The lock file is in the git directory that's shared by all the worktrees
+    of a clone, so this serializes gh-pr-upsert runs for the same branch
+    across all worktrees while runs for different branches go in parallel.
+    """
+    with open(
+        lock_path(common_dir(), remote, branch), "w", encoding="utf-8"
+    ) as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def lock_path(git_dir: str, remote: str, branch: str) -> str:
+    """Return the path to lock_branch()'s lock file, creating its directory."""
+    lock_dir = os.path.join(git_dir, "gh-pr-upsert", "locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, quote(f"{remote}/{branch}", safe="") + ".lock")
+
+
 def push(remote: str, local_branch: str, remote_branch: str) -> None:
     """Force-push <local_branch> to <remote>/<remote_branch>."""
+    start = time.monotonic()
     run(
         ["git", "push", "--force-with-lease", remote, f"{local_branch}:{remote_branch}"]
     )
+    metrics.PUSH_DURATION.observe(time.monotonic() - start)
+
+
+def push_many(remote: str, branches: list) -> None:
+    """Atomically force-push several branches to `remote` with one `git push`.
+
+    `branches` is a list of (local_branch, remote_branch) pairs. Either all
+    of the remote branches are updated or (if any of them can't be) none are.
+    """
+    start = time.monotonic()
+    run(
+        [
+            "git",
+            "push",
+            "--atomic",
+            "--force-with-lease",
+            remote,
+            *(
+                f"{local_branch}:{remote_branch}"
+                for local_branch, remote_branch in branches
+            ),
+        ]
+    )
+    metrics.PUSH_DURATION.observe(time.monotonic() - start)
+
+
+def rev_parse(*revs: str) -> list[str]:
+    """Return the SHAs of the given `revs`, in the same order."""
+    return run(["git", "rev-parse", *revs]).splitlines()
+
+
+def git_paths(*names: str) -> list[str]:
+    """Return the paths of the given files in the git directory.
+
+    For example "HEAD" or "refs/heads/main". The paths are resolved with
+    `git rev-parse --git-path` so they're right in linked worktrees too.
+    """
+    return run(
+        ["git", "rev-parse", *(arg for name in names for arg in ("--git-path", name))]
+    ).splitlines()
+
+
+def rev_list(*revs: str) -> list[str]:
+    """Return the SHAs of the commits in `git rev-list <rev>...`."""
+    return run(["git", "rev-list", *revs]).split()
+
+
+def clear_ref_caches() -> None:
+    """Clear the cached results that depend on where branches and PRs are.
+
+    This needs to be called after pushing a branch or creating or closing a
+    PR so that later calls in the same process see the change. Results that
+    can't change, like commits and repos, are kept.
+    """
+    for function in (PullRequest.get, branch_exists):
+        function.cache_clear()
+
+    clear_local_ref_caches()
+
+
+def clear_local_ref_caches() -> None:
+    """Clear the cached results that depend on where local branches are.
+
+    Unlike clear_ref_caches() this keeps the results that only depend on
+    GitHub (PRs and which remote branches exist), so this can be called
+    after a local branch has changed without having to look the PR up again.
+    """
+    for function in (diff, diff_is_empty, log):
+        function.cache_clear()
+
+
+def cached_functions():
+    """Return all of this module's cached functions."""
+    return [
+        GitHubRepo.get,
+        PullRequest.get,
+        branch_exists,
+        common_dir,
+        configured_user,
+        current_branch,
+        diff,
+        diff_is_empty,
+        log,
+    ]
@@ -0,0 +1,651 @@
+"""Helpers for working with GitHub's REST and GraphQL APIs.
+
+git.py re-exports everything here, so the rest of gh-pr-upsert (and code
+that embeds it) uses these as git.PullRequest etc.
+"""
+
+import json as json_
+import sys
+from dataclasses import dataclass, field, replace
+from functools import cache
+
+from gh_pr_upsert.exceptions import NotFoundError
+from gh_pr_upsert.run import run, stream
+
+# A hidden marker that's added to the bodies of PRs created by gh-pr-upsert
+# so that they can be found again later (see PullRequest.get_upserted()).
+PR_MARKER = "<!-- gh-pr-upsert -->"
+
+# The fields that GitHubRepo.get() asks `gh repo view` for.
+REPO_JSON_FIELDS = "id,owner,name,nameWithOwner,defaultBranchRef,url"
+
+# A jq filter (for `gh api --jq`) that reduces a PR's JSON from the GitHub
+# API to a single line with just the fields that PullRequest needs,
+# separated by NULs. The title and body come last, still encoded as JSON,
+# see PullRequest.from_record(). The rest of the JSON (which includes the
+# whole of both the base and head repos' JSON) is never sent to Python.
+PR_RECORD_JQ = (
+    "[(.number | tostring), .node_id, .base.ref, .head.ref, .head.sha, .html_url,"
+    ' .updated_at, ({title, body} | tojson)] | join("\\u0000")'
+)
+
+# Options for @dataclass that make instances smaller and faster where the
+# Python version supports it.
+SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+# The pr_index.PRIndex that PullRequest.get() looks in before asking GitHub,
+# see use_pr_index().
+_hooks = {"pr_index": None}
+
+
+def use_pr_index(pr_index):
+    """Look PRs up in (and record the PRs that are changed to) `pr_index`.
+
+    `pr_index` is a pr_index.PRIndex, or None to always ask GitHub. Returns
+    the previous index (or None).
+    """
+    previous = _hooks["pr_index"]
+    _hooks["pr_index"] = pr_index
+    return previous
+
+
+def current_pr_index():
+    """Return the pr_index.PRIndex set by use_pr_index(), or None."""
+    return _hooks["pr_index"]
+
+
+# The GraphQL mutations to close a single PR and delete its head branch.
+# `{i}` is replaced with the PR's index within a batch of PRs being closed.
+# Setting a ref's afterOid to the all-zeroes object ID deletes it.
+CLOSE_PR_MUTATIONS = """
+  comment{i}: addComment(input: {subjectId: $pr{i}, body: $comment}) {
+    clientMutationId
+  }
+  close{i}: closePullRequest(input: {pullRequestId: $pr{i}}) {
+    pullRequest { updatedAt }
+  }
+  deleteBranch{i}: updateRefs(
+    input: {
+      repositoryId: $repo{i}
+      refUpdates: [
+        {
+          name: $ref{i}
+          beforeOid: $sha{i}
+          afterOid: "0000000000000000000000000000000000000000"
+        }
+      ]
+    }
+  ) {
+    clientMutationId
+  }
+"""
+
+# The GraphQL mutations to configure a PR (see PullRequest.configure()).
+# `{ids}` is replaced with a list of GraphQL variables containing node IDs.
+ADD_LABELS_MUTATION = """
+  addLabels: addLabelsToLabelable(
+    input: {labelableId: $pr, labelIds: [{ids}]}
+  ) {
+    clientMutationId
+  }
+"""
+REQUEST_REVIEWS_MUTATION = """
+  requestReviews: requestReviews(
+    input: {pullRequestId: $pr, userIds: [{user_ids}], teamIds: [{team_ids}]}
+  ) {
+    clientMutationId
+  }
+"""
+ADD_ASSIGNEES_MUTATION = """
+  addAssignees: addAssigneesToAssignable(
+    input: {assignableId: $pr, assigneeIds: [{ids}]}
+  ) {
+    clientMutationId
+  }
+"""
+ENABLE_AUTO_MERGE_MUTATION = """
+  enableAutoMerge: enablePullRequestAutoMerge(
+    input: {pullRequestId: $pr, mergeMethod: $mergeMethod}
+  ) {
+    clientMutationId
+  }
+"""
+
+
+@dataclass(frozen=True, **SLOTS)
+class GitHubRepo:
+    remote: str
+    owner: str
+    name: str
+    node_id: str = field(repr=False, compare=False)
+    name_with_owner: str = field(repr=False, compare=False)
+    default_branch: str = field(repr=False, compare=False)
+    url: str = field(repr=False, compare=False)
+
+    @classmethod
+    @cache
+    def get(cls, remote: str):
+        remote_url = run(["git", "remote", "get-url", remote])
+
+        json = run(
+            [
+                "gh",
+                "repo",
+                "view",
+                "--json",
+                REPO_JSON_FIELDS,
+                remote_url,
+            ],
+            json=True,
+        )
+
+        return cls.from_json(remote, json)
+
+    @classmethod
+    def from_json(cls, remote, json):
+        """Return a GitHubRepo from the given `gh repo view` JSON data."""
+        return cls(
+            remote=remote,
+            owner=json["owner"]["login"],
+            name=json["name"],
+            node_id=json["id"],
+            name_with_owner=json["nameWithOwner"],
+            default_branch=json["defaultBranchRef"]["name"],
+            url=json["url"],
+        )
+
+
+@dataclass(frozen=True, **SLOTS)
+class PullRequest:  # pylint:disable=too-many-instance-attributes
+    base_repo: GitHubRepo
+    head_repo: GitHubRepo
+    head_branch: str
+    number: int
+    node_id: str = field(compare=False, repr=False)
+    base_branch: str = field(compare=False, repr=False)
+    head_sha: str = field(compare=False, repr=False)
+    html_url: str = field(compare=False, repr=False)
+    # The PR's title and body as a JSON object that hasn't been decoded
+    # yet: they're only needed if the PR gets updated, and bodies can be big.
+    raw_json: str = field(compare=False, repr=False, default="{}")
+    # When the PR was last updated according to GitHub, or "" if unknown.
+    updated_at: str = field(compare=False, repr=False, default="")
+
+    @property
+    def json(self) -> dict:
+        """Return the PR's title and body from the GitHub API."""
+        return json_.loads(self.raw_json)
+
+    @classmethod
+    def from_json(cls, base_repo, head_repo, head_branch, json):
+        """Return a PullRequest from the given GitHub API JSON data."""
+        return cls(
+            base_repo=base_repo,
+            head_repo=head_repo,
+            head_branch=head_branch,
+            number=json["number"],
+            node_id=json["node_id"],
+            base_branch=json["base"]["ref"],
+            head_sha=json["head"]["sha"],
+            html_url=json["html_url"],
+            raw_json=json_.dumps({"title": json["title"], "body": json["body"]}),
+        )
+
+    @classmethod
+    def from_record(cls, base_repo, head_repo, record):
+        """Return a PullRequest from a line of `gh api --jq PR_RECORD_JQ` output."""
+        (
+            number,
+            node_id,
+            base_branch,
+            head_branch,
+            head_sha,
+            html_url,
+            updated_at,
+            raw_json,
+        ) = record.split("\0", 7)
+        return cls(
+            base_repo=base_repo,
+            head_repo=head_repo,
+            head_branch=head_branch,
+            number=int(number),
+            node_id=node_id,
+            base_branch=base_branch,
+            head_sha=head_sha,
+            html_url=html_url,
+            raw_json=raw_json,
+            updated_at=updated_at,
+        )
+
+    @classmethod
+    def create(
+        cls,
+        base_repo,
+        base_branch,
+        head_repo,
+        head_branch,
+        title,
+        body,
+        *,
+        draft=False,
+        labels=(),
+        reviewers=(),
+        assignees=(),
+        auto_merge=None,
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+        """Create and return a new PR.
+
+        `reviewers` can contain both user logins and "org/team" team slugs.
+        `auto_merge` is the merge method ("MERGE", "SQUASH" or "REBASE") to
+        enable auto-merge with, or None to not enable auto-merge.
+        """
+        user_reviewers = [reviewer for reviewer in reviewers if "/" not in reviewer]
+        team_reviewers = [reviewer for reviewer in reviewers if "/" in reviewer]
+
+        # Look up the node IDs of any labels, users and teams *before* creating
+        # the PR so that a misspelled name doesn't leave a half-configured PR.
+        label_ids, user_ids, team_ids = get_node_ids(
+            base_repo, labels, [*user_reviewers, *assignees], team_reviewers
+        )
+
+        record = run(
+            [
+                "gh",
+                "api",
+                "--header",
+                "X-GitHub-Api-Version:2022-11-28",
+                "--method",
+                "POST",
+                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
+                "--input",
+                "-",
+                "--jq",
+                PR_RECORD_JQ,
+            ],
+            json_input={
+                "base": base_branch,
+                "head": f"{head_repo.owner}:{head_branch}",
+                "title": title,
+                "body": add_marker(body),
+                "draft": draft,
+            },
+        )
+
+        pull_request = cls.from_record(base_repo, head_repo, record)
+
+        if _hooks["pr_index"] is not None:
+            _hooks["pr_index"].record(pull_request)
+
+        pull_request.configure(
+            label_ids=[label_ids[label] for label in labels],
+            reviewer_ids=[user_ids[user] for user in user_reviewers],
+            team_reviewer_ids=[team_ids[team] for team in team_reviewers],
+            assignee_ids=[user_ids[user] for user in assignees],
+            auto_merge=auto_merge,
+        )
+
+        return pull_request
+
+    @classmethod
+    @cache
+    def get(cls, base_repo, base_branch, head_repo, head_branch):
+        if _hooks["pr_index"] is not None:
+            hit, pull_request = _hooks["pr_index"].get(
+                base_repo, base_branch, head_repo, head_branch
+            )
+            if hit:
+                return pull_request
+
+        matching_prs = list(
+            stream(
+                [
+                    "gh",
+                    "api",
+                    "--header",
+                    "X-GitHub-Api-Version:2022-11-28",
+                    "--paginate",
+                    "--method",
+                    "GET",
+                    f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
+                    "-f",
+                    f"base={base_branch}",
+                    "-f",
+                    f"head={head_repo.owner}:{head_branch}",
+                    "-f",
+                    "state=open",
+                    "--jq",
+                    f".[] | {PR_RECORD_JQ}",
+                ]
+            )
+        )
+
+        if not matching_prs:
+            return None
+
+        assert len(matching_prs) == 1
+
+        return cls.from_record(base_repo, head_repo, matching_prs[0])
+
+    @classmethod
+    def get_upserted(cls, base_repo, head_repo):
+        """Return all open PRs from `head_repo` to `base_repo` that were created by gh-pr-upsert.
+
+        The PRs are filtered by gh's jq so only the matching ones' fields are
+        sent to Python, and they're read one at a time as gh outputs them.
+        """
+        return [
+            cls.from_record(base_repo, head_repo, record)
+            for record in stream(
+                [
+                    "gh",
+                    "api",
+                    "--header",
+                    "X-GitHub-Api-Version:2022-11-28",
+                    "--paginate",
+                    "--method",
+                    "GET",
+                    f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
+                    "-f",
+                    "state=open",
+                    "-f",
+                    "per_page=100",
+                    "--jq",
+                    ".[]"
+                    f" | select(.head.repo.full_name == {json_.dumps(head_repo.name_with_owner)})"
+                    f' | select(.body // "" | contains({json_.dumps(PR_MARKER)}))'
+                    f" | {PR_RECORD_JQ}",
+                ]
+            )
+        ]
+
+    def pushed(self, head_sha):
+        """Return this PR with its head at `head_sha`, after a push to its branch.
+
+        The PR is recorded in use_pr_index()'s index too. Otherwise the index
+        would keep the old head_sha until GitHub's webhook arrived, and the
+        next upsert would think the remote-tracking branch was stale (and ask
+        GitHub's compare API) or would close the PR with a stale expected
+        head commit, so its branch wouldn't be deleted.
+        """
+        pull_request = replace(self, head_sha=head_sha)
+
+        if _hooks["pr_index"] is not None:
+            _hooks["pr_index"].record(pull_request)
+
+        return pull_request
+
+    def update(self, title, body):
+        """Update this PR's title and body and return the updated PR.
+
+        The title and body are compared to the PR's existing JSON first and
+        only the ones that have changed are sent. If neither has changed no
+        request is sent at all and this PR is returned unmodified.
+        """
+        changed_fields = self.changed_fields(title, body)
+
+        if not changed_fields:
+            return self
+
+        record = run(
+            [
+                "gh",
+                "api",
+                "--header",
+                "X-GitHub-Api-Version:2022-11-28",
+                "--method",
+                "PATCH",
+                f"/repos/{self.base_repo.owner}/{self.base_repo.name}/pulls/{self.number}",
+                "--input",
+                "-",
+                "--jq",
+                PR_RECORD_JQ,
+            ],
+            json_input=changed_fields,
+        )
+
+        updated = self.from_record(self.base_repo, self.head_repo, record)
+
+        if _hooks["pr_index"] is not None:
+            _hooks["pr_index"].record(updated)
+
+        return updated
+
+    def changed_fields(self, title, body):
+        """Return a dict of the fields that update(title, body) would change."""
+        # self.json decodes raw_json each time, so only get it once.
+        json = self.json
+        body = add_marker(body)
+        return {
+            name: value
+            for name, value in (("title", title), ("body", body))
+            if value != json[name]
+        }
+
+    def configure(
+        self,
+        *,
+        label_ids=(),
+        reviewer_ids=(),
+        team_reviewer_ids=(),
+        assignee_ids=(),
+        auto_merge=None,
+    ) -> None:
+        """Add labels, reviewers and assignees to this PR and enable auto-merge.
+
+        Everything is applied with a single batched GraphQL mutation, and no
+        request is sent at all if there's nothing to apply.
+        """
+        mutation = self.configure_mutation(
+            label_ids=label_ids,
+            reviewer_ids=reviewer_ids,
+            team_reviewer_ids=team_reviewer_ids,
+            assignee_ids=assignee_ids,
+            auto_merge=auto_merge,
+        )
+
+        if mutation:
+            graphql(*mutation)
+
+    def configure_mutation(
+        self,
+        *,
+        label_ids=(),
+        reviewer_ids=(),
+        team_reviewer_ids=(),
+        assignee_ids=(),
+        auto_merge=None,
+    ):
+        """Return the (query, variables) that configure() would send, or None."""
+        parameters = ["$pr: ID!"]
+        mutations = []
+        variables = {"pr": self.node_id}
+
+        def add_ids(prefix, ids):
+            """Add `ids` as GraphQL variables and return their names."""
+            names = []
+            for i, id_ in enumerate(ids):
+                parameters.append(f"${prefix}{i}: ID!")
+                names.append(f"${prefix}{i}")
+                variables[f"{prefix}{i}"] = id_
+            return ", ".join(names)
+
+        if label_ids:
+            mutations.append(
+                ADD_LABELS_MUTATION.replace("{ids}", add_ids("label", label_ids))
+            )
+
+        if reviewer_ids or team_reviewer_ids:
+            mutations.append(
+                REQUEST_REVIEWS_MUTATION.replace(
+                    "{user_ids}", add_ids("reviewer", reviewer_ids)
+                ).replace("{team_ids}", add_ids("team", team_reviewer_ids))
+            )
+
+        if assignee_ids:
+            mutations.append(
+                ADD_ASSIGNEES_MUTATION.replace(
+                    "{ids}", add_ids("assignee", assignee_ids)
+                )
+            )
+
+        if auto_merge:
+            parameters.append("$mergeMethod: PullRequestMergeMethod!")
+            mutations.append(ENABLE_AUTO_MERGE_MUTATION)
+            variables["mergeMethod"] = auto_merge
+
+        if not mutations:
+            return None
+
+        return (
+            f"mutation({', '.join(parameters)}) {{{''.join(mutations)}}}",
+            variables,
+        )
+
+    def close(self, comment) -> None:
+        self.close_many([self], comment)
+
+    @classmethod
+    def close_many(cls, pull_requests, comment) -> None:
+        """Comment on, close, and delete the head branches of `pull_requests`.
+
+        All the PRs are closed with a single batched GraphQL mutation rather
+        than the several separate API requests per PR that `gh pr close
+        --delete-branch` makes.
+
+        Each head branch is only deleted if it still points to the commit that
+        the PR was fetched with, so commits pushed since then aren't lost.
+        """
+        if pull_requests:
+            data = graphql(*cls.close_mutation(pull_requests, comment))
+
+            if _hooks["pr_index"] is not None:
+                for i, pull_request in enumerate(pull_requests):
+                    _hooks["pr_index"].record(
+                        pull_request,
+                        state="closed",
+                        updated_at=data[f"close{i}"]["pullRequest"]["updatedAt"],
+                    )
+
+    @staticmethod
+    def close_mutation(pull_requests, comment):
+        """Return the (query, variables) that close_many() would send."""
+        parameters = ["$comment: String!"]
+        mutations = []
+        variables = {"comment": comment}
+
+        for i, pull_request in enumerate(pull_requests):
+            parameters.extend(
+                [
+                    f"$pr{i}: ID!",
+                    f"$repo{i}: ID!",
+                    f"$ref{i}: GitRefname!",
+                    f"$sha{i}: GitObjectID!",
+                ]
+            )
+            mutations.append(CLOSE_PR_MUTATIONS.replace("{i}", str(i)))
+            variables.update(
+                {
+                    f"pr{i}": pull_request.node_id,
+                    f"repo{i}": pull_request.head_repo.node_id,
+                    f"ref{i}": f"refs/heads/{pull_request.head_branch}",
+                    f"sha{i}": pull_request.head_sha,
+                }
+            )
+
+        return (
+            f"mutation({', '.join(parameters)}) {{{''.join(mutations)}}}",
+            variables,
+        )
+
+
+def graphql(query: str, variables: dict) -> dict:
+    """Send a GraphQL query or mutation to GitHub and return its data."""
+    return run(
+        ["gh", "api", "graphql", "--input", "-"],
+        json=True,
+        json_input={"query": query, "variables": variables},
+    )["data"]
+
+
+def add_marker(body: str) -> str:
+    """Return `body` with gh-pr-upsert's hidden PR marker added."""
+    return f"{body}\n\n{PR_MARKER}"
+
+
+def get_node_ids(repo, labels, users, teams):
+    """Return the GraphQL node IDs of the given labels, users and teams.
+
+    Returns three dicts mapping the label names (from `repo`), user logins and
+    "org/team" team slugs to their node IDs. All the IDs are looked up with a
+    single GraphQL query, or none at all if there's nothing to look up.
+
+    :raise NotFoundError: if a label or team doesn't exist
+    """
+    labels, users, teams = (
+        list(dict.fromkeys(names)) for names in (labels, users, teams)
+    )
+
+    if not (labels or users or teams):
+        return {}, {}, {}
+
+    data = graphql(*node_ids_query(repo, labels, users, teams))
+
+    return parse_node_ids(data, labels, users, teams)
+
+
+def node_ids_query(repo, labels, users, teams):
+    """Return the (query, variables) that get_node_ids() sends."""
+    parameters = []
+    fields = []
+    variables = {}
+
+    if labels:
+        parameters.extend(["$owner: String!", "$name: String!"])
+        variables.update({"owner": repo.owner, "name": repo.name})
+        label_fields = []
+        for i, label in enumerate(labels):
+            parameters.append(f"$label{i}: String!")
+            label_fields.append(f"label{i}: label(name: $label{i}) {{ id }}")
+            variables[f"label{i}"] = label
+        fields.append(
+            f"repository(owner: $owner, name: $name) {{ {' '.join(label_fields)} }}"
+        )
+
+    for i, user in enumerate(users):
+        parameters.append(f"$user{i}: String!")
+        fields.append(f"user{i}: user(login: $user{i}) {{ id }}")
+        variables[f"user{i}"] = user
+
+    for i, team in enumerate(teams):
+        org, slug = team.split("/", 1)
+        parameters.extend([f"$org{i}: String!", f"$team{i}: String!"])
+        fields.append(
+            f"org{i}: organization(login: $org{i}) {{ team(slug: $team{i}) {{ id }} }}"
+        )
+        variables.update({f"org{i}": org, f"team{i}": slug})
+
+    return f"query({', '.join(parameters)}) {{ {' '.join(fields)} }}", variables
+
+
+def parse_node_ids(data, labels, users, teams):
+    """Return get_node_ids()'s dicts from the data returned by node_ids_query().
+
+    :raise NotFoundError: if a label or team doesn't exist
+    """
+
+    def node_id(node, kind, name):
+        if not node:
+            raise NotFoundError(f"Couldn't find the {kind} {name!r}")
+        return node["id"]
+
+    return (
+        {
+            label: node_id(data["repository"][f"label{i}"], "label", label)
+            for i, label in enumerate(labels)
+        },
+        {user: node_id(data[f"user{i}"], "user", user) for i, user in enumerate(users)},
+        {
+            team: node_id(data[f"org{i}"]["team"], "team", team)
+            for i, team in enumerate(teams)
+        },
+    )
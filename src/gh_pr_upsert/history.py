@@ -0,0 +1,170 @@
+"""Fast history walks on big repos, using commit-graphs and reachability bitmaps.
+
+Finding the commits on one branch that aren't on others (`git log head ^local
+^base`) makes git walk back through the other branches' history until it can
+tell which commits they share, which can take seconds in a repo with a long
+history. If use_history_indexes() is turned on:
+
+* maintain() makes sure that the repo has a commit-graph (which has the
+  generation numbers that let git stop walking early) and reachability
+  bitmaps, and refreshes them incrementally. It's run once per clone.
+* bound() replaces the negative revs of a walk with their merge bases with
+  the positive ones, which are found with the commit-graph. The walk then
+  stops at the merge bases rather than going on down the other branches.
+"""
+
+import glob
+import os
+import threading
+from subprocess import CalledProcessError
+
+from gh_pr_upsert import git
+from gh_pr_upsert.exceptions import TimedOutError
+from gh_pr_upsert.run import run
+
+# Whether bound() is turned on, see use_history_indexes().
+_hooks = {"enabled": False}
+
+# The common git directories of the clones that have been maintained in
+# this process, and a lock so that concurrent walks in the same clone (see
+# manifest.plan_all()) only maintain it once.
+_maintained = set()
+_lock = threading.Lock()
+
+# The commands that maintain() runs. --changed-paths adds Bloom filters that
+# speed up walks limited to paths (see --path).
+COMMIT_GRAPH_COMMAND = [
+    "git",
+    "commit-graph",
+    "write",
+    "--reachable",
+    "--split",
+    "--changed-paths",
+]
+BITMAPS_COMMAND = ["git", "multi-pack-index", "write", "--bitmap"]
+
+
+def use_history_indexes(enabled):
+    """Turn maintaining and using commit-graphs and bitmaps on or off.
+
+    Returns whether it was on before.
+    """
+    previous = _hooks["enabled"]
+    _hooks["enabled"] = enabled
+    return previous
+
+
+def maintain():
+    """Write or refresh the current repo's commit-graph and reachability bitmaps.
+
+    Both are refreshed incrementally: `--split` only writes the commits that
+    aren't in the commit-graph yet, as a new layer, and the bitmaps are only
+    rewritten if a pack has been added since they were written.
+
+    Both are best-effort: git fails to write them if another process is
+    already writing them (for example a parallel run in another worktree of
+    the same clone, which shares its object store), and writing them can
+    take longer than --timeout or --deadline allow. Walks still work
+    without them, just more slowly.
+    """
+    best_effort(COMMIT_GRAPH_COMMAND)
+
+    (pack_dir,) = git.git_paths("objects/pack")
+
+    if bitmaps_are_stale(pack_dir):
+        best_effort(BITMAPS_COMMAND)
+
+
+def best_effort(cmd):
+    """Run `cmd`, ignoring it if it fails or times out."""
+    try:
+        run(cmd)
+    except (CalledProcessError, TimedOutError):
+        pass
+
+
+def bitmaps_are_stale(pack_dir):
+    """Return True if the packs in `pack_dir` have changed since their bitmaps were written."""
+    packs = glob.glob(os.path.join(pack_dir, "pack-*.pack"))
+
+    if not packs:
+        # There's nothing to write bitmaps for.
+        return False
+
+    bitmaps = glob.glob(os.path.join(pack_dir, "multi-pack-index-*.bitmap"))
+
+    if not bitmaps:
+        return True
+
+    return max(os.path.getmtime(pack) for pack in packs) > max(
+        os.path.getmtime(bitmap) for bitmap in bitmaps
+    )
+
+
+def bound(revs):
+    """Return `revs` (for `git log` or `git rev-list`) bounded at their merge bases.
+
+    For example ("head", "^local", "^base") becomes ("head", "^<merge base>")
+    where <merge base> is each merge base of head and local or base, which
+    selects the same commits. `revs` is returned unchanged if
+    use_history_indexes() isn't on, if it has no positive or no negative
+    revs, or if the merge bases can't be found (for example because one of
+    the revs doesn't exist).
+    """
+    ends = split_revs(revs)
+
+    if ends is None:
+        return revs
+
+    positives, negatives = ends
+
+    with _lock:
+        if claim(git.common_dir()):
+            maintain()
+
+    try:
+        merge_bases = {
+            merge_base
+            for positive in positives
+            # The merge bases of `positive` and all the negative revs at once
+            # are the newest commits that it shares with any of them.
+            for merge_base in run(
+                ["git", "merge-base", "--all", positive, *negatives]
+            ).split()
+        }
+    except CalledProcessError:
+        return revs
+
+    return (*positives, *(f"^{merge_base}" for merge_base in sorted(merge_bases)))
+
+
+def split_revs(revs):
+    """Return the (positive, negative) revs of `revs` if bound() should bound them.
+
+    The negative revs are returned without their "^". Returns None if
+    use_history_indexes() isn't on or `revs` has no positive or no negative
+    revs.
+    """
+    if not _hooks["enabled"]:
+        return None
+
+    positives = [rev for rev in revs if not rev.startswith("^")]
+    negatives = [rev[1:] for rev in revs if rev.startswith("^")]
+
+    if not positives or not negatives:
+        return None
+
+    return positives, negatives
+
+
+def claim(common_dir):
+    """Return True if the clone at `common_dir` needs maintain()ing, marking it as done.
+
+    The clone is marked before it's maintained so that if maintaining it
+    fails or times out, later walks don't try (and wait for it) again.
+    """
+    if common_dir in _maintained:
+        return False
+
+    _maintained.add(common_dir)
+    return True
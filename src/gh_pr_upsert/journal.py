@@ -0,0 +1,110 @@
+"""A write-ahead journal of a batch run's progress, so that it can be resumed.
+
+The journal is a JSON Lines file that's appended to (and fsync'ed) before
+and after each manifest entry is upserted:
+
+* Before: a "pending" record, so an entry that a crash interrupted is known
+  to need retrying.
+* After: a "done" record with the entry's result and the SHAs of the
+  branches that it depends on, as they were once it was done.
+
+When a run is resumed from the journal an entry whose last run is done and
+whose options and branches haven't changed since is skipped. Anything else
+(entries that failed, were interrupted, were changed or were never started)
+is upserted again.
+"""
+
+import hashlib
+import json
+import os
+
+from gh_pr_upsert.run import run
+
+
+class Journal:
+    """The journal at `path`, which is created if it doesn't exist."""
+
+    def __init__(self, path):
+        self.path = path
+        # The last record of each entry, keyed by entry key.
+        self.records = {}
+
+        try:
+            with open(path, encoding="utf-8") as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A record that a crash cut short.
+                        continue
+                    self.records[record["key"]] = record
+        except FileNotFoundError:
+            pass
+
+    def completed(self, key, digest):
+        """Return the result of the entry's last run if its inputs are unchanged.
+
+        `digest` is the digest of the entry's options (see options_digest()).
+        Returns None if the entry's last run didn't finish, or if its options
+        or any of the branches that it depends on have changed since.
+        """
+        record = self.records.get(key)
+
+        if not record or record["state"] != "done" or record["digest"] != digest:
+            return None
+
+        if ref_shas(*record["refs"]) != record["refs"]:
+            return None
+
+        return record["result"]
+
+    def start(self, key, digest):
+        """Record that an entry is about to be upserted."""
+        self._write({"key": key, "state": "pending", "digest": digest})
+
+    def finish(self, key, digest, refs, result):
+        """Record an entry's result and the current SHAs of `refs`.
+
+        `refs` are the full names of the branches that the entry depends on,
+        for example "refs/heads/my-branch", and `result` is a JSON-serializable
+        dict.
+        """
+        self._write(
+            {
+                "key": key,
+                "state": "done",
+                "digest": digest,
+                "refs": ref_shas(*refs),
+                "result": result,
+            }
+        )
+
+    def _write(self, record):
+        with open(self.path, "a", encoding="utf-8") as journal_file:
+            journal_file.write(json.dumps(record) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        self.records[record["key"]] = record
+
+
+def options_digest(options):
+    """Return a digest of `options` (a JSON-serializable dict)."""
+    return hashlib.sha256(
+        json.dumps(options, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def ref_shas(*refs):
+    """Return a dict of the SHAs of `refs` (None for refs that don't exist)."""
+    shas = dict.fromkeys(refs)
+
+    for line in run(
+        ["git", "for-each-ref", "--format=%(refname)%00%(objectname)", *refs]
+    ).splitlines():
+        ref, sha = line.split("\0")
+        # for-each-ref's patterns also match the refs under them.
+        if ref in shas:
+            shas[ref] = sha
+
+    return shas
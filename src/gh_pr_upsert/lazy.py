@@ -0,0 +1,76 @@
+"""Lazy imports, to keep gh-pr-upsert's start-up time down.
+
+Most runs only need some of gh-pr-upsert's modules (and the standard library
+modules that they import). Modules that are imported with lazy_import()
+aren't loaded until one of their attributes is first used, so the modules
+that the chosen command doesn't use are never loaded at all.
+
+This doesn't use importlib.util.LazyLoader because before Python 3.13 it
+isn't thread-safe: a thread that uses a module while another thread is
+loading it can see the module half-loaded. Lazily imported modules can be
+first used from several threads at once (for example by manifest.plan_all()
+or sweeper.sweep()) so they're loaded under a lock, and look loaded to other
+threads only once they're completely loaded.
+"""
+
+import importlib
+import importlib.util
+import sys
+import threading
+import types
+
+# Held while a lazily imported module is being loaded. It's reentrant
+# because loading one module can use (and so load) others.
+_LOCK = threading.RLock()
+
+# The lazily imported modules that are being loaded, so that a module's own
+# attribute lookups while it's being loaded don't try to load it again.
+_loading = set()
+
+
+class _LazyModule(types.ModuleType):
+    """A module that's loaded when one of its attributes is first used."""
+
+    def __getattribute__(self, attr):
+        with _LOCK:
+            # Only the first thread to get the lock loads the module. By the
+            # time that any others get it the module's class is ModuleType.
+            if isinstance(self, _LazyModule) and id(self) not in _loading:
+                _loading.add(id(self))
+                try:
+                    spec = types.ModuleType.__getattribute__(self, "__spec__")
+                    spec.loader.exec_module(self)
+                    self.__class__ = types.ModuleType
+                finally:
+                    _loading.discard(id(self))
+
+        return types.ModuleType.__getattribute__(self, attr)
+
+
+def lazy_import(name):
+    """Return the module called `name` without loading it until it's used.
+
+    The module is put in sys.modules (and set as an attribute of its parent
+    package) as if it had been imported normally, so a later normal import
+    of it gets the same module object. If the module has already been
+    imported it's just returned.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+
+    if not hasattr(spec.loader, "exec_module"):
+        # Lazy loading only works with loaders that have exec_module(), which
+        # for example zipimport doesn't before Python 3.10.
+        return importlib.import_module(name)
+
+    module = importlib.util.module_from_spec(spec)
+    module.__class__ = _LazyModule
+    sys.modules[name] = module
+
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+
+    return module
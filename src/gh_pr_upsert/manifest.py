@@ -0,0 +1,497 @@
+"""Upsert many PRs, in one or more repos, from a manifest file.
+
+A manifest is a JSON Lines file: one JSON object per line for each PR to
+upsert. Each object's keys are the same as the command line options'
+(`local_branch`, `base_branch`, `title`, `labels`, ...) plus `directory`:
+the clone to run in, relative to the current directory. Options that an
+entry doesn't give are taken from the command line.
+
+A manifest can be split across several CI nodes with `shard`, see in_shard().
+A run that's interrupted can be resumed without redoing the entries that it
+finished by giving it a `journal`, see the journal module. plan_all() says
+what a run would do without doing any of it.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, replace
+from itertools import groupby
+from subprocess import CalledProcessError
+from typing import Optional
+
+from gh_pr_upsert import core, git, journal, metrics, run
+from gh_pr_upsert.exceptions import (
+    BatchError,
+    ManifestError,
+    NoChangesError,
+    PRUpsertError,
+    TimedOutError,
+)
+
+# The fields that a manifest entry can have, with their default values
+# (which are overridden by the command line's values).
+ENTRY_FIELDS = {
+    "directory": ".",
+    "base_remote": "origin",
+    "base_branch": None,
+    "local_branch": None,
+    "head_remote": "origin",
+    "head_branch": None,
+    "title": None,
+    "body": None,
+    "close_comment": None,
+    "draft": False,
+    "labels": (),
+    "reviewers": (),
+    "assignees": (),
+    "auto_merge": None,
+    "update": False,
+    "paths": (),
+}
+
+# The fields whose values are lists of strings.
+LIST_FIELDS = ("labels", "reviewers", "assignees", "paths")
+
+# The merge methods that `auto_merge` can be (in any case).
+AUTO_MERGE_METHODS = ("merge", "squash", "rebase")
+
+
+@dataclass(frozen=True)
+class Entry:  # pylint:disable=too-many-instance-attributes
+    """One PR to upsert."""
+
+    # The entry's position in the manifest, counting from 0.
+    index: int
+    directory: str
+    base_remote: str
+    base_branch: Optional[str]
+    local_branch: str
+    head_remote: str
+    head_branch: str
+    title: str
+    body: str
+    close_comment: str
+    draft: bool
+    labels: tuple
+    reviewers: tuple
+    assignees: tuple
+    auto_merge: Optional[str]
+    update: bool
+    paths: tuple
+
+    @property
+    def shard_key(self) -> bytes:
+        """Return the key that decides which shard this entry belongs to.
+
+        The base repo is identified by the clone and remote rather than by
+        asking GitHub so that entries can be sharded without any lookups.
+        Unlike Entry.key this leaves out the base branch, so that entries
+        for PRs from the same head branch to different base branches are
+        in the same shard and don't push that branch from two places at once.
+        """
+        return "\0".join(
+            [os.path.normpath(self.directory), self.base_remote, self.head_branch]
+        ).encode("utf-8")
+
+    @property
+    def key(self) -> str:
+        """Return a string that identifies this entry's PR within a manifest.
+
+        A PR is identified by its base branch and its head branch, each with
+        the remote it's on. A base_branch of None (the default branch) is "".
+        """
+        return "\0".join(
+            [
+                os.path.normpath(self.directory),
+                self.base_remote,
+                self.base_branch or "",
+                self.head_remote,
+                self.head_branch,
+            ]
+        )
+
+    @property
+    def digest(self) -> str:
+        """Return a digest of this entry's options, for the journal."""
+        options = asdict(self)
+        # Where the entry is in the manifest doesn't change what it does.
+        del options["index"]
+        options["directory"] = os.path.normpath(self.directory)
+        return journal.options_digest(options)
+
+
+@dataclass(frozen=True)
+class EntryResult:  # pylint:disable=too-many-instance-attributes
+    """What happened to one manifest entry, as written to the summary file."""
+
+    index: int
+    directory: str
+    base_remote: str
+    # The base branch, or None if it couldn't be found out.
+    base_branch: Optional[str]
+    head_branch: str
+    # The shard that handled the entry, for example "2/4".
+    shard: str
+    # The Action that core.upsert() took, or None if it raised.
+    action: Optional[str]
+    url: Optional[str]
+    # The message of the error that was raised, if any.
+    error: Optional[str]
+    exit_status: int
+    # Whether the entry was skipped because a journaled run had already done it.
+    resumed: bool = False
+
+    @property
+    def failed(self) -> bool:
+        # Having no changes isn't a failure: the PR is closed or not created.
+        return self.exit_status not in (0, NoChangesError.exit_status)
+
+
+def read(path, defaults):
+    """Return the list of Entry's in the manifest file at `path`.
+
+    `defaults` is a dict of values for the fields that entries don't give.
+
+    :raise ManifestError: if the manifest is invalid, or has two entries for
+        the same PR
+    """
+    entries = []
+    # The line number of each entry, by Entry.key.
+    linenos = {}
+
+    with open(path, encoding="utf-8") as manifest_file:
+        for lineno, line in enumerate(manifest_file, 1):
+            if not line.strip():
+                continue
+
+            try:
+                fields = json.loads(line)
+            except ValueError as err:
+                raise ManifestError(f"{path}:{lineno}: invalid JSON: {err}") from err
+
+            if not isinstance(fields, dict):
+                raise ManifestError(f"{path}:{lineno}: entries must be JSON objects")
+
+            unknown = set(fields) - set(ENTRY_FIELDS)
+            if unknown:
+                raise ManifestError(
+                    f"{path}:{lineno}: unknown fields: "
+                    + ", ".join(repr(name) for name in sorted(unknown))
+                )
+
+            fields = {**ENTRY_FIELDS, **defaults, **fields}
+            check_fields(fields, f"{path}:{lineno}")
+
+            fields["head_branch"] = fields["head_branch"] or fields["local_branch"]
+            for name in LIST_FIELDS:
+                fields[name] = tuple(fields[name])
+
+            entry = Entry(index=len(entries), **fields)
+
+            if entry.key in linenos:
+                raise ManifestError(
+                    f"{path}:{lineno}: same PR as line {linenos[entry.key]}"
+                )
+
+            linenos[entry.key] = lineno
+            entries.append(entry)
+
+    return entries
+
+
+def check_fields(fields, where):
+    """Check the values of an entry's `fields`.
+
+    `where` is the entry's "path:lineno" in the manifest, for error messages.
+
+    :raise ManifestError: if a field's value is invalid
+    """
+    if not fields["local_branch"]:
+        raise ManifestError(f"{where}: no local_branch")
+
+    for name in LIST_FIELDS:
+        # A string would otherwise be split into its characters: for example
+        # "paths": "src" would limit the entry to files called "s", "r" and
+        # "c", so it'd have no changes and its PR would be closed.
+        if not isinstance(fields[name], (list, tuple)) or not all(
+            isinstance(item, str) for item in fields[name]
+        ):
+            raise ManifestError(f"{where}: {name} must be a list of strings")
+
+    if fields["auto_merge"] is not None and not (
+        isinstance(fields["auto_merge"], str)
+        and fields["auto_merge"].lower() in AUTO_MERGE_METHODS
+    ):
+        raise ManifestError(
+            f"{where}: auto_merge must be one of: " + ", ".join(AUTO_MERGE_METHODS)
+        )
+
+
+def parse_shard(shard):
+    """Return the (index, count) of a shard given as "INDEX/COUNT".
+
+    Shards are numbered from 1, so "1/4" to "4/4" cover a whole manifest.
+
+    :raise ValueError: if `shard` isn't a valid shard
+    """
+    index, sep, count = shard.partition("/")
+
+    if not (sep and index.isdigit() and count.isdigit()):
+        raise ValueError(f"shards must look like INDEX/COUNT, not {shard!r}")
+
+    index, count = int(index), int(count)
+
+    if not 1 <= index <= count:
+        raise ValueError(f"shard index must be between 1 and {count}, not {index}")
+
+    return index, count
+
+
+def in_shard(entry, shard):
+    """Return True if `entry` belongs to `shard` (an (index, count) tuple).
+
+    Entries are assigned to shards by a hash of their base repo and head
+    branch, so each shard of a manifest gets a disjoint slice of it and an
+    entry stays on the same shard when other entries are added or removed.
+    Python's hash() isn't used because it's different in each process.
+    """
+    index, count = shard
+    digest = hashlib.sha256(entry.shard_key).digest()
+    return int.from_bytes(digest[:8], "big") % count == index - 1
+
+
+def upsert_all(entries, shard=(1, 1), summary_file=None, journal_file=None):
+    """Upsert the PRs of the `entries` that are in `shard` and return the results.
+
+    Prints each entry's result as it's done. If `summary_file` is given a
+    JSON line for each entry's EntryResult is appended to it, so the summary
+    files of all the shards of a manifest can be merged by concatenating
+    them.
+
+    If `journal_file` is given the run's progress is journaled to it, and
+    entries that an earlier run journaled as done are skipped unless they
+    failed or they or their branches have changed since (see the journal
+    module). Skipped entries' results are still returned and summarized.
+
+    An entry failing doesn't stop the others from being upserted.
+
+    :raise BatchError: after all the entries are done, if any of them failed
+    """
+    results = []
+    progress = journal.Journal(journal_file) if journal_file else None
+
+    for clone_entries in by_clone(entries, shard):
+        for entry in clone_entries:
+            with chdir(entry.directory):
+                if progress:
+                    result = resume_entry(progress, entry, shard)
+                else:
+                    result = upsert_entry(entry, shard)
+
+            results.append(result)
+
+            if summary_file:
+                with open(summary_file, "a", encoding="utf-8") as summary:
+                    summary.write(json.dumps(asdict(result)) + "\n")
+
+    failures = [result for result in results if result.failed]
+
+    if failures:
+        raise BatchError(len(failures), len(results))
+
+    return results
+
+
+def plan_all(entries, shard=(1, 1), max_workers=None):
+    """Print and return a plan of what upsert_all() would do for `entries`.
+
+    Nothing is pushed or changed on GitHub. Each of the `entries` that are
+    in `shard` gets a JSON-serializable dict with the entry's details and
+    its core.Plan (or the error that planning it raised), printed as a line
+    of JSON as it's done. A clone's entries are planned concurrently, in up
+    to `max_workers` threads.
+    """
+    plans = []
+
+    for clone_entries in by_clone(entries, shard):
+        with (
+            chdir(clone_entries[0].directory),
+            ThreadPoolExecutor(max_workers) as executor,
+        ):
+            for entry_plan in executor.map(plan_entry, clone_entries):
+                print(json.dumps(entry_plan))
+                plans.append(entry_plan)
+
+    return plans
+
+
+def plan_entry(entry):
+    """Return a JSON-serializable dict of what upsert_entry() would do for `entry`."""
+    entry_plan = {
+        "index": entry.index,
+        "directory": entry.directory,
+        "base_remote": entry.base_remote,
+        "base_branch": entry.base_branch,
+        "head_branch": entry.head_branch,
+        "action": None,
+        "error": None,
+    }
+
+    try:
+        base_repo = git.GitHubRepo.get(entry.base_remote)
+        entry_plan["base_branch"] = entry.base_branch or base_repo.default_branch
+        entry_plan.update(
+            core.plan(
+                base_repo,
+                entry_plan["base_branch"],
+                entry.local_branch,
+                git.GitHubRepo.get(entry.head_remote),
+                entry.head_branch,
+                entry.title,
+                entry.body,
+                update=entry.update,
+                paths=entry.paths,
+            ).to_dict()
+        )
+    except PRUpsertError as err:
+        if out_of_time(err):
+            raise
+        entry_plan["error"] = err.message
+    except CalledProcessError as err:
+        entry_plan["error"] = (err.stderr or b"").decode("utf-8").strip() or str(err)
+
+    return entry_plan
+
+
+def by_clone(entries, shard):
+    """Yield the lists of the `entries` in `shard` that are in each clone.
+
+    Doing each clone's entries together means that what's looked up about
+    its repos and branches is cached for all of them. The caches are
+    cleared between clones because they're keyed by remote and branch names,
+    which mean different things in different clones.
+    """
+    entries = sorted(
+        (entry for entry in entries if in_shard(entry, shard)),
+        key=lambda entry: (os.path.normpath(entry.directory), entry.index),
+    )
+
+    for _, clone_entries in groupby(
+        entries, key=lambda entry: os.path.normpath(entry.directory)
+    ):
+        for function in git.cached_functions():
+            function.cache_clear()
+        yield list(clone_entries)
+
+
+def resume_entry(progress, entry, shard):
+    """Upsert `entry`'s PR unless `progress` (a Journal) says it's already done."""
+    previous = progress.completed(entry.key, entry.digest)
+
+    if previous:
+        result = EntryResult(**previous)
+        if not result.failed:
+            print(f"{entry.directory}: {entry.head_branch}: unchanged, skipping")
+            return replace(
+                result, index=entry.index, shard=shard_name(shard), resumed=True
+            )
+
+    progress.start(entry.key, entry.digest)
+    result = upsert_entry(entry, shard)
+
+    refs = [
+        f"refs/heads/{entry.local_branch}",
+        f"refs/remotes/{entry.head_remote}/{entry.head_branch}",
+    ]
+    if result.base_branch:
+        refs.append(f"refs/remotes/{entry.base_remote}/{result.base_branch}")
+
+    progress.finish(entry.key, entry.digest, refs, asdict(result))
+    return result
+
+
+def upsert_entry(entry, shard):
+    """Upsert `entry`'s PR, print the result and return an EntryResult."""
+    result = None
+    error = None
+    exit_status = 0
+    outcome = "success"
+    base_branch = entry.base_branch
+
+    try:
+        base_repo = git.GitHubRepo.get(entry.base_remote)
+        base_branch = base_branch or base_repo.default_branch
+        result = core.upsert(
+            base_repo,
+            base_branch,
+            entry.local_branch,
+            git.GitHubRepo.get(entry.head_remote),
+            entry.head_branch,
+            entry.title,
+            entry.body,
+            entry.close_comment,
+            draft=entry.draft,
+            labels=entry.labels,
+            reviewers=entry.reviewers,
+            assignees=entry.assignees,
+            auto_merge=entry.auto_merge.upper() if entry.auto_merge else None,
+            update=entry.update,
+            paths=entry.paths,
+        )
+        core.print_result(result)
+    except PRUpsertError as err:
+        if out_of_time(err):
+            metrics.OUTCOMES.inc(outcome=type(err).__name__)
+            raise
+        error, exit_status, outcome = err.message, err.exit_status, type(err).__name__
+    except CalledProcessError as err:
+        error = (err.stderr or b"").decode("utf-8").strip() or str(err)
+        exit_status, outcome = 1, type(err).__name__
+
+    metrics.OUTCOMES.inc(outcome=outcome)
+
+    if error:
+        print(f"{entry.directory}: {entry.head_branch}: {error}")
+
+    return EntryResult(
+        index=entry.index,
+        directory=entry.directory,
+        base_remote=entry.base_remote,
+        base_branch=base_branch,
+        head_branch=entry.head_branch,
+        shard=shard_name(shard),
+        action=result.action.value if result else None,
+        url=result.url if result else None,
+        error=error,
+        exit_status=exit_status,
+    )
+
+
+def out_of_time(err):
+    """Return True if `err` means that the whole batch should stop.
+
+    An entry that times out because one of its commands took longer than
+    --timeout is just a failed entry. But once the --deadline has passed every
+    remaining entry would fail too, so the batch stops and exits with
+    TimedOutError's status instead, so that it can be rescheduled.
+    """
+    return isinstance(err, TimedOutError) and run.deadline_exceeded()
+
+
+def shard_name(shard):
+    """Return `shard` (an (index, count) tuple) as "INDEX/COUNT"."""
+    return "/".join(str(number) for number in shard)
+
+
+@contextmanager
+def chdir(path):
+    """Change to the directory at `path` for the duration of the context."""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
@@ -0,0 +1,296 @@
+"""Prometheus metrics for monitoring gh-pr-upsert runs.
+
+The metrics are kept in memory for the duration of the process and can be
+exported at the end of a run with write_textfile() (for node_exporter's
+textfile collector) or push() (for a Pushgateway).
+"""
+
+import inspect
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import quote
+
+from gh_pr_upsert.lazy import lazy_import
+
+# These are only needed for exporting metrics, and they're slow to import.
+tempfile = lazy_import("tempfile")
+urllib_request = lazy_import("urllib.request")
+
+# Prometheus's default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# All the metrics, in the order that they were created.
+REGISTRY = []
+
+
+class Metric:
+    """Base class for metrics.
+
+    Subclasses must implement reset() and samples(), which yields a
+    (name, labels, value) tuple for each of the metric's samples.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, help_, labelnames=()):
+        self.name = name
+        self.help = help_
+        self.labelnames = tuple(labelnames)
+        # Metrics can be updated from multiple threads at once (see sweeper.sweep()).
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[labelname]) for labelname in self.labelnames)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, help_, labelnames=()):
+        super().__init__(name, help_, labelnames)
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            self.values[self._key(labels)] += amount
+
+    def set(self, value, **labels):
+        """Set the counter to `value`, for values that are counted elsewhere."""
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def reset(self):
+        self.values.clear()
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help_, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_, labelnames)
+        self.buckets = tuple(buckets)
+        # Maps label values to [per-bucket counts, sum, count].
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            values = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    values[0][i] += 1
+            values[1] += value
+            values[2] += 1
+
+    def reset(self):
+        self.values.clear()
+
+    def samples(self):
+        for key, (bucket_counts, sum_, count) in sorted(self.values.items()):
+            labels = dict(zip(self.labelnames, key))
+            for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                yield f"{self.name}_bucket", {
+                    **labels,
+                    "le": f"{bucket:g}",
+                }, bucket_count
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, count
+            yield f"{self.name}_sum", labels, sum_
+            yield f"{self.name}_count", labels, count
+
+
+SUBPROCESSES = Counter(
+    "gh_pr_upsert_subprocesses_total",
+    "Subprocesses spawned, by program.",
+    ["program"],
+)
+SUBPROCESS_DURATION = Histogram(
+    "gh_pr_upsert_subprocess_duration_seconds",
+    "How long subprocesses took to run, by program.",
+    ["program"],
+)
+API_REQUESTS = Counter(
+    "gh_pr_upsert_api_requests_total",
+    "GitHub API requests made with `gh`, by endpoint.",
+    ["endpoint"],
+)
+CACHE_HITS = Counter(
+    "gh_pr_upsert_cache_hits_total",
+    "Calls to cached functions that were answered from the cache, by function.",
+    ["function"],
+)
+CACHE_MISSES = Counter(
+    "gh_pr_upsert_cache_misses_total",
+    "Calls to cached functions that weren't answered from the cache, by function.",
+    ["function"],
+)
+DIFF_BYTES = Counter(
+    "gh_pr_upsert_diff_bytes_total",
+    "Bytes of `git diff` output compared.",
+)
+PUSH_DURATION = Histogram(
+    "gh_pr_upsert_push_duration_seconds",
+    "How long `git push` took.",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+OUTCOMES = Counter(
+    "gh_pr_upsert_outcomes_total",
+    'Upsert outcomes: "success" or the name of the exception that was raised.',
+    ["outcome"],
+)
+
+
+def api_endpoint(cmd):
+    """Return a low-cardinality name for the API endpoint that `gh` `cmd` calls.
+
+    For example "/repos/{owner}/{repo}/pulls/{number}" for `gh api` commands
+    or "repo view" for other `gh` commands. The compare API's "base...head"
+    (which can contain slashes, from the branch names) becomes "{basehead}".
+    """
+    if cmd[1] != "api":
+        return " ".join(cmd[1:3])
+
+    path = next(arg for arg in cmd[2:] if arg.startswith("/") or arg == "graphql")
+    segments = path.split("?")[0].split("/")
+
+    if segments[1:2] == ["repos"]:
+        segments[2:4] = ["{owner}", "{repo}"]
+
+        if segments[4:5] == ["compare"]:
+            segments[5:] = ["{basehead}"]
+
+    return "/".join(
+        "{number}" if segment.isdigit() else segment for segment in segments
+    )
+
+
+def record_outcome(function):
+    """Count the outcomes of calls to `function` in OUTCOMES.
+
+    `function` can be a normal function or a coroutine function.
+    """
+    if inspect.iscoroutinefunction(function):
+
+        @wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                result = await function(*args, **kwargs)
+            except Exception as err:
+                OUTCOMES.inc(outcome=type(err).__name__)
+                raise
+
+            OUTCOMES.inc(outcome="success")
+            return result
+
+        return async_wrapper
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            result = function(*args, **kwargs)
+        except Exception as err:
+            OUTCOMES.inc(outcome=type(err).__name__)
+            raise
+
+        OUTCOMES.inc(outcome="success")
+        return result
+
+    return wrapper
+
+
+@contextmanager
+def timed(timings, name):
+    """Record how long the body of the `with` statement takes in `timings[name]`."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[name] = time.monotonic() - start
+
+
+def record_cache_info(functions):
+    """Record the hit and miss counts of the given functools.cache'd functions."""
+    for function in functions:
+        info = function.cache_info()
+        CACHE_HITS.set(info.hits, function=function.__qualname__)
+        CACHE_MISSES.set(info.misses, function=function.__qualname__)
+
+
+def to_text():
+    """Return all the metrics in the Prometheus text exposition format."""
+    lines = []
+
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            if labels:
+                label_text = ",".join(
+                    f'{labelname}="{_escape(labelvalue)}"'
+                    for labelname, labelvalue in labels.items()
+                )
+                lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+            else:
+                lines.append(f"{name} {_format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path):
+    """Write all the metrics to `path` for node_exporter's textfile collector.
+
+    The file is written atomically so that node_exporter never reads a
+    partially written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            tmp_file.write(to_text())
+        # mkstemp() makes the file readable only by its owner but
+        # node_exporter usually runs as another user, so give the file the
+        # mode that open() would have (there's no way to read the umask
+        # without setting it).
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o644 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def push(url, job="gh-pr-upsert", timeout=10):
+    """Push all the metrics to the Pushgateway-compatible endpoint at `url`."""
+    request = urllib_request.Request(
+        f"{url.rstrip('/')}/metrics/job/{quote(job, safe='')}",
+        data=to_text().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4"},
+        method="PUT",
+    )
+    with urllib_request.urlopen(request, timeout=timeout):
+        pass
+
+
+def reset():
+    """Reset all the metrics."""
+    for metric in REGISTRY:
+        metric.reset()
+
+
+def _format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
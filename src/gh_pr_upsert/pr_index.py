@@ -0,0 +1,358 @@
+"""A local index of open PRs, kept up to date by GitHub webhooks.
+
+If PullRequest.get() is given an index (see git.use_pr_index()) it looks PRs
+up in the index before asking GitHub, so upserting a PR needn't list the
+repo's PRs with the API.
+
+The index is an SQLite database that's filled in by:
+
+* WebhookServer: a small HTTP server that receives GitHub's `pull_request`
+  webhooks.
+* replay(): applies webhook deliveries that were recorded to a file, for
+  example by WebhookServer.
+* PRIndex.sync(): lists a repo's open PRs with the API.
+* gh-pr-upsert itself, which records the PRs that it creates, updates and
+  closes so that the index doesn't have to wait for their webhooks.
+
+An indexed PR is only trusted for `max_age` seconds after it was last
+written to the index, or after its repo was last synced. A PR not being in
+the index is only trusted if its repo was synced within `max_age`. Anything
+else falls back to the API.
+"""
+
+import hashlib
+import hmac
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from gh_pr_upsert import git
+from gh_pr_upsert.run import stream
+
+# How long, in seconds, indexed data is trusted for by default.
+DEFAULT_MAX_AGE = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pull_requests (
+    repo TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    base_branch TEXT NOT NULL,
+    -- The head branch as "owner:branch".
+    head TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    head_sha TEXT NOT NULL,
+    html_url TEXT NOT NULL,
+    raw_json TEXT NOT NULL,
+    -- When the PR was last updated on GitHub, used to ignore webhooks that
+    -- arrive out of order.
+    updated_at TEXT NOT NULL,
+    -- When the row was last written, as a Unix time.
+    received_at REAL NOT NULL,
+    PRIMARY KEY (repo, number)
+);
+CREATE INDEX IF NOT EXISTS pull_requests_by_branch
+    ON pull_requests (repo, base_branch, head);
+CREATE TABLE IF NOT EXISTS repos (
+    repo TEXT PRIMARY KEY,
+    -- When all the repo's open PRs were last listed, as a Unix time.
+    synced_at REAL NOT NULL
+);
+"""
+
+UPSERT_SQL = """
+INSERT INTO pull_requests VALUES (
+    :repo, :number, :state, :base_branch, :head, :node_id, :head_sha,
+    :html_url, :raw_json, :updated_at, :received_at
+)
+ON CONFLICT (repo, number) DO UPDATE SET
+    state = excluded.state,
+    base_branch = excluded.base_branch,
+    head = excluded.head,
+    node_id = excluded.node_id,
+    head_sha = excluded.head_sha,
+    html_url = excluded.html_url,
+    raw_json = excluded.raw_json,
+    updated_at = excluded.updated_at,
+    received_at = excluded.received_at
+WHERE excluded.updated_at >= pull_requests.updated_at
+"""
+
+# A jq filter (for `gh api --jq`) that reduces each PR in a list of PRs from
+# the GitHub API to the fields that PRIndex.apply() needs, one per line.
+SYNC_JQ = (
+    ".[] | {number, node_id, state, html_url, title, body, updated_at,"
+    " base: {ref: .base.ref, repo: {full_name: .base.repo.full_name}},"
+    " head: {label: .head.label, sha: .head.sha}}"
+)
+
+
+class PRIndex:
+    """An index of open PRs in the SQLite database at `path`."""
+
+    def __init__(self, path, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def get(self, base_repo, base_branch, head_repo, head_branch):
+        """Look up the open PR from `head_branch` to `base_branch`.
+
+        Returns a (hit, pull_request) tuple. If `hit` is False the index
+        doesn't know whether there's a PR and the caller should ask GitHub.
+        Otherwise `pull_request` is the PR, or None if there isn't one.
+        """
+        now = time.time()
+
+        with self._connect() as connection:
+            synced = connection.execute(
+                "SELECT synced_at FROM repos WHERE repo = ?",
+                (base_repo.name_with_owner,),
+            ).fetchone()
+            rows = connection.execute(
+                "SELECT * FROM pull_requests"
+                " WHERE repo = ? AND base_branch = ? AND head = ? AND state = 'open'",
+                (
+                    base_repo.name_with_owner,
+                    base_branch,
+                    f"{head_repo.owner}:{head_branch}",
+                ),
+            ).fetchall()
+
+        synced_recently = (
+            synced is not None and now - synced["synced_at"] <= self.max_age
+        )
+
+        if not rows:
+            return synced_recently, None
+
+        if len(rows) > 1:
+            # GitHub doesn't allow this, so the index is out of date.
+            return False, None
+
+        (row,) = rows
+
+        if not (synced_recently or now - row["received_at"] <= self.max_age):
+            return False, None
+
+        return True, git.PullRequest(
+            base_repo=base_repo,
+            head_repo=head_repo,
+            head_branch=head_branch,
+            number=row["number"],
+            node_id=row["node_id"],
+            base_branch=row["base_branch"],
+            head_sha=row["head_sha"],
+            html_url=row["html_url"],
+            raw_json=row["raw_json"],
+            updated_at=row["updated_at"],
+        )
+
+    def apply(self, pull_request):
+        """Write a PR's JSON (from a webhook or the API) to the index.
+
+        The PR is ignored if the index already has a more recent version of
+        it, because webhooks can arrive out of order.
+        """
+        self._upsert(
+            {
+                "repo": pull_request["base"]["repo"]["full_name"],
+                "number": pull_request["number"],
+                "state": pull_request["state"],
+                "base_branch": pull_request["base"]["ref"],
+                "head": pull_request["head"]["label"],
+                "node_id": pull_request["node_id"],
+                "head_sha": pull_request["head"]["sha"],
+                "html_url": pull_request["html_url"],
+                "raw_json": json.dumps(
+                    {"title": pull_request["title"], "body": pull_request["body"]}
+                ),
+                "updated_at": pull_request["updated_at"],
+            }
+        )
+
+    def record(self, pull_request, state="open", updated_at=None):
+        """Write a git.PullRequest that gh-pr-upsert has just changed to the index.
+
+        `updated_at` is when GitHub says the change was made, and defaults to
+        the PR's `updated_at`. GitHub's clock is used rather than ours so that
+        webhooks for later changes aren't ignored if our clock is ahead.
+        """
+        self._upsert(
+            {
+                "repo": pull_request.base_repo.name_with_owner,
+                "number": pull_request.number,
+                "state": state,
+                "base_branch": pull_request.base_branch,
+                "head": f"{pull_request.head_repo.owner}:{pull_request.head_branch}",
+                "node_id": pull_request.node_id,
+                "head_sha": pull_request.head_sha,
+                "html_url": pull_request.html_url,
+                "raw_json": pull_request.raw_json,
+                "updated_at": updated_at or pull_request.updated_at,
+            }
+        )
+
+    def sync(self, repo):
+        """Replace what the index knows about `repo`'s ("owner/name") open PRs with the API's answer."""
+        synced_at = time.time()
+        pull_requests = [
+            json.loads(line)
+            for line in stream(
+                [
+                    "gh",
+                    "api",
+                    "--header",
+                    "X-GitHub-Api-Version:2022-11-28",
+                    "--paginate",
+                    "--method",
+                    "GET",
+                    f"/repos/{repo}/pulls",
+                    "-f",
+                    "state=open",
+                    "-f",
+                    "per_page=100",
+                    "--jq",
+                    SYNC_JQ,
+                ]
+            )
+        ]
+
+        for pull_request in pull_requests:
+            self.apply(pull_request)
+
+        with self._connect() as connection:
+            # PRs that were closed while nothing was listening for webhooks.
+            # PRs that were written since the listing started are left alone
+            # because they may have been opened since.
+            connection.execute(
+                "UPDATE pull_requests SET state = 'closed', received_at = ?"
+                " WHERE repo = ? AND state = 'open' AND received_at < ?"
+                " AND number NOT IN (SELECT value FROM json_each(?))",
+                (
+                    synced_at,
+                    repo,
+                    synced_at,
+                    json.dumps(
+                        [pull_request["number"] for pull_request in pull_requests]
+                    ),
+                ),
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO repos VALUES (?, ?)", (repo, synced_at)
+            )
+
+        return len(pull_requests)
+
+    def handle_event(self, event, payload):
+        """Apply a webhook delivery to the index.
+
+        Returns True if the event was a `pull_request` event, which is the
+        only kind that the index uses.
+        """
+        if event != "pull_request":
+            return False
+
+        self.apply(payload["pull_request"])
+        return True
+
+    def _upsert(self, row):
+        with self._connect() as connection:
+            connection.execute(UPSERT_SQL, {**row, "received_at": time.time()})
+
+    @contextmanager
+    def _connect(self):
+        # A connection per transaction, so that the index can be used from
+        # several threads (see WebhookServer) and processes at once.
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+def replay(index, path):
+    """Apply the webhook deliveries recorded in the JSON Lines file at `path`.
+
+    Each line is either an {"event": ..., "payload": ...} object (as
+    written by serve()) or just a `pull_request` event's payload, as shown
+    in the "Recent Deliveries" of a GitHub webhook's settings.
+
+    Returns the number of `pull_request` events that were applied.
+    """
+    applied = 0
+
+    with open(path, encoding="utf-8") as deliveries:
+        for line in deliveries:
+            if not line.strip():
+                continue
+
+            delivery = json.loads(line)
+
+            if "payload" not in delivery:
+                delivery = {"event": "pull_request", "payload": delivery}
+
+            applied += index.handle_event(delivery["event"], delivery["payload"])
+
+    return applied
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Receives GitHub webhook deliveries for a WebhookServer."""
+
+    server: "WebhookServer"
+
+    def do_POST(self):  # pylint:disable=invalid-name
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if not self.server.verify(body, self.headers.get("X-Hub-Signature-256", "")):
+            self.send_error(401, "Invalid signature")
+            return
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return
+
+        self.server.receive(self.headers.get("X-GitHub-Event", ""), payload)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Only log errors, rather than every delivery.
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """An HTTP server that writes GitHub's webhooks to a PRIndex.
+
+    Deliveries must be signed with `secret` (see GitHub's "Validating
+    webhook deliveries") and are appended to the file at `record`, if given,
+    so that they can be replayed with replay().
+    """
+
+    def __init__(self, address, index, secret, record=None):
+        super().__init__(address, WebhookHandler)
+        self.index = index
+        self.secret = secret.encode("utf-8")
+        self.record = record
+        self.lock = threading.Lock()
+
+    def verify(self, body, signature):
+        """Return True if `signature` is the X-Hub-Signature-256 of `body`."""
+        expected = hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(f"sha256={expected}", signature)
+
+    def receive(self, event, payload):
+        self.index.handle_event(event, payload)
+
+        if self.record:
+            with self.lock, open(self.record, "a", encoding="utf-8") as record:
+                record.write(json.dumps({"event": event, "payload": payload}) + "\n")
@@ -2,17 +2,421 @@
 
 import json as json_
 import os
-import subprocess
+import signal
+import threading
+import time
+from subprocess import PIPE, CalledProcessError, Popen, TimeoutExpired
 
+from gh_pr_upsert import metrics
+from gh_pr_upsert.exceptions import TimedOutError
+from gh_pr_upsert.lazy import lazy_import
 
-def run(cmd, json=False):
-    """Run a command in a subprocess and returns its stdout."""
+# Only run_async() and stream_async() need asyncio, and it's slow to import.
+asyncio = lazy_import("asyncio")
+
+# How many bytes of a command's stdout stream() reads at a time.
+CHUNK_SIZE = 64 * 1024
+
+# How many bytes of the end of a command's stderr stream() keeps for error
+# messages. The rest is read and thrown away.
+STDERR_LIMIT = 64 * 1024
+
+# The limits on how long commands can take, see set_timeouts().
+_limits = {"timeout": None, "deadline": None}
+
+# The cassette that commands are recorded to or replayed from, see use_cassette().
+_hooks = {"cassette": None}
+
+
+def set_timeouts(timeout=None, deadline=None):
+    """Limit how long the commands run by run() are allowed to take.
+
+    `timeout` is the maximum number of seconds that any one command can take.
+    `deadline` is the maximum number of seconds from now that all commands
+    combined can take. Either can be None for no limit.
+
+    A command that runs out of time is killed (along with any child processes
+    that it has started) and run() raises TimedOutError.
+    """
+    _limits["timeout"] = timeout
+    _limits["deadline"] = None if deadline is None else time.monotonic() + deadline
+
+
+def deadline_exceeded():
+    """Return True if the deadline set with set_timeouts() has passed."""
+    deadline = _limits["deadline"]
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def use_cassette(cassette):
+    """Record commands to, or replay them from, `cassette`.
+
+    `cassette` is a cassette.Recorder, a cassette.Player or None to go back
+    to just running commands. Returns the previous cassette. Use the
+    cassette.record() and cassette.replay() context managers rather than
+    calling this directly.
+    """
+    previous = _hooks["cassette"]
+    _hooks["cassette"] = cassette
+    return previous
+
+
+def run(cmd, json=False, json_input=None):  # pylint:disable=too-many-locals
+    """Run a command in a subprocess and returns its stdout.
+
+    If `json_input` is given it's serialized as JSON and written to the
+    command's stdin. This is how request bodies are sent to `gh api` (with
+    `--input -`): large values such as PR bodies can't overflow the OS's limit
+    on the size of command line arguments.
+    """
+    stdin, timeout, program = _prepare(cmd, json_input)
+    cassette = _hooks["cassette"]
+
+    if cassette is not None and cassette.replaying:
+        returncode, stdout, stderr, delay = cassette.play(cmd, stdin)
+        time.sleep(delay)
+        return _result(cmd, returncode, stdout, stderr, json)
+
+    start = time.monotonic()
+    group = _own_group(timeout)
+
+    with Popen(
+        cmd,
+        stdin=PIPE if stdin is not None else None,
+        stdout=PIPE,
+        stderr=PIPE,
+        start_new_session=group,
+    ) as process:
+        try:
+            stdout, stderr = process.communicate(stdin, timeout=timeout)
+        except TimeoutExpired as err:
+            _kill(process, group)
+            process.communicate()
+            raise TimedOutError(f"Timed out after {timeout:g}s: {cmd}") from err
+        except BaseException:
+            # For example KeyboardInterrupt: don't leave orphaned processes.
+            _kill(process, group)
+            process.communicate()
+            raise
+        finally:
+            duration = time.monotonic() - start
+            metrics.SUBPROCESS_DURATION.observe(duration, program=program)
+
+    if cassette is not None:
+        cassette.record(cmd, stdin, process.returncode, stdout, stderr, duration)
+
+    return _result(cmd, process.returncode, stdout, stderr, json)
+
+
+async def run_async(cmd, json=False, json_input=None):  # pylint:disable=too-many-locals
+    """Run a command in a subprocess without blocking the event loop.
+
+    The asyncio version of run(): it takes the same arguments, returns the
+    same things and has the same timeouts. If the calling task is cancelled
+    the command (and any processes that it started) is killed before the
+    CancelledError is re-raised.
+    """
+    stdin, timeout, program = _prepare(cmd, json_input)
+    cassette = _hooks["cassette"]
+
+    if cassette is not None and cassette.replaying:
+        returncode, stdout, stderr, delay = cassette.play(cmd, stdin)
+        await asyncio.sleep(delay)
+        return _result(cmd, returncode, stdout, stderr, json)
+
+    start = time.monotonic()
+    group = _own_group(timeout)
+
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=PIPE if stdin is not None else None,
+        stdout=PIPE,
+        stderr=PIPE,
+        start_new_session=group,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(stdin), timeout)
+    except asyncio.TimeoutError as err:
+        _kill(process, group)
+        await process.wait()
+        raise TimedOutError(f"Timed out after {timeout:g}s: {cmd}") from err
+    except BaseException:
+        # For example asyncio.CancelledError: don't leave orphaned processes.
+        _kill(process, group)
+        await process.wait()
+        raise
+    finally:
+        duration = time.monotonic() - start
+        metrics.SUBPROCESS_DURATION.observe(duration, program=program)
+
+    if cassette is not None:
+        cassette.record(cmd, stdin, process.returncode, stdout, stderr, duration)
+
+    return _result(cmd, process.returncode, stdout, stderr, json)
+
+
+def stream(cmd, separator=b"\n"):  # pylint:disable=too-many-locals,too-complex
+    r"""Run a command and yield its stdout as it's produced.
+
+    The output is split on `separator` (b"\n" for lines, b"\0" for the
+    records of git's -z options) and each record is yielded as a string as
+    soon as the command has written it, so output that's too big to hold in
+    memory can be processed a record at a time. Empty records are skipped.
+    If `separator` is None the output is yielded as chunks of bytes, as
+    they're read.
+
+    The output is only read as fast as the caller asks for it: a command
+    that gets ahead of the caller blocks on writing to its stdout, rather
+    than its output piling up in memory. Only the last STDERR_LIMIT bytes of
+    its stderr are kept, for the CalledProcessError.
+
+    Has the same timeouts as run(). Raises CalledProcessError after the last
+    record if the command fails. If the caller stops iterating early the
+    command (and any processes that it started) is killed.
+    """
+    _, timeout, program = _prepare(cmd, None)
+    cassette = _hooks["cassette"]
+
+    if cassette is not None and cassette.replaying:
+        returncode, stdout, stderr, delay = cassette.play(cmd, None)
+        time.sleep(delay)
+        yield from _split([stdout], separator)
+        _result(cmd, returncode, stdout, stderr, False)
+        return
+
+    start = time.monotonic()
+    # The output that's been read so far, if it's being recorded.
+    recorded = []
+    stderr = []
+    timed_out = threading.Event()
+    group = _own_group(timeout)
+
+    with Popen(cmd, stdout=PIPE, stderr=PIPE, start_new_session=group) as process:
+        # Read stderr in another thread so that the command can't get stuck
+        # writing to a full stderr pipe while we're waiting for its stdout.
+        stderr_reader = threading.Thread(
+            target=lambda: stderr.append(_tail(process.stderr, STDERR_LIMIT)),
+            daemon=True,
+        )
+        stderr_reader.start()
+
+        def expire():
+            timed_out.set()
+            _kill(process, group)
+
+        timer = threading.Timer(timeout, expire) if timeout is not None else None
+        if timer:
+            timer.start()
+
+        def read():
+            for chunk in iter(lambda: process.stdout.read1(CHUNK_SIZE), b""):
+                if cassette is not None:
+                    recorded.append(chunk)
+                yield chunk
+
+        try:
+            yield from _split(read(), separator)
+            process.wait()
+            stderr_reader.join()
+        except BaseException:
+            # For example GeneratorExit if the caller stopped iterating.
+            _kill(process, group)
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+            duration = time.monotonic() - start
+            metrics.SUBPROCESS_DURATION.observe(duration, program=program)
+
+    if timed_out.is_set():
+        raise TimedOutError(f"Timed out after {timeout:g}s: {cmd}")
+
+    if cassette is not None:
+        cassette.record(
+            cmd, None, process.returncode, b"".join(recorded), stderr[0], duration
+        )
+
+    _result(cmd, process.returncode, b"", stderr[0], False)
+
+
+async def stream_async(cmd):  # pylint:disable=too-many-locals
+    """Run a command and yield its stdout, as chunks of bytes, as it's produced.
+
+    The asyncio version of stream(cmd, separator=None): it has the same
+    timeouts, keeps only the end of the command's stderr, and raises
+    CalledProcessError after the last chunk if the command fails. If the
+    calling task is cancelled or stops iterating early the command (and any
+    processes that it started) is killed.
+    """
+    _, timeout, program = _prepare(cmd, None)
+    cassette = _hooks["cassette"]
+
+    if cassette is not None and cassette.replaying:
+        returncode, stdout, stderr, delay = cassette.play(cmd, None)
+        await asyncio.sleep(delay)
+        if stdout:
+            yield stdout
+        _result(cmd, returncode, stdout, stderr, False)
+        return
+
+    start = time.monotonic()
+    # The output that's been read so far, if it's being recorded.
+    recorded = []
+    group = _own_group(timeout)
+
+    def remaining():
+        return None if timeout is None else max(start + timeout - time.monotonic(), 0)
+
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=PIPE, stderr=PIPE, start_new_session=group
+    )
+    # Read stderr at the same time so that the command can't get stuck
+    # writing to a full stderr pipe while we're waiting for its stdout.
+    stderr_reader = asyncio.ensure_future(_tail_async(process.stderr, STDERR_LIMIT))
+
+    try:
+        while chunk := await asyncio.wait_for(
+            process.stdout.read(CHUNK_SIZE), remaining()
+        ):
+            if cassette is not None:
+                recorded.append(chunk)
+            yield chunk
+        stderr = await asyncio.wait_for(stderr_reader, remaining())
+        await asyncio.wait_for(process.wait(), remaining())
+    except asyncio.TimeoutError as err:
+        _kill(process, group)
+        await process.wait()
+        raise TimedOutError(f"Timed out after {timeout:g}s: {cmd}") from err
+    except BaseException:
+        # For example asyncio.CancelledError, or GeneratorExit if the caller
+        # stopped iterating: don't leave orphaned processes.
+        _kill(process, group)
+        await process.wait()
+        raise
+    finally:
+        stderr_reader.cancel()
+        duration = time.monotonic() - start
+        metrics.SUBPROCESS_DURATION.observe(duration, program=program)
+
+    if cassette is not None:
+        cassette.record(
+            cmd, None, process.returncode, b"".join(recorded), stderr, duration
+        )
+
+    _result(cmd, process.returncode, b"", stderr, False)
+
+
+def _tail(pipe, limit):
+    """Read `pipe` to the end and return the last `limit` bytes of it."""
+    tail = bytearray()
+
+    for chunk in iter(lambda: pipe.read1(CHUNK_SIZE), b""):
+        tail += chunk
+        del tail[:-limit]
+
+    return bytes(tail)
+
+
+async def _tail_async(reader, limit):
+    """Read `reader` to the end and return the last `limit` bytes of it."""
+    tail = bytearray()
+
+    while chunk := await reader.read(CHUNK_SIZE):
+        tail += chunk
+        del tail[:-limit]
+
+    return bytes(tail)
+
+
+def _split(chunks, separator):
+    """Split `chunks` of output into records, see stream()."""
+    if separator is None:
+        yield from (chunk for chunk in chunks if chunk)
+        return
+
+    partial = b""
+    for chunk in chunks:
+        *records, partial = (partial + chunk).split(separator)
+        yield from _records(records)
+    yield from _records([partial])
+
+
+def _records(records):
+    for record in records:
+        if record:
+            yield record.decode("utf-8")
+
+
+def _prepare(cmd, json_input):
+    """Do the things that run() and run_async() do before starting `cmd`.
+
+    Returns the bytes to write to `cmd`'s stdin (or None), the number of
+    seconds that `cmd` has to run in (or None) and the program's name.
+    """
     if os.environ.get("DEBUG") == "yes":
         print(cmd)
 
-    stdout = subprocess.run(cmd, check=True, capture_output=True).stdout
+    if json_input is not None:
+        stdin = json_.dumps(json_input).encode("utf-8")
+    else:
+        stdin = None
+
+    timeout = _timeout(cmd)
+
+    program = os.path.basename(cmd[0])
+    metrics.SUBPROCESSES.inc(program=program)
+    if program == "gh":
+        metrics.API_REQUESTS.inc(endpoint=metrics.api_endpoint(cmd))
+
+    return stdin, timeout, program
+
+
+def _result(cmd, returncode, stdout, stderr, json):
+    """Return the result of a finished command or raise if it failed."""
+    if returncode:
+        raise CalledProcessError(returncode, cmd, stdout, stderr)
 
     if json:
         return json_.loads(stdout)
 
     return stdout.decode("utf-8").strip()
+
+
+def _timeout(cmd):
+    """Return the number of seconds that `cmd` has left to run in."""
+    timeout, deadline = _limits["timeout"], _limits["deadline"]
+
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+
+        if remaining <= 0:
+            raise TimedOutError(f"Deadline exceeded before running: {cmd}")
+
+        if timeout is None or remaining < timeout:
+            timeout = remaining
+
+    return timeout
+
+
+def _own_group(timeout):
+    """Return whether to start a command that has `timeout` seconds in its own process group.
+
+    A command that might time out is started in a new session (and so a new
+    process group) so that if it's killed any child processes that it has
+    started (for example the ssh processes started by `git push`) can be
+    killed too. Other commands are left in gh-pr-upsert's session: a new
+    session has no controlling terminal, so git and gh couldn't prompt for
+    credentials, ssh passphrases or logging in.
+    """
+    return timeout is not None
+
+
+def _kill(process, group):
+    """Kill `process`, and the other processes in its process group if `group`."""
+    try:
+        if group:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
@@ -0,0 +1,91 @@
+"""Close all of gh-pr-upsert's PRs that aren't needed anymore."""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from gh_pr_upsert import core, git, history
+
+# How many PRs to close with each GraphQL mutation. Each batch is recorded and
+# reported as soon as it's been closed, so if a later batch fails the PRs that
+# were already closed aren't lost track of.
+CLOSE_BATCH_SIZE = 25
+
+
+def sweep(base_repo, head_repo, close_comment):
+    """Close all of gh-pr-upsert's PRs from `head_repo` that have no changes.
+
+    Returns the list of PRs that were closed.
+
+    This finds PRs that gh-pr-upsert created on any branch, not just the
+    current one, and applies the same checks as core.pr_upsert(): a PR is only
+    closed if its head branch has no changes compared to its base branch and
+    doesn't contain commits from anyone other than the current user.
+
+    The same branch locks that core.upsert() takes are held on all the PRs'
+    head branches while they're checked and closed, so an upsert from this
+    clone can't push to a branch while its PR is being closed.
+    """
+    pull_requests = git.PullRequest.get_upserted(base_repo, head_repo)
+
+    if not pull_requests:
+        return []
+
+    closed_pull_requests = []
+
+    with ExitStack() as locks:
+        # Lock the branches in a consistent order (like core.upsert_stack()
+        # does) so that two sweeps can't deadlock each other.
+        for head_branch in sorted({pr.head_branch for pr in pull_requests}):
+            locks.enter_context(git.lock_branch(head_repo.remote, head_branch))
+
+        for batch in batches(
+            find_obsolete(base_repo, head_repo, pull_requests), CLOSE_BATCH_SIZE
+        ):
+            git.PullRequest.close_many(batch, close_comment)
+
+            for pull_request in batch:
+                print(f"Closed PR {pull_request.html_url}")
+
+            closed_pull_requests.extend(batch)
+
+    return closed_pull_requests
+
+
+def find_obsolete(base_repo, head_repo, pull_requests):
+    """Return the PRs in `pull_requests` that have no changes."""
+    # Make sure we have the head commits of all the PRs locally. A PR's
+    # head_sha is used rather than the remote-tracking branch so that the
+    # checks below can't be fooled by a stale remote-tracking branch.
+    git.fetch(*dict.fromkeys([head_repo.remote, base_repo.remote]))
+
+    def is_obsolete(pull_request):
+        # If the branch has moved since the PRs were got (for example an
+        # upsert pushed to it before its lock was taken) leave it for the next
+        # sweep: the PR's head_sha is no longer what's on the branch.
+        remote_branch = f"{head_repo.remote}/{pull_request.head_branch}"
+        if not git.branch_exists(head_repo.remote, pull_request.head_branch) or (
+            git.rev_parse(remote_branch) != [pull_request.head_sha]
+        ):
+            return False
+
+        branches = (
+            pull_request.head_sha,
+            f"^{base_repo.remote}/{pull_request.base_branch}",
+        )
+        return git.diff_is_empty(branches) and not core.get_other_contributors(
+            git.log(history.bound(branches))
+        )
+
+    with ThreadPoolExecutor() as executor:
+        return [
+            pull_request
+            for pull_request, obsolete in zip(
+                pull_requests, executor.map(is_obsolete, pull_requests)
+            )
+            if obsolete
+        ]
+
+
+def batches(items, size):
+    """Return `items` split into lists of at most `size` items."""
+    return [items[start : start + size] for start in range(0, len(items), size)]
@@ -0,0 +1,119 @@
+"""Upsert a PR again each time its local branch changes."""
+
+import os
+import time
+from subprocess import CalledProcessError
+
+from gh_pr_upsert import core, git, run
+from gh_pr_upsert.exceptions import PRUpsertError, TimedOutError
+
+# How often to check whether the branch has changed, in seconds.
+POLL_INTERVAL = 0.2
+
+
+def watch(  # pylint:disable=too-many-arguments
+    base_repo,
+    base_branch,
+    local_branch,
+    head_repo,
+    head_branch,
+    *args,
+    debounce=1.0,
+    **kwargs,
+):
+    """Upsert a PR, then upsert it again each time `local_branch` changes.
+
+    The other arguments are the same as core.upsert()'s. Runs until
+    interrupted.
+
+    Changes are noticed by watching the files that git keeps the branch in
+    (HEAD, the branch's loose ref and packed-refs) rather than by running
+    git. A burst of changes (for example a series of commits) is waited out:
+    the PR isn't upserted until the branch has stopped changing for
+    `debounce` seconds.
+
+    Between upserts the repos, the configured user and (unless something was
+    pushed, created or closed) the PR and whether the remote branch exists
+    are kept in git's caches. Only the lookups that depend on the local
+    branch are redone, and nothing at all is done if the branch's files
+    changed but the branch still points at the same commit.
+
+    An upsert that fails is reported and the branch is watched for its next
+    change, except that once --deadline has passed the TimedOutError is
+    raised: every later upsert would time out too.
+    """
+    paths = git.git_paths("HEAD", f"refs/heads/{local_branch}", "packed-refs")
+    files = stat(paths)
+    upserted_sha = None
+
+    while True:
+        (sha,) = git.rev_parse(local_branch)
+
+        if sha != upserted_sha:
+            git.clear_local_ref_caches()
+            try:
+                core.print_result(
+                    core.upsert(
+                        base_repo,
+                        base_branch,
+                        local_branch,
+                        head_repo,
+                        head_branch,
+                        *args,
+                        **kwargs,
+                    )
+                )
+            except TimedOutError as err:
+                if run.deadline_exceeded():
+                    raise
+                print(err.message)
+            except PRUpsertError as err:
+                print(err.message)
+            except CalledProcessError as err:
+                # For example a rejected push or a network error. Print what
+                # the command said, like cli.handle_errors() does.
+                print(err)
+                if err.stderr:
+                    print(err.stderr.decode("utf-8"))
+            upserted_sha = sha
+
+        files = wait_for_change(paths, files, debounce)
+
+
+def wait_for_change(paths, files, debounce):
+    """Wait until stat(`paths`) differs from `files` and then stops changing.
+
+    Returns the new stat(`paths`).
+    """
+    while (changed_files := stat(paths)) == files:
+        time.sleep(POLL_INTERVAL)
+
+    quiet_until = time.monotonic() + debounce
+
+    while time.monotonic() < quiet_until:
+        time.sleep(POLL_INTERVAL)
+        latest_files = stat(paths)
+        if latest_files != changed_files:
+            changed_files = latest_files
+            quiet_until = time.monotonic() + debounce
+
+    return changed_files
+
+
+def stat(paths):
+    """Return a value that changes whenever any of the files at `paths` do.
+
+    Missing files are allowed: git creates and deletes loose refs and
+    packed-refs as it goes.
+    """
+    files = []
+
+    for path in paths:
+        try:
+            result = os.stat(path)
+        except FileNotFoundError:
+            files.append(None)
+        else:
+            files.append((result.st_ino, result.st_size, result.st_mtime_ns))
+
+    return tuple(files)
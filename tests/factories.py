@@ -27,10 +27,10 @@ class GitHubRepoFactory(factory.Factory):
     remote = "origin"
     owner = factory.Sequence(lambda n: f"user-{n}")
     name = factory.Sequence(lambda n: f"repo-{n}")
+    node_id = factory.Sequence(lambda n: f"R_{n}")
     name_with_owner = factory.LazyAttribute(lambda o: f"{o.owner}/{o.name}")
     default_branch = factory.Faker("random_element", elements=["main", "master"])
     url = factory.LazyAttribute(lambda o: f"https://github.com/{o.owner}/{o.name}")
-    json = None
 
 
 class PullRequestFactory(factory.Factory):
@@ -41,7 +41,9 @@ class PullRequestFactory(factory.Factory):
     head_repo = factory.SubFactory(GitHubRepoFactory)
     head_branch = factory.Faker("word")
     number = factory.Sequence(lambda n: n)
+    node_id = factory.Sequence(lambda n: f"PR_{n}")
+    base_branch = factory.Faker("random_element", elements=["main", "master"])
+    head_sha = factory.Faker("sha1")
     html_url = factory.LazyAttribute(
         lambda o: f"https://github.com/{o.base_repo.owner}/{o.base_repo.name}/pull/{o.number}"
     )
-    json = None
@@ -0,0 +1,924 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+from subprocess import CalledProcessError
+from unittest.mock import AsyncMock, MagicMock, call, sentinel
+
+import pytest
+
+from gh_pr_upsert import aio, git
+from gh_pr_upsert.core import Action, Result
+from gh_pr_upsert.exceptions import (
+    NoChangesError,
+    OtherPeopleError,
+    SameBranchError,
+    TimedOutError,
+)
+from gh_pr_upsert.git import (
+    PR_MARKER,
+    PR_RECORD_JQ,
+    Commit,
+    GitHubRepo,
+    PullRequest,
+    User,
+)
+from gh_pr_upsert.pr_index import PRIndex
+
+
+class TestCache:
+    def test_it(self):
+        calls = []
+
+        @aio.cache
+        async def function(arg):
+            calls.append(arg)
+            return arg
+
+        async def main():
+            return [await function(1), await function(1), await function(2)]
+
+        assert asyncio.run(main()) == [1, 1, 2]
+        assert calls == [1, 2]
+
+        function.cache_clear()
+        asyncio.run(main())
+
+        assert calls == [1, 2, 1, 2]
+
+
+class TestGetNodeIDs:
+    def test_it(self, run_async, git_hub_repo):
+        run_async.return_value = {"data": {"user0": {"id": "USER_ID"}}}
+
+        node_ids = asyncio.run(aio.get_node_ids(git_hub_repo, [], ["user"], []))
+
+        assert run_async.call_args[1]["json_input"]["variables"] == {"user0": "user"}
+        assert node_ids == ({}, {"user": "USER_ID"}, {})
+
+    def test_it_does_nothing_if_theres_nothing_to_look_up(
+        self, run_async, git_hub_repo
+    ):
+        assert asyncio.run(aio.get_node_ids(git_hub_repo, [], [], [])) == ({}, {}, {})
+        run_async.assert_not_called()
+
+
+def test_get_repo(run_async):
+    json = {
+        "id": "R_1",
+        "owner": {"login": "hypothesis"},
+        "name": "gh-pr-upsert",
+        "nameWithOwner": "hypothesis/gh-pr-upsert",
+        "defaultBranchRef": {"name": "main"},
+        "url": "https://github.com/hypothesis/gh-pr-upsert",
+    }
+    run_async.side_effect = ["git@github.com:hypothesis/gh-pr-upsert.git", json]
+
+    repo = asyncio.run(aio.get_repo("origin"))
+
+    assert run_async.call_args_list == [
+        call(["git", "remote", "get-url", "origin"]),
+        call(
+            [
+                "gh",
+                "repo",
+                "view",
+                "--json",
+                "id,owner,name,nameWithOwner,defaultBranchRef,url",
+                "git@github.com:hypothesis/gh-pr-upsert.git",
+            ],
+            json=True,
+        ),
+    ]
+    assert repo == GitHubRepo.from_json("origin", json)
+
+
+class TestGetPullRequest:
+    def test_it(self, run_async, base_repo, head_repo, pr_record):
+        run_async.return_value = f"{pr_record}\n"
+
+        pull_request = asyncio.run(
+            aio.get_pull_request(base_repo, "main", head_repo, "my-branch")
+        )
+
+        assert run_async.call_args[0][0][-8:] == [
+            "-f",
+            "base=main",
+            "-f",
+            f"head={head_repo.owner}:my-branch",
+            "-f",
+            "state=open",
+            "--jq",
+            f".[] | {PR_RECORD_JQ}",
+        ]
+        assert pull_request == PullRequest.from_record(base_repo, head_repo, pr_record)
+
+    def test_it_returns_None_if_theres_no_pr(self, run_async, base_repo, head_repo):
+        run_async.return_value = ""
+
+        assert (
+            asyncio.run(aio.get_pull_request(base_repo, "main", head_repo, "branch"))
+            is None
+        )
+
+    def test_it_looks_in_the_pr_index_first(
+        self, run_async, base_repo, head_repo, pr_index
+    ):
+        pr_index.get.return_value = (True, sentinel.pull_request)
+
+        assert (
+            asyncio.run(aio.get_pull_request(base_repo, "main", head_repo, "branch"))
+            == sentinel.pull_request
+        )
+        pr_index.get.assert_called_once_with(base_repo, "main", head_repo, "branch")
+        run_async.assert_not_called()
+
+    def test_it_asks_GitHub_if_the_pr_index_misses(
+        self, run_async, base_repo, head_repo, pr_index
+    ):
+        pr_index.get.return_value = (False, None)
+        run_async.return_value = ""
+
+        asyncio.run(aio.get_pull_request(base_repo, "main", head_repo, "branch"))
+
+        run_async.assert_called_once()
+
+
+class TestCreatePullRequest:
+    def test_it(self, run_async, base_repo, head_repo, pr_record):
+        run_async.return_value = pr_record
+
+        pull_request = asyncio.run(
+            aio.create_pull_request(
+                base_repo, "main", head_repo, "my-branch", "Title", "Body"
+            )
+        )
+
+        run_async.assert_called_once_with(
+            [
+                "gh",
+                "api",
+                "--header",
+                "X-GitHub-Api-Version:2022-11-28",
+                "--method",
+                "POST",
+                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
+                "--input",
+                "-",
+                "--jq",
+                PR_RECORD_JQ,
+            ],
+            json_input={
+                "base": "main",
+                "head": f"{head_repo.owner}:my-branch",
+                "title": "Title",
+                "body": f"Body\n\n{PR_MARKER}",
+                "draft": False,
+            },
+        )
+        assert pull_request.number == 1
+
+    def test_it_records_the_pr_in_the_pr_index(
+        self, run_async, base_repo, head_repo, pr_record, pr_index
+    ):
+        run_async.return_value = pr_record
+
+        pull_request = asyncio.run(
+            aio.create_pull_request(
+                base_repo, "main", head_repo, "my-branch", "Title", "Body"
+            )
+        )
+
+        pr_index.record.assert_called_once_with(pull_request)
+
+    def test_it_configures_the_pr(self, run_async, base_repo, head_repo, pr_record):
+        run_async.side_effect = [
+            {
+                "data": {
+                    "repository": {"label0": {"id": "LABEL_ID"}},
+                    "user0": {"id": "REVIEWER_ID"},
+                    "user1": {"id": "ASSIGNEE_ID"},
+                    "org0": {"team": {"id": "TEAM_ID"}},
+                }
+            },
+            pr_record,
+            {"data": {}},
+        ]
+
+        asyncio.run(
+            aio.create_pull_request(
+                base_repo,
+                "main",
+                head_repo,
+                "my-branch",
+                "Title",
+                "Body",
+                labels=["label"],
+                reviewers=["reviewer", "org/team"],
+                assignees=["assignee"],
+                auto_merge="SQUASH",
+            )
+        )
+
+        assert run_async.call_args[1]["json_input"]["variables"] == {
+            "pr": "PR_1",
+            "label0": "LABEL_ID",
+            "reviewer0": "REVIEWER_ID",
+            "team0": "TEAM_ID",
+            "assignee0": "ASSIGNEE_ID",
+            "mergeMethod": "SQUASH",
+        }
+
+
+class TestUpdatePullRequest:
+    def test_it(self, run_async, pull_request, pr_record):
+        run_async.return_value = pr_record.replace('"Title"', '"New title"')
+
+        updated = asyncio.run(
+            aio.update_pull_request(pull_request, "New title", "Body")
+        )
+
+        assert run_async.call_args[0][0][6] == (
+            f"/repos/{pull_request.base_repo.owner}/{pull_request.base_repo.name}"
+            f"/pulls/{pull_request.number}"
+        )
+        assert run_async.call_args[1]["json_input"] == {"title": "New title"}
+        assert updated == pull_request
+        assert updated.json["title"] == "New title"
+
+    def test_it_records_the_pr_in_the_pr_index(
+        self, run_async, pull_request, pr_record, pr_index
+    ):
+        run_async.return_value = pr_record.replace('"Title"', '"New title"')
+
+        updated = asyncio.run(
+            aio.update_pull_request(pull_request, "New title", "Body")
+        )
+
+        pr_index.record.assert_called_once_with(updated)
+
+    def test_it_does_nothing_if_nothing_has_changed(self, run_async, pull_request):
+        assert (
+            asyncio.run(aio.update_pull_request(pull_request, "Title", "Body"))
+            is pull_request
+        )
+        run_async.assert_not_called()
+
+
+class TestClosePullRequests:
+    def test_it(self, run_async, pull_request):
+        run_async.return_value = {"data": {}}
+
+        asyncio.run(aio.close_pull_requests([pull_request], "Closing"))
+
+        variables = run_async.call_args[1]["json_input"]["variables"]
+        assert variables["comment"] == "Closing"
+        assert variables["pr0"] == pull_request.node_id
+
+    def test_it_records_the_prs_as_closed_in_the_pr_index(
+        self, run_async, pull_request, pr_index
+    ):
+        run_async.return_value = {
+            "data": {"close0": {"pullRequest": {"updatedAt": "2024-01-02T00:00:00Z"}}}
+        }
+
+        asyncio.run(aio.close_pull_requests([pull_request], "Closing"))
+
+        pr_index.record.assert_called_once_with(
+            pull_request, state="closed", updated_at="2024-01-02T00:00:00Z"
+        )
+
+    def test_it_does_nothing_if_there_are_no_prs(self, run_async):
+        asyncio.run(aio.close_pull_requests([], "Closing"))
+
+        run_async.assert_not_called()
+
+
+class TestBranchExists:
+    def test_it(self, run_async):
+        assert asyncio.run(aio.branch_exists("origin", "my-branch"))
+        run_async.assert_called_once_with(
+            ["git", "show-ref", "refs/remotes/origin/my-branch"]
+        )
+
+    def test_it_returns_False_if_the_branch_doesnt_exist(self, run_async):
+        run_async.side_effect = CalledProcessError(returncode=1, cmd=sentinel.cmd)
+
+        assert not asyncio.run(aio.branch_exists("origin", "my-branch"))
+
+    def test_it_raises_if_git_fails(self, run_async):
+        run_async.side_effect = CalledProcessError(returncode=2, cmd=sentinel.cmd)
+
+        with pytest.raises(CalledProcessError):
+            asyncio.run(aio.branch_exists("origin", "my-branch"))
+
+
+class TestBound:
+    def test_it(self, history, run_async):
+        revs = asyncio.run(aio.bound(sentinel.revs))
+
+        history.split_revs.assert_called_once_with(sentinel.revs)
+        history.claim.assert_called_once_with("/repo/.git")
+        assert run_async.call_args_list[1:] == [
+            call(["git", "merge-base", "--all", "head_1", "local", "base"]),
+            call(["git", "merge-base", "--all", "head_2", "local", "base"]),
+        ]
+        assert revs == ("head_1", "head_2", "^merge_base_1", "^merge_base_2")
+
+    def test_it_does_nothing_if_theres_nothing_to_bound(self, history, run_async):
+        history.split_revs.return_value = None
+
+        assert asyncio.run(aio.bound(sentinel.revs)) == sentinel.revs
+        run_async.assert_not_called()
+
+    def test_it_returns_the_revs_unchanged_if_git_fails(self, outputs):
+        outputs[("git", "merge-base", "--all", "head_2", "local", "base")] = (
+            CalledProcessError(128, "git")
+        )
+
+        assert asyncio.run(aio.bound(sentinel.revs)) == sentinel.revs
+
+    @pytest.mark.parametrize("stale", [True, False])
+    def test_it_maintains_the_clone_the_first_time(
+        self, history, run_async, outputs, stale
+    ):
+        history.claim.return_value = True
+        history.bitmaps_are_stale.return_value = stale
+        # Maintaining the clone is best-effort.
+        outputs[tuple(history.COMMIT_GRAPH_COMMAND)] = TimedOutError("timed out")
+        outputs[tuple(history.BITMAPS_COMMAND)] = CalledProcessError(1, "git")
+
+        revs = asyncio.run(aio.bound(sentinel.revs))
+
+        assert run_async.call_args_list == [
+            call(["git", "rev-parse", "--git-common-dir"]),
+            call(history.COMMIT_GRAPH_COMMAND),
+            call(["git", "rev-parse", "--git-path", "objects/pack"]),
+            *([call(history.BITMAPS_COMMAND)] if stale else []),
+            call(["git", "merge-base", "--all", "head_1", "local", "base"]),
+            call(["git", "merge-base", "--all", "head_2", "local", "base"]),
+        ]
+        history.bitmaps_are_stale.assert_called_once_with("pack_dir")
+        assert revs == ("head_1", "head_2", "^merge_base_1", "^merge_base_2")
+
+    @pytest.fixture(autouse=True)
+    def outputs(self, run_async):
+        outputs = {
+            ("git", "rev-parse", "--git-common-dir"): "/repo/.git",
+            ("git", "rev-parse", "--git-path", "objects/pack"): "pack_dir",
+            ("git", "merge-base", "--all", "head_1", "local", "base"): "merge_base_2",
+            ("git", "merge-base", "--all", "head_2", "local", "base"): (
+                "merge_base_1\nmerge_base_2"
+            ),
+        }
+
+        def run(cmd):
+            output = outputs[tuple(cmd)]
+            if isinstance(output, Exception):
+                raise output
+            return output
+
+        run_async.side_effect = run
+        return outputs
+
+    @pytest.fixture(autouse=True)
+    def history(self, history):
+        history.split_revs.return_value = (["head_1", "head_2"], ["local", "base"])
+        history.claim.return_value = False
+        history.COMMIT_GRAPH_COMMAND = ["git", "commit-graph", "write"]
+        history.BITMAPS_COMMAND = ["git", "multi-pack-index", "write"]
+        return history
+
+
+def test_common_dir(run_async, tmp_path):
+    run_async.return_value = str(tmp_path)
+
+    assert asyncio.run(aio.common_dir()) == str(tmp_path)
+
+
+def test_compare_commits(run_async, base_repo, head_repo):
+    run_async.return_value = "sha1\0A\0a@example.com\0C\0c@example.com\n"
+
+    commits = asyncio.run(
+        aio.compare_commits(base_repo, "main", head_repo, "my-branch")
+    )
+
+    run_async.assert_called_once_with(
+        git.compare_commits_command(base_repo, "main", head_repo, "my-branch")
+    )
+    assert commits == [
+        Commit("sha1", User("A", "a@example.com"), User("C", "c@example.com"))
+    ]
+
+
+def test_configured_user(run_async):
+    run_async.side_effect = ["Name", "name@example.com"]
+
+    assert asyncio.run(aio.configured_user()) == User("Name", "name@example.com")
+
+
+def test_diff(metrics, stream_async):
+    stream_async.side_effect = lambda _cmd: chunks(b"dif", b"f")
+
+    assert asyncio.run(aio.diff(("a", "^b"))) == hashlib.sha256(b"diff").hexdigest()
+    stream_async.assert_called_once_with(["git", "diff", "a", "^b"])
+    metrics.DIFF_BYTES.inc.assert_called_once_with(4)
+
+
+def test_diff_paths(stream_async):
+    stream_async.side_effect = lambda _cmd: chunks()
+
+    assert not asyncio.run(aio.diff(("a", "^b"), ("src",)))
+    stream_async.assert_called_once_with(["git", "diff", "a", "^b", "--", "src"])
+
+
+def test_fetch_branch(run_async):
+    asyncio.run(aio.fetch_branch("origin", "my-branch"))
+
+    run_async.assert_called_once_with(
+        [
+            "git",
+            "fetch",
+            "origin",
+            "+refs/heads/my-branch:refs/remotes/origin/my-branch",
+        ]
+    )
+
+
+def test_log(run_async):
+    run_async.return_value = (
+        "sha1\0A\0a@example.com\0C\0c@example.com\nsha2\0A\0a@\0A\0a@"
+    )
+
+    commits = asyncio.run(aio.log(("a", "^b")))
+
+    run_async.assert_called_once_with(
+        [
+            "git",
+            "log",
+            "--ignore-missing",
+            "a",
+            "^b",
+            "--format=%H%x00%an%x00%ae%x00%cn%x00%ce",
+        ]
+    )
+    assert commits == [
+        Commit("sha1", User("A", "a@example.com"), User("C", "c@example.com")),
+        Commit("sha2", User("A", "a@"), User("A", "a@")),
+    ]
+
+
+def test_log_paths(run_async):
+    run_async.return_value = ""
+
+    asyncio.run(aio.log(("a",), ("src",)))
+
+    assert run_async.call_args[0][0][-2:] == ["--", "src"]
+
+
+class TestLockBranch:
+    def test_it(self, run_async, tmp_path):
+        run_async.return_value = str(tmp_path)
+        lock_path = tmp_path / "gh-pr-upsert" / "locks" / "origin%2Fmy-branch.lock"
+
+        async def main():
+            async with aio.lock_branch("origin", "my-branch"):
+                with open(lock_path, encoding="utf-8") as lock_file:
+                    with pytest.raises(BlockingIOError):
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        asyncio.run(main())
+
+        with open(lock_path, encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_it_waits_for_the_lock_without_blocking(self, run_async, tmp_path):
+        run_async.return_value = str(tmp_path)
+        events = []
+
+        async def hold(name):
+            async with aio.lock_branch("origin", "my-branch"):
+                events.append(f"{name} locked")
+                await asyncio.sleep(0.05)
+                events.append(f"{name} unlocked")
+
+        async def main():
+            await asyncio.gather(hold("first"), hold("second"))
+
+        asyncio.run(main())
+
+        assert events == [
+            "first locked",
+            "first unlocked",
+            "second locked",
+            "second unlocked",
+        ]
+
+    @pytest.fixture(autouse=True)
+    def LOCK_POLL_INTERVAL(self, mocker):
+        mocker.patch("gh_pr_upsert.aio.LOCK_POLL_INTERVAL", 0.01)
+
+
+def test_push(run_async):
+    asyncio.run(aio.push("origin", "local", "remote"))
+
+    run_async.assert_called_once_with(
+        ["git", "push", "--force-with-lease", "origin", "local:remote"]
+    )
+
+
+def test_rev_parse(run_async):
+    run_async.return_value = "sha1\nsha2"
+
+    assert asyncio.run(aio.rev_parse("a", "b")) == ["sha1", "sha2"]
+
+
+def test_rev_list(run_async):
+    run_async.return_value = "sha1\nsha2\n"
+
+    assert asyncio.run(aio.rev_list("a", "^b")) == ["sha1", "sha2"]
+    run_async.assert_called_once_with(["git", "rev-list", "a", "^b"])
+
+
+def test_clear_ref_caches(run_async):
+    asyncio.run(aio.branch_exists("origin", "my-branch"))
+
+    aio.clear_ref_caches()
+    asyncio.run(aio.branch_exists("origin", "my-branch"))
+
+    assert run_async.call_count == 2
+
+
+class TestUpsert:
+    def test_it_creates_a_pr(self, base_repo, head_repo, helpers):
+        helpers.get_pull_request.return_value = None
+        helpers.branch_exists.return_value = False
+
+        result = self.upsert(base_repo, head_repo)
+
+        helpers.lock_branch.assert_called_once_with(
+            head_repo.remote, sentinel.head_branch
+        )
+        helpers.push.assert_called_once_with(
+            head_repo.remote, sentinel.local_branch, sentinel.head_branch
+        )
+        helpers.clear_ref_caches.assert_called_with()
+        helpers.create_pull_request.assert_called_once_with(
+            base_repo,
+            sentinel.base_branch,
+            head_repo,
+            sentinel.head_branch,
+            sentinel.title,
+            sentinel.body,
+            draft=False,
+            labels=(),
+            reviewers=(),
+            assignees=(),
+            auto_merge=None,
+        )
+        assert result == Result(
+            action=Action.CREATED,
+            has_changes=True,
+            pull_request=helpers.create_pull_request.return_value,
+            local_sha="local_sha",
+            base_sha="base_sha",
+            remote_sha=None,
+        )
+
+    def test_it_pushes_to_an_existing_pr(self, base_repo, head_repo, helpers):
+        helpers.diff.side_effect = ["local_diff", "remote_diff"]
+
+        result = self.upsert(base_repo, head_repo, update=True)
+
+        pull_request = helpers.get_pull_request.return_value
+        pull_request.pushed.assert_called_once_with("local_sha")
+        helpers.update_pull_request.assert_called_once_with(
+            pull_request.pushed.return_value, sentinel.title, sentinel.body
+        )
+        assert result.action == Action.PUSHED
+        assert result.remote_sha == "remote_sha"
+        assert result.pull_request == helpers.update_pull_request.return_value
+
+    def test_it_only_updates_the_pr_if_asked_to(self, base_repo, head_repo, helpers):
+        helpers.diff.side_effect = ["local_diff", "remote_diff"]
+
+        result = self.upsert(base_repo, head_repo)
+
+        helpers.update_pull_request.assert_not_called()
+        assert result.action == Action.PUSHED
+        assert (
+            result.pull_request
+            == helpers.get_pull_request.return_value.pushed.return_value
+        )
+
+    def test_it_updates_an_existing_pr(self, base_repo, head_repo, helpers):
+        result = self.upsert(base_repo, head_repo, update=True)
+
+        helpers.push.assert_not_called()
+        assert result.action == Action.UPDATED
+
+    @pytest.mark.parametrize("update", [True, False])
+    def test_if_nothing_has_changed_it_does_nothing(
+        self, base_repo, head_repo, helpers, update
+    ):
+        pull_request = helpers.get_pull_request.return_value
+        pull_request.changed_fields.return_value = {}
+
+        result = self.upsert(base_repo, head_repo, update=update)
+
+        assert result.action == Action.NOOP
+        assert result.pull_request == pull_request
+
+    def test_it_closes_a_pr_with_no_changes(self, base_repo, head_repo, helpers):
+        helpers.diff.return_value = ""
+
+        result = self.upsert(base_repo, head_repo)
+
+        helpers.close_pull_requests.assert_called_once_with(
+            [helpers.get_pull_request.return_value], sentinel.close_comment
+        )
+        assert result.action == Action.CLOSED
+        assert not result.has_changes
+
+    def test_if_there_are_no_changes_and_no_pr_it_does_nothing(
+        self, base_repo, head_repo, helpers
+    ):
+        helpers.diff.return_value = ""
+        helpers.get_pull_request.return_value = None
+
+        assert self.upsert(base_repo, head_repo).action == Action.NOOP
+
+    @pytest.mark.parametrize("diff", ["", "local_diff"])
+    def test_it_refuses_if_there_are_other_contributors(
+        self, base_repo, head_repo, commit_factory, helpers, diff
+    ):
+        helpers.diff.side_effect = [diff, "remote_diff"]
+        helpers.log.return_value = [commit_factory()]
+
+        result = self.upsert(base_repo, head_repo)
+
+        helpers.push.assert_not_called()
+        helpers.close_pull_requests.assert_not_called()
+        assert result.action == Action.REFUSED
+
+    def test_it_gets_the_remote_commits_from_GitHub_if_the_remote_branch_is_stale(
+        self, base_repo, head_repo, commit_factory, helpers
+    ):
+        helpers.get_pull_request.return_value.head_sha = "new_remote_sha"
+        helpers.diff.side_effect = ["local_diff", "remote_diff"]
+        helpers.compare_commits.return_value = [commit_factory()]
+
+        result = self.upsert(base_repo, head_repo)
+
+        helpers.compare_commits.assert_called_once_with(
+            base_repo, sentinel.base_branch, head_repo, sentinel.head_branch
+        )
+        helpers.log.assert_not_called()
+        assert result.action == Action.REFUSED
+
+    def test_if_the_remote_branch_is_stale_and_there_are_paths_it_fetches_it(
+        self, base_repo, head_repo, helpers
+    ):
+        helpers.get_pull_request.return_value.head_sha = "new_remote_sha"
+
+        self.upsert(base_repo, head_repo, paths=sentinel.paths)
+
+        helpers.fetch_branch.assert_called_once_with(
+            head_repo.remote, sentinel.head_branch
+        )
+        helpers.compare_commits.assert_not_called()
+        assert helpers.log.call_args[0][1] == sentinel.paths
+
+    def test_it_bounds_the_walk_of_the_remote_branch(
+        self, base_repo, head_repo, helpers
+    ):
+        helpers.bound.side_effect = lambda revs: ("bounded", *revs[:1])
+
+        self.upsert(base_repo, head_repo)
+
+        helpers.bound.assert_called_once_with(
+            (
+                f"{head_repo.remote}/{sentinel.head_branch}",
+                f"^{sentinel.local_branch}",
+                f"^{base_repo.remote}/{sentinel.base_branch}",
+            )
+        )
+        assert helpers.log.call_args[0][0] == (
+            "bounded",
+            f"{head_repo.remote}/{sentinel.head_branch}",
+        )
+
+    def test_it_limits_the_diffs_and_log_to_paths(self, base_repo, head_repo, helpers):
+        self.upsert(base_repo, head_repo, paths=sentinel.paths)
+
+        assert helpers.log.call_args[0][1] == sentinel.paths
+        assert [call_[0][1] for call_ in helpers.diff.call_args_list] == [
+            sentinel.paths,
+            sentinel.paths,
+        ]
+
+    def test_it_raises_if_the_base_and_head_branch_are_the_same(self, git_hub_repo):
+        with pytest.raises(SameBranchError):
+            asyncio.run(
+                aio.upsert(
+                    git_hub_repo,
+                    "main",
+                    "main",
+                    git_hub_repo,
+                    "main",
+                    "Title",
+                    "Body",
+                    "Closing",
+                )
+            )
+
+    def upsert(self, base_repo, head_repo, **kwargs):
+        return asyncio.run(
+            aio.upsert(
+                base_repo,
+                sentinel.base_branch,
+                sentinel.local_branch,
+                head_repo,
+                sentinel.head_branch,
+                sentinel.title,
+                sentinel.body,
+                sentinel.close_comment,
+                **kwargs,
+            )
+        )
+
+    @pytest.fixture
+    def helpers(self, mocker, user, commit_factory):
+        helpers = MagicMock()
+
+        for name in [
+            "bound",
+            "compare_commits",
+            "log",
+            "rev_list",
+            "configured_user",
+            "diff",
+            "fetch_branch",
+            "get_pull_request",
+            "branch_exists",
+            "rev_parse",
+            "push",
+            "create_pull_request",
+            "update_pull_request",
+            "close_pull_requests",
+        ]:
+            setattr(
+                helpers, name, mocker.patch(f"gh_pr_upsert.aio.{name}", AsyncMock())
+            )
+        helpers.lock_branch = mocker.patch("gh_pr_upsert.aio.lock_branch")
+        helpers.clear_ref_caches = mocker.patch("gh_pr_upsert.aio.clear_ref_caches")
+
+        helpers.configured_user.return_value = user
+        helpers.log.return_value = commit_factory.create_batch(
+            2, author=user, committer=user
+        )
+        helpers.diff.return_value = "diff"
+        helpers.get_pull_request.return_value = mocker.create_autospec(
+            PullRequest, instance=True, head_sha="remote_sha"
+        )
+        helpers.bound.side_effect = lambda revs: revs
+        helpers.rev_parse.side_effect = lambda *revs: [
+            "local_sha",
+            "base_sha",
+            "remote_sha",
+        ][: len(revs)]
+
+        return helpers
+
+
+class TestPRUpsert:
+    def test_it_prints_the_url(self, capsys, upsert, pull_request):
+        upsert.return_value = Result(
+            Action.CREATED, True, pull_request, "local_sha", "base_sha", None
+        )
+
+        asyncio.run(aio.pr_upsert(sentinel.base_repo, update=True))
+
+        upsert.assert_called_once_with(sentinel.base_repo, update=True)
+        assert capsys.readouterr().out.strip() == pull_request.html_url
+
+    @pytest.mark.parametrize(
+        "action,has_changes,exception",
+        [
+            (Action.NOOP, False, NoChangesError),
+            (Action.REFUSED, True, OtherPeopleError),
+        ],
+    )
+    def test_it_raises(self, upsert, action, has_changes, exception):
+        upsert.return_value = Result(
+            action, has_changes, None, "local_sha", "base_sha", None
+        )
+
+        with pytest.raises(exception):
+            asyncio.run(aio.pr_upsert())
+
+    @pytest.fixture
+    def upsert(self, mocker):
+        return mocker.patch("gh_pr_upsert.aio.upsert", AsyncMock())
+
+
+def test_gather_cancels_the_others_if_one_fails():
+    cancelled = []
+
+    async def fail():
+        raise ValueError()
+
+    async def wait():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(ValueError):
+        asyncio.run(aio._gather(wait(), fail()))  # pylint:disable=protected-access
+
+    assert cancelled == [True]
+
+
+@pytest.fixture
+def pr_json(base_repo):
+    return {
+        "number": 1,
+        "node_id": "PR_1",
+        "title": "Title",
+        "body": f"Body\n\n{PR_MARKER}",
+        "base": {"ref": "main"},
+        "head": {"sha": "abc123"},
+        "html_url": f"https://github.com/{base_repo.owner}/{base_repo.name}/pull/1",
+        "updated_at": "2024-01-01T00:00:00Z",
+    }
+
+
+@pytest.fixture
+def pr_record(pr_json):
+    """Return `pr_json` as output by `gh api --jq PR_RECORD_JQ`."""
+    return "\0".join(
+        [
+            str(pr_json["number"]),
+            pr_json["node_id"],
+            pr_json["base"]["ref"],
+            "my-branch",
+            pr_json["head"]["sha"],
+            pr_json["html_url"],
+            pr_json["updated_at"],
+            json.dumps({"title": pr_json["title"], "body": pr_json["body"]}),
+        ]
+    )
+
+
+@pytest.fixture
+def pull_request(base_repo, head_repo, pr_json):
+    return PullRequest.from_json(base_repo, head_repo, "my-branch", pr_json)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    for function in (
+        aio.get_repo,
+        aio.get_pull_request,
+        aio.branch_exists,
+        aio.common_dir,
+        aio.configured_user,
+        aio.diff,
+        aio.log,
+    ):
+        function.cache_clear()
+
+
+@pytest.fixture
+def pr_index(mocker):
+    pr_index = mocker.create_autospec(PRIndex, instance=True, spec_set=True)
+    previous = git.use_pr_index(pr_index)
+    yield pr_index
+    git.use_pr_index(previous)
+
+
+@pytest.fixture
+def history(mocker):
+    return mocker.patch("gh_pr_upsert.aio.history", autospec=True)
+
+
+@pytest.fixture(autouse=True)
+def metrics(mocker):
+    return mocker.patch("gh_pr_upsert.aio.metrics", autospec=True)
+
+
+@pytest.fixture(autouse=True)
+def run_async(mocker):
+    return mocker.patch("gh_pr_upsert.aio.run_async", autospec=True)
+
+
+@pytest.fixture
+def stream_async(mocker):
+    return mocker.patch("gh_pr_upsert.aio.stream_async", autospec=True)
+
+
+async def chunks(*chunks_):
+    for chunk in chunks_:
+        yield chunk
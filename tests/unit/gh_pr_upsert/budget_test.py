@@ -0,0 +1,248 @@
+"""Subprocess and GitHub API call budgets for standard upsert scenarios.
+
+Each scenario runs core.upsert() against a fake `git` and `gh` that count
+the commands they're asked to run. The test fails if a scenario spawns more
+subprocesses or sends more GitHub API requests than its budget allows, so
+a change that adds calls to the hot path has to update the budgets below
+(and justify doing so in review).
+
+Budgets have a fixed part and a part that's multiplied by the number of
+commits on the remote branch, so that a change that adds a call per commit
+(which is the kind of call that gets expensive) has to raise the latter from
+zero.
+"""
+
+import json
+from dataclasses import dataclass
+from subprocess import CalledProcessError
+
+import pytest
+
+from gh_pr_upsert import core, git, history, pr_index
+from gh_pr_upsert.core import Action
+
+
+@dataclass(frozen=True)
+class Budget:
+    # The maximum number of subprocesses (git and gh) regardless of commits.
+    subprocesses: int
+    # The maximum number of extra subprocesses per commit on the remote branch.
+    subprocesses_per_commit: int
+    # The maximum number of GitHub API requests (gh commands).
+    api_requests: int
+
+
+BUDGETS = {
+    "new PR": Budget(subprocesses=10, subprocesses_per_commit=0, api_requests=2),
+    "unchanged PR": Budget(subprocesses=9, subprocesses_per_commit=0, api_requests=1),
+    "changed PR": Budget(subprocesses=10, subprocesses_per_commit=0, api_requests=1),
+    "no changes close": Budget(
+        subprocesses=9, subprocesses_per_commit=0, api_requests=2
+    ),
+    "other contributor refusal": Budget(
+        subprocesses=9, subprocesses_per_commit=0, api_requests=1
+    ),
+    "unfetched PR": Budget(subprocesses=10, subprocesses_per_commit=0, api_requests=2),
+    "indexed PR": Budget(subprocesses=9, subprocesses_per_commit=0, api_requests=0),
+    # Writing the commit-graph and finding the merge bases cost three more
+    # subprocesses than "changed PR", but only once per clone.
+    "bounded walk": Budget(subprocesses=13, subprocesses_per_commit=0, api_requests=1),
+}
+
+
+class FakeRepo:
+    """A fake `run()` that answers git and gh commands and records them."""
+
+    def __init__(self, tmp_path, commits, options):
+        self.tmp_path = tmp_path
+        self.commits = commits
+        self.author = options.get("author", "Me")
+        self.local_diff = options.get("local_diff", "diff")
+        # None means that the remote branch doesn't exist.
+        self.remote_diff = options["remote_diff"]
+        self.pr = self.pr_record() if options["pr"] else None
+        self.calls = []
+
+    def __call__(self, cmd, json=False, json_input=None):
+        del json, json_input
+        self.calls.append(cmd)
+
+        if cmd[0] == "gh":
+            return self.gh(cmd)
+
+        return getattr(self, f"git_{cmd[1].replace('-', '_')}")(cmd)
+
+    def stream(self, cmd, separator=b"\n"):
+        """Answer a streamed command the same way as `run()` would."""
+        output = self(cmd)
+        if separator is None:
+            yield from [output.encode("utf-8")] if output else []
+        else:
+            yield from (record for record in output.split(separator.decode()) if record)
+
+    def gh(self, cmd):
+        if cmd[2] == "graphql":
+            return {"data": {}}
+        if "/compare/" in cmd[-3]:
+            return "\n".join(
+                f"commit_{i}\0Me\0me@example.com\0Me\0me@example.com"
+                for i in range(self.commits)
+            )
+        if "POST" in cmd:
+            return self.pr_record()
+        return self.pr or ""
+
+    def git_rev_parse(self, cmd):
+        if cmd[2] in ("--git-common-dir", "--git-path"):
+            return str(self.tmp_path)
+        return "\n".join(f"{rev}_sha" for rev in cmd[2:])
+
+    def git_config(self, cmd):
+        return {"user.name": "Me", "user.email": "me@example.com"}[cmd[-1]]
+
+    def git_log(self, _cmd):
+        return "\n".join(
+            f"commit_{i}\0{self.author}\0{self.author.lower()}@example.com"
+            "\0Me\0me@example.com"
+            for i in range(self.commits)
+        )
+
+    def git_show_ref(self, cmd):
+        if self.remote_diff is None:
+            raise CalledProcessError(1, cmd)
+        return ""
+
+    def git_diff(self, cmd):
+        return self.local_diff if cmd[2] == "local" else self.remote_diff
+
+    def git_rev_list(self, _cmd):
+        return ""
+
+    def git_commit_graph(self, _cmd):
+        return ""
+
+    def git_merge_base(self, _cmd):
+        return "merge_base_sha"
+
+    def git_push(self, _cmd):
+        return ""
+
+    @staticmethod
+    def pr_record():
+        return "\0".join(
+            [
+                "1",
+                "PR_1",
+                "main",
+                "my-branch",
+                "origin/my-branch_sha",
+                "https://github.com/owner/repo/pull/1",
+                "2024-01-01T00:00:00Z",
+                json.dumps({"title": "Title", "body": f"Body\n\n{git.PR_MARKER}"}),
+            ]
+        )
+
+    @property
+    def subprocesses(self):
+        return len(self.calls)
+
+    @property
+    def api_requests(self):
+        return len([cmd for cmd in self.calls if cmd[0] == "gh"])
+
+
+SCENARIOS = {
+    # There's no remote branch and no PR yet.
+    "new PR": {"remote_diff": None, "pr": False, "action": Action.CREATED},
+    # The remote branch already has the same changes as the local branch.
+    "unchanged PR": {"remote_diff": "diff", "pr": True, "action": Action.NOOP},
+    # The local branch has changes that the remote branch doesn't.
+    "changed PR": {"remote_diff": "old", "pr": True, "action": Action.PUSHED},
+    # The local branch has no changes anymore so the PR gets closed.
+    "no changes close": {
+        "local_diff": "",
+        "remote_diff": "diff",
+        "pr": True,
+        "action": Action.CLOSED,
+    },
+    # There's a PR but its branch hasn't been fetched (as in a CI clone), so
+    # its commits are got from GitHub rather than from git.
+    "unfetched PR": {"remote_diff": None, "pr": True, "action": Action.PUSHED},
+    # The same as "changed PR" but the PR is found in a --pr-index rather
+    # than by asking GitHub.
+    "indexed PR": {
+        "remote_diff": "old",
+        "pr": True,
+        "indexed": True,
+        "action": Action.PUSHED,
+    },
+    # The same as "changed PR" but with --history-indexes.
+    "bounded walk": {
+        "remote_diff": "old",
+        "pr": True,
+        "history_indexes": True,
+        "action": Action.PUSHED,
+    },
+    # Someone else has pushed to the remote branch so we leave it alone.
+    "other contributor refusal": {
+        "author": "Someone Else",
+        "remote_diff": "old",
+        "pr": True,
+        "action": Action.REFUSED,
+    },
+}
+
+
+@pytest.mark.parametrize(
+    "scenario,commits",
+    [
+        (scenario, commits)
+        for scenario, options in SCENARIOS.items()
+        # There can't be any commits on a remote branch that doesn't exist.
+        for commits in (
+            [0] if options["remote_diff"] is None and not options["pr"] else [1, 10]
+        )
+    ],
+)
+def test_call_budget(
+    tmp_path, mocker, request, git_hub_repo_factory, scenario, commits
+):  # pylint:disable=too-many-positional-arguments
+    options = SCENARIOS[scenario]
+    fake = FakeRepo(tmp_path, commits, options)
+    mocker.patch("gh_pr_upsert.git.run", fake)
+    mocker.patch("gh_pr_upsert.git.stream", fake.stream)
+    mocker.patch("gh_pr_upsert.github.run", fake)
+    mocker.patch("gh_pr_upsert.github.stream", fake.stream)
+    base_repo = git_hub_repo_factory(remote="upstream")
+    head_repo = git_hub_repo_factory(remote="origin")
+    if options.get("indexed"):
+        index = pr_index.PRIndex(str(tmp_path / "index.db"))
+        index.record(git.PullRequest.from_record(base_repo, head_repo, fake.pr))
+        git.use_pr_index(index)
+        request.addfinalizer(lambda: git.use_pr_index(None))
+    if options.get("history_indexes"):
+        mocker.patch("gh_pr_upsert.history.run", fake)
+        mocker.patch.object(history, "_maintained", set())
+        history.use_history_indexes(True)
+        request.addfinalizer(lambda: history.use_history_indexes(False))
+
+    result = core.upsert(
+        base_repo, "main", "local", head_repo, "my-branch", "Title", "Body", "Closing"
+    )
+
+    assert result.action == options["action"]
+    budget = BUDGETS[scenario]
+    calls = "\n".join(" ".join(cmd) for cmd in fake.calls)
+    assert (
+        fake.subprocesses
+        <= budget.subprocesses + budget.subprocesses_per_commit * commits
+    ), f"{scenario!r} spawned too many subprocesses:\n{calls}"
+    assert (
+        fake.api_requests <= budget.api_requests
+    ), f"{scenario!r} sent too many GitHub API requests:\n{calls}"
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    for function in git.cached_functions():
+        function.cache_clear()
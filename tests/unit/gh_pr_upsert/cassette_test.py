@@ -0,0 +1,173 @@
+import json
+import os
+from subprocess import CalledProcessError
+from unittest.mock import sentinel
+
+import pytest
+
+from gh_pr_upsert import cassette, run
+from gh_pr_upsert.cassette import Interaction, Player, Recorder
+from gh_pr_upsert.exceptions import CassetteError
+
+
+class TestRecorder:
+    def test_it(self, tmp_path):
+        path = tmp_path / "test.cassette"
+        recorder = Recorder(path)
+
+        recorder.record(["git", "status"], None, 0, b"output\n", b"", 0.5)
+        recorder.record(["gh", "api"], b'{"foo": 1}', 1, b"", b"\xff", 1.5)
+
+        assert [json.loads(line) for line in path.read_text().splitlines()] == [
+            {
+                "cmd": ["git", "status"],
+                "stdin": None,
+                "returncode": 0,
+                "stdout": "output\n",
+                "stderr": "",
+                "duration": 0.5,
+            },
+            {
+                "cmd": ["gh", "api"],
+                "stdin": '{"foo": 1}',
+                "returncode": 1,
+                "stdout": "",
+                "stderr": "\udcff",
+                "duration": 1.5,
+            },
+        ]
+
+    def test_it_truncates_existing_cassettes(self, tmp_path):
+        path = tmp_path / "test.cassette"
+        path.write_text("old contents\n")
+
+        Recorder(path)
+
+        assert not path.read_text()
+
+
+class TestPlayer:
+    def test_it(self, tmp_path, make_cassette):
+        player = Player(
+            make_cassette(
+                Interaction(["git", "status"], None, 0, "one", "", 0.5),
+                Interaction(["git", "status"], None, 1, "two", "\udcff", 0.5),
+            ),
+            tmp_path,
+        )
+
+        assert player.play(["git", "status"], None) == (0, b"one", b"", 0)
+        assert player.play(["git", "status"], None) == (1, b"two", b"\xff", 0)
+
+    def test_it_matches_stdin(self, tmp_path, make_cassette):
+        player = Player(
+            make_cassette(
+                Interaction(["gh", "api"], "a", 0, "a", "", 0.5),
+                Interaction(["gh", "api"], "b", 0, "b", "", 0.5),
+            ),
+            tmp_path,
+        )
+
+        assert player.play(["gh", "api"], b"b")[1] == b"b"
+        assert player.play(["gh", "api"], b"a")[1] == b"a"
+
+    def test_it_simulates_timing(self, tmp_path, make_cassette):
+        player = Player(
+            make_cassette(Interaction(["git", "status"], None, 0, "", "", 0.5)),
+            tmp_path,
+            simulate_timing=True,
+        )
+
+        assert player.play(["git", "status"], None)[3] == 0.5
+
+    def test_it_replaces_the_git_dir(self, make_cassette):
+        player = Player(
+            make_cassette(
+                Interaction(
+                    ["git", "rev-parse", "--git-common-dir"],
+                    None,
+                    0,
+                    "/recording/machine/.git",
+                    "",
+                    0.5,
+                )
+            ),
+            "/scratch",
+        )
+
+        assert player.play(["git", "rev-parse", "--git-common-dir"], None)[1] == (
+            b"/scratch"
+        )
+
+    def test_it_raises_if_a_command_wasnt_recorded(self, tmp_path, make_cassette):
+        player = Player(
+            make_cassette(Interaction(["git", "status"], None, 0, "", "", 0.5)),
+            tmp_path,
+        )
+        player.play(["git", "status"], None)
+
+        with pytest.raises(CassetteError) as exc_info:
+            player.play(["git", "status"], None)
+
+        assert exc_info.value.message == (
+            "No recorded interaction for: ['git', 'status']"
+        )
+
+    @pytest.fixture
+    def make_cassette(self, tmp_path):
+        def make_cassette(*interactions):
+            path = tmp_path / "test.cassette"
+            path.write_text(
+                "".join(
+                    json.dumps(interaction.__dict__) + "\n"
+                    for interaction in interactions
+                )
+                + "\n"
+            )
+            return path
+
+        return make_cassette
+
+
+def test_record_and_replay(tmp_path):
+    path = tmp_path / "test.cassette"
+
+    with cassette.record(path):
+        output = run.run(["echo", "hello"])
+        with pytest.raises(CalledProcessError):
+            run.run(["false"])
+
+    with cassette.replay(path):
+        # Replaying doesn't run the commands.
+        assert run.run(["echo", "hello"]) == output
+        with pytest.raises(CalledProcessError):
+            run.run(["false"])
+
+    # The cassette is removed at the end of the context.
+    assert run.use_cassette(None) is None
+
+
+def test_replay_uses_a_scratch_git_dir(tmp_path):
+    path = tmp_path / "test.cassette"
+    Recorder(path).record(
+        ["git", "rev-parse", "--git-common-dir"], None, 0, b"/nonexistent", b"", 1
+    )
+
+    with cassette.replay(path):
+        git_dir = run.run(["git", "rev-parse", "--git-common-dir"])
+        assert os.path.isdir(git_dir)
+
+    assert not os.path.exists(git_dir)
+
+
+def test_replay_restores_the_previous_cassette(tmp_path):
+    path = tmp_path / "test.cassette"
+    path.write_text("")
+    run.use_cassette(sentinel.previous)
+
+    try:
+        with cassette.replay(path):
+            pass
+        assert run.use_cassette(None) == sentinel.previous
+    finally:
+        run.use_cassette(None)
@@ -1,9 +1,12 @@
+import io
+import json
 from importlib.metadata import version
 from subprocess import CalledProcessError
 from unittest.mock import call, sentinel
 
 import pytest
 
+import gh_pr_upsert.manifest
 from gh_pr_upsert.cli import cli
 from gh_pr_upsert.exceptions import NoChangesError
 
@@ -37,6 +40,13 @@ def test_defaults(core, base_repo, head_repo, git):
         "Automated changes by gh-pr-upsert",
         "Automated changes by [gh-pr-upsert](https://github.com/hypothesis/gh-pr-upsert).",
         "It looks like this PR isn't needed anymore, closing it.",
+        draft=False,
+        labels=[],
+        reviewers=[],
+        assignees=[],
+        auto_merge=None,
+        update=False,
+        paths=(),
     )
 
 
@@ -59,6 +69,24 @@ def test_options(core, base_repo, head_repo, git):
             "my_body",
             "--close-comment",
             "my_close_comment",
+            "--draft",
+            "--label",
+            "label_1",
+            "--label",
+            "label_2",
+            "--reviewer",
+            "reviewer",
+            "--reviewer",
+            "org/team",
+            "--assignee",
+            "assignee",
+            "--auto-merge",
+            "squash",
+            "--update",
+            "--path",
+            "src",
+            "--path",
+            "docs",
         ]
     )
 
@@ -75,9 +103,560 @@ def test_options(core, base_repo, head_repo, git):
         "my_title",
         "my_body",
         "my_close_comment",
+        draft=True,
+        labels=["label_1", "label_2"],
+        reviewers=["reviewer", "org/team"],
+        assignees=["assignee"],
+        auto_merge="SQUASH",
+        update=True,
+        paths=("src", "docs"),
     )
 
 
+def test_body_file(core, tmp_path):
+    body_file = tmp_path / "body.md"
+    body_file.write_text("my_body_from_a_file", encoding="utf-8")
+
+    cli(["--body", "my_body", "--body-file", str(body_file)])
+
+    assert core.pr_upsert.call_args[0][6] == "my_body_from_a_file"
+
+
+def test_body_file_from_stdin(core, monkeypatch):
+    monkeypatch.setattr("sys.stdin", io.StringIO("my_body_from_stdin"))
+
+    cli(["--body-file", "-"])
+
+    assert core.pr_upsert.call_args[0][6] == "my_body_from_stdin"
+
+
+def test_body_template(core, base_repo, git):
+    git.diffstat.return_value.template_fields.return_value = {
+        "files": 2,
+        "insertions": 3,
+        "deletions": 4,
+        "binary_files": 0,
+        "top_directories": "- `src`: 7 lines changed",
+    }
+
+    cli(
+        [
+            "--local-branch",
+            "my_branch",
+            "--body",
+            "Intro",
+            "--path",
+            "src",
+            "--body-template",
+            "{body}: {files} files, +{insertions} -{deletions}\n{top_directories}",
+        ]
+    )
+
+    git.diffstat.assert_called_once_with(
+        ("my_branch", f"^origin/{base_repo.default_branch}"), ("src",)
+    )
+    assert (
+        core.pr_upsert.call_args[0][6]
+        == "Intro: 2 files, +3 -4\n- `src`: 7 lines changed"
+    )
+
+
+@pytest.mark.parametrize(
+    "template,message",
+    [
+        ("{unknown} {files}", "unknown fields: 'unknown'"),
+        ("{}", "unknown fields: ''"),
+        ("{files", "expected '}' before end of string"),
+    ],
+)
+def test_invalid_body_template(capsys, core, template, message):
+    with pytest.raises(SystemExit):
+        cli(["--body-template", template])
+
+    assert message in capsys.readouterr().err
+    core.pr_upsert.assert_not_called()
+
+
+def test_sweep(core, sweeper, base_repo, head_repo, git):
+    cli(["sweep"])
+
+    assert git.GitHubRepo.get.call_args_list == [call("origin"), call("origin")]
+    sweeper.sweep.assert_called_once_with(
+        base_repo,
+        head_repo,
+        "It looks like this PR isn't needed anymore, closing it.",
+    )
+    core.pr_upsert.assert_not_called()
+
+
+@pytest.mark.parametrize("before_the_command", [False, True])
+def test_sweep_options(sweeper, base_repo, head_repo, git, before_the_command):
+    options = [
+        "--base-remote",
+        "my_base_remote",
+        "--head-remote",
+        "my_head_remote",
+        "--close-comment",
+        "my_close_comment",
+    ]
+
+    cli([*options, "sweep"] if before_the_command else ["sweep", *options])
+
+    assert git.GitHubRepo.get.call_args_list == [
+        call("my_base_remote"),
+        call("my_head_remote"),
+    ]
+    sweeper.sweep.assert_called_once_with(base_repo, head_repo, "my_close_comment")
+
+
+def test_sweep_CalledProcessError(sweeper):
+    error = sweeper.sweep.side_effect = CalledProcessError(23, sentinel.cmd)
+
+    with pytest.raises(CalledProcessError) as exc_info:
+        cli(["sweep"])
+
+    assert exc_info.value == error
+
+
+def test_stack(core, base_repo, git):
+    cli(["stack", "branch_1", "branch_2"])
+
+    git.GitHubRepo.get.assert_called_once_with("origin")
+    core.pr_upsert_stack.assert_called_once_with(
+        base_repo,
+        base_repo.default_branch,
+        ["branch_1", "branch_2"],
+        "Automated changes by gh-pr-upsert",
+        "Automated changes by [gh-pr-upsert](https://github.com/hypothesis/gh-pr-upsert).",
+        "It looks like this PR isn't needed anymore, closing it.",
+        draft=False,
+        labels=[],
+        reviewers=[],
+        assignees=[],
+        auto_merge=None,
+        update=False,
+        paths=(),
+    )
+    core.pr_upsert.assert_not_called()
+
+
+def test_stack_options(core, base_repo, git):
+    cli(
+        [
+            "--base-remote",
+            "my_remote",
+            "--head-remote",
+            "my_remote",
+            "--base-branch",
+            "my_base_branch",
+            "--title",
+            "my_title",
+            "--body",
+            "my_body",
+            "--close-comment",
+            "my_close_comment",
+            "--draft",
+            "--label",
+            "label",
+            "--reviewer",
+            "reviewer",
+            "--assignee",
+            "assignee",
+            "--auto-merge",
+            "rebase",
+            "--update",
+            "--path",
+            "src",
+            "stack",
+            "branch_1",
+        ]
+    )
+
+    git.GitHubRepo.get.assert_called_once_with("my_remote")
+    core.pr_upsert_stack.assert_called_once_with(
+        base_repo,
+        "my_base_branch",
+        ["branch_1"],
+        "my_title",
+        "my_body",
+        "my_close_comment",
+        draft=True,
+        labels=["label"],
+        reviewers=["reviewer"],
+        assignees=["assignee"],
+        auto_merge="REBASE",
+        update=True,
+        paths=("src",),
+    )
+
+
+def test_stack_body_file(core, tmp_path):
+    body_file = tmp_path / "body.md"
+    body_file.write_text("my_body_from_a_file", encoding="utf-8")
+
+    cli(["--body-file", str(body_file), "stack", "branch_1"])
+
+    assert core.pr_upsert_stack.call_args[0][4] == "my_body_from_a_file"
+
+
+def test_stack_doesnt_support_body_templates(core):
+    with pytest.raises(SystemExit):
+        cli(["--body-template", "{files}", "stack", "branch_1"])
+
+    core.pr_upsert_stack.assert_not_called()
+
+
+def test_stack_doesnt_support_a_different_head_remote(core):
+    with pytest.raises(SystemExit) as exc_info:
+        cli(["--head-remote", "fork", "stack", "branch_1"])
+
+    assert exc_info.value.code == 2
+    core.pr_upsert_stack.assert_not_called()
+
+
+def test_watch(core, base_repo, head_repo, watcher):
+    cli(["--local-branch", "my_branch", "watch", "--debounce", "2.5"])
+
+    watcher.watch.assert_called_once_with(
+        base_repo,
+        base_repo.default_branch,
+        "my_branch",
+        head_repo,
+        "my_branch",
+        "Automated changes by gh-pr-upsert",
+        "Automated changes by [gh-pr-upsert](https://github.com/hypothesis/gh-pr-upsert).",
+        "It looks like this PR isn't needed anymore, closing it.",
+        debounce=2.5,
+        draft=False,
+        labels=[],
+        reviewers=[],
+        assignees=[],
+        auto_merge=None,
+        update=False,
+        paths=(),
+    )
+    core.pr_upsert.assert_not_called()
+
+
+def test_plan(capsys, core, base_repo, head_repo, git):
+    core.plan.return_value.to_dict.return_value = {"action": "pushed"}
+
+    cli(["--plan"])
+
+    core.plan.assert_called_once_with(
+        base_repo,
+        base_repo.default_branch,
+        git.current_branch.return_value,
+        head_repo,
+        git.current_branch.return_value,
+        "Automated changes by gh-pr-upsert",
+        "Automated changes by [gh-pr-upsert](https://github.com/hypothesis/gh-pr-upsert).",
+        "It looks like this PR isn't needed anymore, closing it.",
+        draft=False,
+        labels=[],
+        reviewers=[],
+        assignees=[],
+        auto_merge=None,
+        update=False,
+        paths=(),
+    )
+    assert json.loads(capsys.readouterr().out) == {"action": "pushed"}
+    core.pr_upsert.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["sweep"],
+        ["stack", "a", "b"],
+        ["watch"],
+        ["--pr-index", "index.db", "pr-index", "sync", "owner/repo"],
+    ],
+)
+def test_plan_is_only_supported_by_upsert_and_batch(
+    core, sweeper, watcher, pr_index, argv
+):
+    with pytest.raises(SystemExit) as exc_info:
+        cli(["--plan", *argv])
+
+    assert exc_info.value.code == 2
+    sweeper.sweep.assert_not_called()
+    core.pr_upsert_stack.assert_not_called()
+    watcher.watch.assert_not_called()
+    pr_index.PRIndex.return_value.sync.assert_not_called()
+
+
+def test_watch_exits_when_interrupted(watcher):
+    watcher.watch.side_effect = KeyboardInterrupt
+
+    cli(["watch"])
+
+
+def test_watch_doesnt_support_body_templates(watcher):
+    with pytest.raises(SystemExit):
+        cli(["--body-template", "{files}", "watch"])
+
+    watcher.watch.assert_not_called()
+
+
+def test_batch(manifest):
+    cli(
+        [
+            "--base-branch",
+            "develop",
+            "--label",
+            "bot",
+            "batch",
+            "manifest.jsonl",
+            "--shard",
+            "2/4",
+            "--summary-file",
+            "summary.jsonl",
+            "--journal",
+            "journal.jsonl",
+        ]
+    )
+
+    manifest.read.assert_called_once_with(
+        "manifest.jsonl",
+        defaults={
+            "base_remote": "origin",
+            "base_branch": "develop",
+            "head_remote": "origin",
+            "title": "Automated changes by gh-pr-upsert",
+            "body": "Automated changes by [gh-pr-upsert](https://github.com/hypothesis/gh-pr-upsert).",
+            "close_comment": "It looks like this PR isn't needed anymore, closing it.",
+            "update": False,
+            "draft": False,
+            "labels": ["bot"],
+            "reviewers": [],
+            "assignees": [],
+            "paths": [],
+        },
+    )
+    manifest.upsert_all.assert_called_once_with(
+        manifest.read.return_value, (2, 4), "summary.jsonl", "journal.jsonl"
+    )
+
+
+def test_batch_defaults_to_the_whole_manifest(manifest):
+    cli(["batch", "manifest.jsonl"])
+
+    manifest.upsert_all.assert_called_once_with(
+        manifest.read.return_value, (1, 1), None, None
+    )
+
+
+def test_batch_plan(manifest):
+    cli(["--plan", "batch", "manifest.jsonl", "--shard", "2/4"])
+
+    manifest.plan_all.assert_called_once_with(manifest.read.return_value, (2, 4))
+    manifest.upsert_all.assert_not_called()
+
+
+@pytest.mark.parametrize("shard", ["2", "0/4", "5/4", "a/b", "1/0"])
+def test_batch_rejects_invalid_shards(manifest, shard):
+    with pytest.raises(SystemExit) as exc_info:
+        cli(["batch", "manifest.jsonl", "--shard", shard])
+
+    assert exc_info.value.code == 2
+    manifest.upsert_all.assert_not_called()
+
+
+def test_batch_doesnt_support_body_templates(manifest):
+    with pytest.raises(SystemExit):
+        cli(["--body-template", "{files}", "batch", "manifest.jsonl"])
+
+    manifest.upsert_all.assert_not_called()
+
+
+def test_timeouts(set_timeouts):
+    cli(["--timeout", "30", "--deadline", "600"])
+
+    set_timeouts.assert_called_once_with(30, 600)
+
+
+def test_timeouts_default_to_no_limit(set_timeouts):
+    cli([])
+
+    set_timeouts.assert_called_once_with(None, None)
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["--timeout", "30", "--deadline", "600", "sweep"],
+        ["sweep", "--timeout", "30", "--deadline", "600"],
+    ],
+)
+def test_sweep_timeouts(set_timeouts, argv):
+    cli(argv)
+
+    set_timeouts.assert_called_once_with(30, 600)
+
+
+def test_metrics_file(git, metrics):
+    cli(["--metrics-file", "metrics.prom"])
+
+    metrics.record_cache_info.assert_called_once_with(git.cached_functions.return_value)
+    metrics.write_textfile.assert_called_once_with("metrics.prom")
+    metrics.push.assert_not_called()
+
+
+def test_metrics_pushgateway(git, metrics):
+    cli(["--metrics-pushgateway", "http://pushgateway:9091"])
+
+    metrics.record_cache_info.assert_called_once_with(git.cached_functions.return_value)
+    metrics.write_textfile.assert_not_called()
+    metrics.push.assert_called_once_with("http://pushgateway:9091")
+
+
+def test_it_exports_metrics_even_if_the_upsert_fails(core, metrics):
+    core.pr_upsert.side_effect = NoChangesError()
+
+    with pytest.raises(SystemExit):
+        cli(["--metrics-file", "metrics.prom"])
+
+    metrics.write_textfile.assert_called_once_with("metrics.prom")
+
+
+def test_it_doesnt_export_metrics_by_default(metrics):
+    cli([])
+
+    metrics.record_cache_info.assert_not_called()
+    metrics.write_textfile.assert_not_called()
+    metrics.push.assert_not_called()
+
+
+def test_record_cassette(cassette, core):
+    cli(["--record-cassette", "run.cassette"])
+
+    cassette.record.assert_called_once_with("run.cassette")
+    cassette.replay.assert_not_called()
+    core.pr_upsert.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "argv,simulate_timing",
+    [
+        (["--replay-cassette", "run.cassette"], None),
+        (["--replay-cassette", "run.cassette", "--simulate-timing"], True),
+    ],
+)
+def test_replay_cassette(cassette, argv, simulate_timing):
+    cli(argv)
+
+    cassette.replay.assert_called_once_with("run.cassette", simulate_timing)
+    cassette.record.assert_not_called()
+
+
+def test_it_doesnt_use_a_cassette_by_default(cassette):
+    cli([])
+
+    cassette.record.assert_not_called()
+    cassette.replay.assert_not_called()
+
+
+def test_history_indexes(history):
+    cli(["--history-indexes"])
+
+    history.use_history_indexes.assert_called_once_with(True)
+
+
+def test_it_doesnt_use_history_indexes_by_default(history):
+    cli([])
+
+    history.use_history_indexes.assert_not_called()
+
+
+def test_pr_index(git, pr_index):
+    git.use_pr_index.return_value = sentinel.previous_index
+
+    cli(["--pr-index", "index.db", "--pr-index-max-age", "60"])
+
+    pr_index.PRIndex.assert_called_once_with("index.db", 60.0)
+    assert git.use_pr_index.call_args_list == [
+        call(pr_index.PRIndex.return_value),
+        call(sentinel.previous_index),
+    ]
+
+
+def test_pr_index_max_age_defaults_to_the_indexs_default(pr_index):
+    cli(["--pr-index", "index.db"])
+
+    pr_index.PRIndex.assert_called_once_with("index.db")
+
+
+def test_it_doesnt_use_a_pr_index_by_default(git, pr_index):
+    cli([])
+
+    pr_index.PRIndex.assert_not_called()
+    git.use_pr_index.assert_not_called()
+
+
+def test_pr_index_serve(capsys, monkeypatch, pr_index):
+    monkeypatch.setenv("GH_PR_UPSERT_WEBHOOK_SECRET", "secret")
+    server = pr_index.WebhookServer.return_value
+    server.server_port = 8080
+    server.serve_forever.side_effect = KeyboardInterrupt
+
+    cli(["--pr-index", "index.db", "pr-index", "serve", "--record", "hooks.jsonl"])
+
+    pr_index.WebhookServer.assert_called_once_with(
+        ("127.0.0.1", 8000), pr_index.PRIndex.return_value, "secret", "hooks.jsonl"
+    )
+    server.serve_forever.assert_called_once_with()
+    server.server_close.assert_called_once_with()
+    assert (
+        capsys.readouterr().out == "Listening for webhooks on http://127.0.0.1:8080/\n"
+    )
+
+
+def test_pr_index_serve_needs_a_secret(monkeypatch, pr_index):
+    monkeypatch.delenv("GH_PR_UPSERT_WEBHOOK_SECRET", raising=False)
+
+    with pytest.raises(SystemExit):
+        cli(["--pr-index", "index.db", "pr-index", "serve"])
+
+    pr_index.WebhookServer.assert_not_called()
+
+
+def test_pr_index_replay(capsys, pr_index):
+    pr_index.replay.side_effect = [3, 0]
+
+    cli(["--pr-index", "index.db", "pr-index", "replay", "a.jsonl", "b.jsonl"])
+
+    assert pr_index.replay.call_args_list == [
+        call(pr_index.PRIndex.return_value, "a.jsonl"),
+        call(pr_index.PRIndex.return_value, "b.jsonl"),
+    ]
+    assert capsys.readouterr().out == (
+        "a.jsonl: applied 3 pull_request events\n"
+        "b.jsonl: applied 0 pull_request events\n"
+    )
+
+
+def test_pr_index_sync(capsys, pr_index):
+    pr_index.PRIndex.return_value.sync.side_effect = [2, 5]
+
+    cli(["--pr-index", "index.db", "pr-index", "sync", "a/b", "c/d"])
+
+    assert pr_index.PRIndex.return_value.sync.call_args_list == [
+        call("a/b"),
+        call("c/d"),
+    ]
+    assert capsys.readouterr().out == (
+        "a/b: 2 open pull requests\nc/d: 5 open pull requests\n"
+    )
+
+
+def test_pr_index_needs_a_pr_index(pr_index):
+    with pytest.raises(SystemExit):
+        cli(["pr-index", "sync", "a/b"])
+
+    pr_index.PRIndex.assert_not_called()
+
+
 def test_PRUpsertError(capsys, core):
     core.pr_upsert.side_effect = NoChangesError()
 
@@ -108,11 +687,54 @@ def test_it_prints_stdout_and_stderr_from_CalledProcessErrors(capsys, core):
     assert capsys.readouterr().out.strip() == "errors\noutput"
 
 
+@pytest.fixture(autouse=True)
+def cassette(mocker):
+    return mocker.patch("gh_pr_upsert.cli.cassette", autospec=True)
+
+
 @pytest.fixture(autouse=True)
 def core(mocker):
     return mocker.patch("gh_pr_upsert.cli.core", autospec=True)
 
 
+@pytest.fixture(autouse=True)
+def sweeper(mocker):
+    return mocker.patch("gh_pr_upsert.cli.sweeper", autospec=True)
+
+
+@pytest.fixture(autouse=True)
+def watcher(mocker):
+    return mocker.patch("gh_pr_upsert.cli.watcher", autospec=True)
+
+
+@pytest.fixture
+def manifest(mocker):
+    mocker.patch("gh_pr_upsert.cli.manifest.read", autospec=True)
+    mocker.patch("gh_pr_upsert.cli.manifest.upsert_all", autospec=True)
+    mocker.patch("gh_pr_upsert.cli.manifest.plan_all", autospec=True)
+    return gh_pr_upsert.manifest
+
+
+@pytest.fixture(autouse=True)
+def pr_index(mocker):
+    return mocker.patch("gh_pr_upsert.cli.pr_index", autospec=True)
+
+
+@pytest.fixture(autouse=True)
+def history(mocker):
+    return mocker.patch("gh_pr_upsert.cli.history", autospec=True)
+
+
+@pytest.fixture(autouse=True)
+def metrics(mocker):
+    return mocker.patch("gh_pr_upsert.cli.metrics", autospec=True)
+
+
+@pytest.fixture(autouse=True)
+def set_timeouts(mocker):
+    return mocker.patch("gh_pr_upsert.cli.run.set_timeouts", autospec=True)
+
+
 @pytest.fixture(autouse=True)
 def git(mocker, base_repo, head_repo):
     git = mocker.patch("gh_pr_upsert.cli.git", autospec=True)
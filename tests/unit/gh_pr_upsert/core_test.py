@@ -1,9 +1,10 @@
-from unittest.mock import call, sentinel
+from unittest.mock import call, create_autospec, sentinel
 
 import pytest
 
 from gh_pr_upsert import core
 from gh_pr_upsert.exceptions import NoChangesError, OtherPeopleError, SameBranchError
+from gh_pr_upsert.git import PullRequest
 
 
 class TestPRUpsert:
@@ -25,7 +26,8 @@ class TestPRUpsert:
                 f"{head_repo.remote}/{sentinel.head_branch}",
                 f"^{sentinel.local_branch}",
                 f"^{base_repo.remote}/{sentinel.base_branch}",
-            )
+            ),
+            (),
         )
 
         assert git.diff.call_args_list == [
@@ -34,17 +36,22 @@ class TestPRUpsert:
                 (
                     sentinel.local_branch,
                     f"^{base_repo.remote}/{sentinel.base_branch}",
-                )
+                ),
+                (),
             ),
             # It gets the diff of the remote branch.
             call(
                 (
                     f"{head_repo.remote}/{sentinel.head_branch}",
                     f"^{base_repo.remote}/{sentinel.base_branch}",
-                )
+                ),
+                (),
             ),
         ]
 
+        # It holds a lock on the head branch.
+        git.lock_branch.assert_called_once_with(head_repo.remote, sentinel.head_branch)
+
         # It gets the existing PR.
         git.PullRequest.get.assert_called_once_with(
             base_repo, sentinel.base_branch, head_repo, sentinel.head_branch
@@ -64,6 +71,9 @@ class TestPRUpsert:
         # It doesn't close the PR because there was a diff.
         git.PullRequest.get.return_value.close.assert_not_called()
 
+        # It doesn't update the PR's title and body because it wasn't asked to.
+        git.PullRequest.get.return_value.update.assert_not_called()
+
         # It prints out the PR's URL.
         assert capsys.readouterr().out.strip() == str(
             git.PullRequest.get.return_value.html_url
@@ -83,7 +93,7 @@ class TestPRUpsert:
             )
 
     def test_if_there_are_no_changes_it_closes_any_existing_pr(
-        self, base_repo, head_repo, git
+        self, base_repo, capsys, head_repo, git
     ):
         git.diff.return_value = ""
 
@@ -102,6 +112,9 @@ class TestPRUpsert:
         git.PullRequest.get.return_value.close.assert_called_once_with(
             sentinel.close_comment
         )
+        assert capsys.readouterr().out.strip() == (
+            f"Closed PR {git.PullRequest.get.return_value.html_url}"
+        )
 
     def test_it_doesnt_close_prs_that_have_other_contributors(
         self, base_repo, head_repo, commit_factory, git
@@ -183,6 +196,28 @@ class TestPRUpsert:
 
         git.push.assert_not_called()
 
+    def test_it_updates_the_existing_prs_title_and_body(
+        self, base_repo, capsys, head_repo, git
+    ):
+        core.pr_upsert(
+            base_repo,
+            sentinel.base_branch,
+            sentinel.local_branch,
+            head_repo,
+            sentinel.head_branch,
+            sentinel.title,
+            sentinel.body,
+            sentinel.close_comment,
+            update=True,
+        )
+
+        git.PullRequest.get.return_value.update.assert_called_once_with(
+            sentinel.title, sentinel.body
+        )
+        assert capsys.readouterr().out.strip() == str(
+            git.PullRequest.get.return_value.update.return_value.html_url
+        )
+
     def test_if_the_pr_doesnt_exist_it_creates_one(self, base_repo, head_repo, git):
         git.PullRequest.get.return_value = None
 
@@ -204,19 +239,703 @@ class TestPRUpsert:
             sentinel.head_branch,
             sentinel.title,
             sentinel.body,
+            draft=False,
+            labels=(),
+            reviewers=(),
+            assignees=(),
+            auto_merge=None,
+        )
+
+    def test_it_passes_the_pr_options_to_create(self, base_repo, head_repo, git):
+        git.PullRequest.get.return_value = None
+
+        core.pr_upsert(
+            base_repo,
+            sentinel.base_branch,
+            sentinel.local_branch,
+            head_repo,
+            sentinel.head_branch,
+            sentinel.title,
+            sentinel.body,
+            sentinel.close_comment,
+            draft=True,
+            labels=sentinel.labels,
+            reviewers=sentinel.reviewers,
+            assignees=sentinel.assignees,
+            auto_merge=sentinel.auto_merge,
+        )
+
+        git.PullRequest.create.assert_called_once_with(
+            base_repo,
+            sentinel.base_branch,
+            head_repo,
+            sentinel.head_branch,
+            sentinel.title,
+            sentinel.body,
+            draft=True,
+            labels=sentinel.labels,
+            reviewers=sentinel.reviewers,
+            assignees=sentinel.assignees,
+            auto_merge=sentinel.auto_merge,
+        )
+
+
+class TestPlan:
+    def test_it(self, base_repo, head_repo, git):
+        git.PullRequest.get.return_value = None
+        git.branch_exists.return_value = False
+
+        plan = self.plan(base_repo, head_repo)
+
+        assert plan == core.Plan(
+            action=core.Action.CREATED,
+            reason="there's no PR",
+            push=True,
+            has_changes=True,
+            pull_request=None,
+            local_sha=f"{sentinel.local_branch}_sha",
+            base_sha=f"{base_repo.remote}/{sentinel.base_branch}_sha",
+            remote_sha=None,
+        )
+        assert plan.to_dict()["url"] is None
+        # It doesn't change anything.
+        git.lock_branch.assert_not_called()
+        git.push.assert_not_called()
+        git.PullRequest.create.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "diffs,pr,other_people,update,action,push",
+        [
+            (["", ""], False, False, False, core.Action.NOOP, False),
+            (["", ""], True, False, False, core.Action.CLOSED, False),
+            (["", ""], True, True, False, core.Action.REFUSED, False),
+            (["new", "old"], True, True, False, core.Action.REFUSED, False),
+            (["new", "old"], True, False, False, core.Action.PUSHED, True),
+            (["same", "same"], False, False, False, core.Action.CREATED, False),
+            (["same", "same"], True, False, True, core.Action.UPDATED, False),
+            (["same", "same"], True, False, False, core.Action.NOOP, False),
+        ],
+    )
+    def test_actions(
+        self,
+        base_repo,
+        head_repo,
+        git,
+        commit_factory,
+        diffs,
+        pr,
+        other_people,
+        update,
+        action,
+        push,
+    ):  # pylint:disable=too-many-arguments,too-many-positional-arguments
+        pull_request = git.PullRequest.get.return_value
+        git.diff.side_effect = diffs
+        if not pr:
+            git.PullRequest.get.return_value = None
+        if other_people:
+            git.log.return_value = [commit_factory()]
+
+        plan = self.plan(base_repo, head_repo, update=update)
+
+        assert plan.action == action
+        assert plan.push == push
+        assert plan.reason
+        pull_request.close.assert_not_called()
+        pull_request.update.assert_not_called()
+
+    def test_it_raises_if_the_branches_are_the_same(self, base_repo):
+        with pytest.raises(SameBranchError):
+            core.plan(base_repo, "main", "main", base_repo, "main", None, None)
+
+    def test_it_rejects_misspelt_arguments(self, base_repo, head_repo):
+        with pytest.raises(TypeError):
+            self.plan(base_repo, head_repo, pahts=("src",))
+
+    def test_to_dict(self, base_repo, head_repo, git):
+        plan = self.plan(base_repo, head_repo)
+
+        assert plan.to_dict() == {
+            "action": "noop",
+            "reason": "the PR is up to date",
+            "push": False,
+            "has_changes": True,
+            "url": git.PullRequest.get.return_value.html_url,
+            "number": git.PullRequest.get.return_value.number,
+            "local_sha": f"{sentinel.local_branch}_sha",
+            "base_sha": f"{base_repo.remote}/{sentinel.base_branch}_sha",
+            "remote_sha": f"{head_repo.remote}/{sentinel.head_branch}_sha",
+        }
+
+    def plan(self, base_repo, head_repo, **kwargs):
+        return core.plan(
+            base_repo,
+            sentinel.base_branch,
+            sentinel.local_branch,
+            head_repo,
+            sentinel.head_branch,
+            sentinel.title,
+            sentinel.body,
+            sentinel.close_comment,
+            labels=sentinel.labels,
+            **kwargs,
+        )
+
+
+class TestUpsert:
+    def test_it_creates_a_pr(self, base_repo, head_repo, git):
+        git.PullRequest.get.return_value = None
+        git.branch_exists.return_value = False
+
+        result = self.upsert(base_repo, head_repo)
+
+        git.rev_parse.assert_called_once_with(
+            sentinel.local_branch, f"{base_repo.remote}/{sentinel.base_branch}"
+        )
+        git.clear_ref_caches.assert_called()
+        assert result == core.Result(
+            action=core.Action.CREATED,
+            has_changes=True,
+            pull_request=git.PullRequest.create.return_value,
+            local_sha=f"{sentinel.local_branch}_sha",
+            base_sha=f"{base_repo.remote}/{sentinel.base_branch}_sha",
+            remote_sha=None,
+        )
+        assert result.url == git.PullRequest.create.return_value.html_url
+        assert result.number == git.PullRequest.create.return_value.number
+        assert set(result.timings) == {"total", "inspect", "push", "create"}
+
+    def test_it_pushes_to_an_existing_pr(self, base_repo, head_repo, git):
+        git.diff.side_effect = [sentinel.local_diff, sentinel.remote_diff]
+
+        result = self.upsert(base_repo, head_repo, update=True)
+
+        git.rev_parse.assert_called_once_with(
+            sentinel.local_branch,
+            f"{base_repo.remote}/{sentinel.base_branch}",
+            f"{head_repo.remote}/{sentinel.head_branch}",
+        )
+        git.clear_ref_caches.assert_called_once_with()
+        # It records the push in the PR before updating it.
+        pull_request = git.PullRequest.get.return_value
+        pull_request.pushed.assert_called_once_with(f"{sentinel.local_branch}_sha")
+        assert result.action == core.Action.PUSHED
+        assert (
+            result.pull_request == pull_request.pushed.return_value.update.return_value
+        )
+        assert result.remote_sha == f"{head_repo.remote}/{sentinel.head_branch}_sha"
+        assert set(result.timings) == {"total", "inspect", "push", "update"}
+
+    def test_it_updates_an_existing_pr(self, base_repo, head_repo, git):
+        result = self.upsert(base_repo, head_repo, update=True)
+
+        assert result.action == core.Action.UPDATED
+        assert (
+            result.pull_request == git.PullRequest.get.return_value.update.return_value
+        )
+
+    @pytest.mark.parametrize("update", [True, False])
+    def test_if_nothing_has_changed_it_does_nothing(
+        self, base_repo, head_repo, git, update
+    ):
+        pull_request = git.PullRequest.get.return_value
+        pull_request.changed_fields.return_value = {}
+
+        result = self.upsert(base_repo, head_repo, update=update)
+
+        git.push.assert_not_called()
+        git.clear_ref_caches.assert_not_called()
+        assert result.action == core.Action.NOOP
+        assert result.has_changes
+        assert result.pull_request == pull_request
+
+    def test_it_closes_a_pr_with_no_changes(self, base_repo, head_repo, git):
+        git.diff.return_value = ""
+
+        result = self.upsert(base_repo, head_repo)
+
+        git.clear_ref_caches.assert_called_once_with()
+        assert result.action == core.Action.CLOSED
+        assert not result.has_changes
+        assert result.url == git.PullRequest.get.return_value.html_url
+        assert set(result.timings) == {"total", "inspect", "close"}
+
+    def test_if_there_are_no_changes_and_no_pr_it_does_nothing(
+        self, base_repo, head_repo, git
+    ):
+        git.diff.return_value = ""
+        git.PullRequest.get.return_value = None
+
+        result = self.upsert(base_repo, head_repo)
+
+        assert result.action == core.Action.NOOP
+        assert not result.has_changes
+        assert result.url is None
+        assert result.number is None
+
+    def test_it_limits_the_diffs_and_log_to_paths(self, base_repo, head_repo, git):
+        git.diff.side_effect = [sentinel.local_diff, sentinel.remote_diff]
+
+        self.upsert(base_repo, head_repo, paths=sentinel.paths)
+
+        assert git.log.call_args[0][1] == sentinel.paths
+        assert [call_[0][1] for call_ in git.diff.call_args_list] == [
+            sentinel.paths,
+            sentinel.paths,
+        ]
+
+    @pytest.mark.parametrize("diff", ["", sentinel.local_diff])
+    def test_it_refuses_if_there_are_other_contributors(
+        self, base_repo, head_repo, commit_factory, git, diff
+    ):
+        git.diff.side_effect = [diff, sentinel.remote_diff]
+        git.log.return_value.append(commit_factory())
+
+        result = self.upsert(base_repo, head_repo)
+
+        git.push.assert_not_called()
+        git.PullRequest.get.return_value.close.assert_not_called()
+        assert result.action == core.Action.REFUSED
+        assert result.pull_request == git.PullRequest.get.return_value
+
+    def upsert(self, base_repo, head_repo, **kwargs):
+        return core.upsert(
+            base_repo,
+            sentinel.base_branch,
+            sentinel.local_branch,
+            head_repo,
+            sentinel.head_branch,
+            sentinel.title,
+            sentinel.body,
+            sentinel.close_comment,
+            **kwargs,
+        )
+
+
+class TestUpsertStack:
+    @pytest.mark.usefixtures("stack")
+    def test_it_creates_a_new_stack(self, git_hub_repo, git):
+        results = self.upsert_stack(git_hub_repo)
+
+        git.lock_branch.assert_has_calls(
+            [
+                call(git_hub_repo.remote, "branch_1"),
+                call(git_hub_repo.remote, "branch_2"),
+            ],
+            any_order=True,
+        )
+        git.rev_parse.assert_called_once_with("origin/main", "branch_1", "branch_2")
+        git.push_many.assert_called_once_with(
+            "origin", [("branch_1", "branch_1"), ("branch_2", "branch_2")]
+        )
+        assert git.PullRequest.create.call_args_list == [
+            call(
+                git_hub_repo,
+                "main",
+                git_hub_repo,
+                "branch_1",
+                "Title (1/2)",
+                sentinel.body,
+                draft=sentinel.draft,
+                labels=sentinel.labels,
+                reviewers=sentinel.reviewers,
+                assignees=sentinel.assignees,
+                auto_merge=sentinel.auto_merge,
+            ),
+            call(
+                git_hub_repo,
+                "branch_1",
+                git_hub_repo,
+                "branch_2",
+                "Title (2/2)",
+                sentinel.body,
+                draft=sentinel.draft,
+                labels=sentinel.labels,
+                reviewers=sentinel.reviewers,
+                assignees=sentinel.assignees,
+                auto_merge=sentinel.auto_merge,
+            ),
+        ]
+        git.PullRequest.close_many.assert_not_called()
+        assert results == [
+            core.Result(
+                action=core.Action.CREATED,
+                has_changes=True,
+                pull_request=git.PullRequest.create.return_value,
+                local_sha="branch_1_sha",
+                base_sha="origin/main_sha",
+                remote_sha=None,
+            ),
+            core.Result(
+                action=core.Action.CREATED,
+                has_changes=True,
+                pull_request=git.PullRequest.create.return_value,
+                local_sha="branch_2_sha",
+                base_sha="branch_1_sha",
+                remote_sha=None,
+            ),
+        ]
+
+    def test_it_only_pushes_the_branches_that_have_changed(
+        self, git_hub_repo, git, stack, pull_request_factory
+    ):
+        stack.remote_diffs = {"branch_1": "diff_1", "branch_2": "old_diff_2"}
+        stack.pull_requests = self.pull_requests(pull_request_factory)
+
+        results = self.upsert_stack(git_hub_repo)
+
+        git.push_many.assert_called_once_with("origin", [("branch_2", "branch_2")])
+        git.PullRequest.create.assert_not_called()
+        assert [result.action for result in results] == [
+            core.Action.NOOP,
+            core.Action.PUSHED,
+        ]
+        assert results[1].remote_sha == "origin/branch_2_sha"
+        # The pushed PR's head is the pushed commit.
+        assert results[1].pull_request.head_sha == "branch_2_sha"
+
+    def test_it_updates_existing_prs(self, git_hub_repo, git, stack):
+        stack.remote_diffs = {"branch_1": "diff_1", "branch_2": "diff_2"}
+        stack.pull_requests = {
+            "branch_1": create_autospec(PullRequest, instance=True),
+            "branch_2": create_autospec(PullRequest, instance=True),
+        }
+        stack.pull_requests["branch_2"].update.return_value = stack.pull_requests[
+            "branch_2"
+        ]
+
+        results = self.upsert_stack(git_hub_repo, update=True)
+
+        stack.pull_requests["branch_1"].update.assert_called_once_with(
+            "Title (1/2)", sentinel.body
+        )
+        git.push_many.assert_not_called()
+        assert [result.action for result in results] == [
+            core.Action.UPDATED,
+            core.Action.NOOP,
+        ]
+        assert (
+            results[0].pull_request
+            == stack.pull_requests["branch_1"].update.return_value
+        )
+
+    def test_it_closes_the_prs_at_the_top_of_the_stack_that_have_no_changes(
+        self, git_hub_repo, git, stack, pull_request_factory
+    ):
+        stack.local_diffs["branch_2"] = ""
+        stack.remote_diffs = {"branch_1": "diff_1", "branch_2": "diff_2"}
+        stack.pull_requests = self.pull_requests(pull_request_factory)
+
+        results = self.upsert_stack(git_hub_repo)
+
+        git.PullRequest.close_many.assert_called_once_with(
+            [stack.pull_requests["branch_2"]], sentinel.close_comment
+        )
+        git.push_many.assert_not_called()
+        assert [result.action for result in results] == [
+            core.Action.NOOP,
+            core.Action.CLOSED,
+        ]
+        assert not results[1].has_changes
+
+    def test_it_doesnt_close_prs_lower_down_the_stack(
+        self, git_hub_repo, git, stack, pull_request_factory
+    ):
+        stack.local_diffs["branch_1"] = ""
+        stack.pull_requests = {"branch_1": pull_request_factory()}
+
+        results = self.upsert_stack(git_hub_repo)
+
+        git.PullRequest.close_many.assert_not_called()
+        # branch_1 is still pushed because branch_2's PR is based on it.
+        git.push_many.assert_called_once_with(
+            "origin", [("branch_1", "branch_1"), ("branch_2", "branch_2")]
+        )
+        git.PullRequest.create.assert_called_once()
+        assert [result.action for result in results] == [
+            core.Action.PUSHED,
+            core.Action.CREATED,
+        ]
+        assert [result.has_changes for result in results] == [False, True]
+
+    def test_it_refuses_the_whole_stack_if_there_are_other_contributors(
+        self, git_hub_repo, commit_factory, git, stack, pull_request_factory
+    ):
+        stack.local_diffs["branch_2"] = ""
+        stack.remote_diffs = {"branch_1": "old_diff_1", "branch_2": "diff_2"}
+        stack.pull_requests = self.pull_requests(pull_request_factory)
+        stack.logs["origin/branch_1"] = [commit_factory()]
+
+        results = self.upsert_stack(git_hub_repo)
+
+        git.push_many.assert_not_called()
+        git.PullRequest.create.assert_not_called()
+        git.PullRequest.close_many.assert_not_called()
+        assert [result.action for result in results] == [
+            core.Action.REFUSED,
+            core.Action.NOOP,
+        ]
+
+    def test_it_doesnt_close_prs_that_have_other_contributors(
+        self, git_hub_repo, commit_factory, git, stack, pull_request_factory
+    ):
+        stack.local_diffs["branch_2"] = ""
+        stack.remote_diffs = {"branch_1": "diff_1", "branch_2": "diff_2"}
+        stack.pull_requests = self.pull_requests(pull_request_factory)
+        stack.logs["origin/branch_2"] = [commit_factory()]
+
+        results = self.upsert_stack(git_hub_repo)
+
+        git.PullRequest.close_many.assert_not_called()
+        assert [result.action for result in results] == [
+            core.Action.NOOP,
+            core.Action.REFUSED,
+        ]
+
+    @pytest.mark.usefixtures("stack")
+    def test_it_limits_the_diffs_and_logs_to_paths(self, git_hub_repo, git):
+        self.upsert_stack(git_hub_repo, paths=sentinel.paths)
+
+        for function in (git.log, git.diff):
+            for call_ in function.call_args_list:
+                assert call_[0][1] == sentinel.paths
+
+    @pytest.mark.parametrize(
+        "local_branches", [["branch_1", "branch_1"], ["branch_1", "main"]]
+    )
+    def test_it_raises_if_a_branch_is_repeated(self, git_hub_repo, git, local_branches):
+        with pytest.raises(SameBranchError):
+            core.upsert_stack(
+                git_hub_repo, "main", local_branches, "Title", sentinel.body, None
+            )
+
+        git.push_many.assert_not_called()
+
+    def pull_requests(self, pull_request_factory):
+        return {
+            "branch_1": pull_request_factory(),
+            "branch_2": pull_request_factory(),
+        }
+
+    def upsert_stack(self, repo, **kwargs):
+        return core.upsert_stack(
+            repo,
+            "main",
+            ["branch_1", "branch_2"],
+            "Title",
+            sentinel.body,
+            sentinel.close_comment,
+            draft=sentinel.draft,
+            labels=sentinel.labels,
+            reviewers=sentinel.reviewers,
+            assignees=sentinel.assignees,
+            auto_merge=sentinel.auto_merge,
+            **kwargs,
         )
 
-    @pytest.fixture(autouse=True)
-    def git(self, mocker, user, commit_factory):
-        git = mocker.patch("gh_pr_upsert.core.git", autospec=True)
+    @pytest.fixture
+    def stack(self, git):
+        """Configure the mock `git` module to return a two-branch stack.
+
+        By default both branches have changes, neither remote branch exists,
+        and there are no PRs yet. Tests can change the returned object's
+        attributes to configure a different stack.
+        """
+
+        class Stack:
+            local_diffs = {"branch_1": "diff_1", "branch_2": "diff_2"}
+            # Maps branches to the diffs of their remote branches. Branches
+            # that aren't in here don't have remote branches.
+            remote_diffs: dict = {}
+            # Maps branches to their PRs.
+            pull_requests: dict = {}
+            # Maps remote branches to the commits on them.
+            logs: dict = {}
+
+        def diff(revs, _paths):
+            ref = revs[0]
+            if ref.startswith("origin/"):
+                return Stack.remote_diffs[ref.split("/", 1)[1]]
+            return Stack.local_diffs[ref]
+
+        git.diff.side_effect = diff
+        git.branch_exists.side_effect = (
+            lambda _remote, branch: branch in Stack.remote_diffs
+        )
+        git.log.side_effect = lambda revs, _paths: Stack.logs.get(revs[0], [])
+        git.PullRequest.get.side_effect = (
+            lambda _base_repo, _base_branch, _head_repo, head_branch: (
+                Stack.pull_requests.get(head_branch)
+            )
+        )
 
-        # Make `git log` return two commits both by the configured user.
-        git.configured_user.return_value = user
+        return Stack
 
-        git.log.return_value = commit_factory.create_batch(
-            2,
-            author=git.configured_user.return_value,
-            committer=git.configured_user.return_value,
+
+class TestPRUpsertStack:
+    def test_it(self, capsys, git_hub_repo, git):
+        git.PullRequest.get.return_value = None
+        git.branch_exists.return_value = False
+
+        core.pr_upsert_stack(
+            git_hub_repo, "main", ["branch_1"], "Title", sentinel.body, None
+        )
+
+        pull_request = git.PullRequest.create.return_value
+        assert capsys.readouterr().out.strip() == str(pull_request.html_url)
+
+    def test_it_prints_closed_prs(self, capsys, pull_request_factory):
+        pull_request = pull_request_factory()
+
+        core.print_stack_results(
+            [
+                self.result(core.Action.NOOP, pull_request=pull_request),
+                self.result(
+                    core.Action.CLOSED, has_changes=False, pull_request=pull_request
+                ),
+            ]
+        )
+
+        assert (
+            capsys.readouterr().out
+            == f"{pull_request.html_url}\nClosed PR {pull_request.html_url}\n"
+        )
+
+    def test_it_raises_if_the_stack_was_refused(self):
+        with pytest.raises(OtherPeopleError):
+            core.print_stack_results(
+                [self.result(core.Action.REFUSED), self.result(core.Action.NOOP)]
+            )
+
+    def test_it_raises_if_there_are_no_changes(self):
+        with pytest.raises(NoChangesError):
+            core.print_stack_results([self.result(core.Action.NOOP, has_changes=False)])
+
+    def result(self, action, has_changes=True, pull_request=None):
+        return core.Result(
+            action=action,
+            has_changes=has_changes,
+            pull_request=pull_request,
+            local_sha="local_sha",
+            base_sha="base_sha",
+            remote_sha=None,
+        )
+
+
+class TestRemoteCommits:
+    def test_it_reads_the_remote_tracking_branch(self, base_repo, head_repo, git):
+        commits = self.remote_commits(
+            base_repo, head_repo, git.PullRequest.get.return_value
+        )
+
+        git.log.assert_called_once_with(
+            (
+                f"{head_repo.remote}/{sentinel.head_branch}",
+                f"^{sentinel.local_branch}",
+                f"^{base_repo.remote}/{sentinel.base_branch}",
+            ),
+            sentinel.paths,
+        )
+        git.compare_commits.assert_not_called()
+        assert commits == git.log.return_value
+
+    def test_it_reads_the_remote_tracking_branch_if_theres_no_pr(
+        self, base_repo, head_repo, git
+    ):
+        commits = self.remote_commits(base_repo, head_repo, None, remote_sha=None)
+
+        git.compare_commits.assert_not_called()
+        assert commits == git.log.return_value
+
+    @pytest.mark.parametrize("remote_sha", [None, "stale_sha"])
+    def test_if_the_remote_tracking_branch_is_missing_or_stale_it_asks_github(
+        self, base_repo, head_repo, commit_factory, git, remote_sha
+    ):
+        local_commit, remote_commit = commit_factory.create_batch(2)
+        git.rev_list.return_value = [local_commit.sha]
+        git.compare_commits.return_value = [local_commit, remote_commit]
+
+        commits = self.remote_commits(
+            base_repo, head_repo, git.PullRequest.get.return_value, remote_sha, ()
+        )
+
+        git.fetch_branch.assert_not_called()
+        git.rev_list.assert_called_once_with(
+            sentinel.local_branch, f"^{base_repo.remote}/{sentinel.base_branch}"
+        )
+        git.compare_commits.assert_called_once_with(
+            base_repo, sentinel.base_branch, head_repo, sentinel.head_branch
         )
+        git.log.assert_not_called()
+        assert commits == [remote_commit]
+
+    def test_if_the_remote_tracking_branch_is_stale_and_there_are_paths_it_fetches(
+        self, base_repo, head_repo, git
+    ):
+        commits = self.remote_commits(
+            base_repo, head_repo, git.PullRequest.get.return_value, "stale_sha"
+        )
+
+        git.fetch_branch.assert_called_once_with(head_repo.remote, sentinel.head_branch)
+        git.compare_commits.assert_not_called()
+        assert git.log.call_args[0][1] == sentinel.paths
+        assert commits == git.log.return_value
+
+    def remote_commits(
+        self,
+        base_repo,
+        head_repo,
+        pull_request,
+        remote_sha=sentinel.unset,
+        paths=sentinel.paths,
+    ):
+        if remote_sha is sentinel.unset:
+            remote_sha = f"{head_repo.remote}/{sentinel.head_branch}_sha"
+
+        return core.remote_commits(
+            base_repo,
+            sentinel.base_branch,
+            sentinel.local_branch,
+            head_repo,
+            sentinel.head_branch,
+            pull_request,
+            remote_sha,
+            paths,
+        )
+
+
+class TestGetOtherContributors:
+    def test_it(self, commit_factory, git, user_factory):
+        other_user = user_factory()
+        commits = [
+            commit_factory(author=other_user, committer=git.configured_user()),
+            commit_factory(committer=other_user),
+        ]
+
+        assert core.get_other_contributors(commits, other_user) == {
+            git.configured_user(),
+            commits[1].author,
+        }
+
+
+@pytest.fixture(autouse=True)
+def git(mocker, user, commit_factory, head_repo):
+    git = mocker.patch("gh_pr_upsert.core.git", autospec=True)
+
+    # Make `git log` return two commits both by the configured user.
+    git.configured_user.return_value = user
+
+    git.rev_parse.side_effect = lambda *revs: [f"{rev}_sha" for rev in revs]
+
+    # Make the remote-tracking branch up to date with the PR.
+    git.PullRequest.get.return_value.head_sha = (
+        f"{head_repo.remote}/{sentinel.head_branch}_sha"
+    )
+
+    git.log.return_value = commit_factory.create_batch(
+        2,
+        author=git.configured_user.return_value,
+        committer=git.configured_user.return_value,
+    )
 
-        return git
+    return git
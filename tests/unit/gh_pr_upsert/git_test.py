@@ -1,3 +1,6 @@
+import fcntl
+import hashlib
+from collections import Counter
 from subprocess import CalledProcessError
 from unittest.mock import call, sentinel
 
@@ -5,307 +8,307 @@ import pytest
 
 from gh_pr_upsert.git import (
     Commit,
-    GitHubRepo,
-    PullRequest,
+    DiffStat,
     User,
     branch_exists,
+    cached_functions,
+    clear_local_ref_caches,
+    clear_ref_caches,
+    common_dir,
+    compare_commits,
     configured_user,
     current_branch,
     diff,
+    diff_is_empty,
+    diffstat,
+    fetch,
+    fetch_branch,
+    git_paths,
+    lock_branch,
     log,
     push,
+    push_many,
+    rev_list,
+    rev_parse,
 )
 
 
-class TestCommit:
-    def test_get(self, run):
-        run.side_effect = [
-            sentinel.full_sha,
-            sentinel.author_name,
-            sentinel.author_email,
-            sentinel.committer_name,
-            sentinel.committer_email,
-        ]
-
-        commit = Commit.get(sentinel.sha)
+class TestBranchExists:
+    def test_it_returns_True_if_the_branch_exists(self, run):
+        exists = branch_exists("origin", "my-branch")
 
-        assert run.call_args_list == [
-            call(["git", "show", "--no-patch", "--format=%H", sentinel.sha]),
-            call(["git", "show", "--no-patch", "--format=%an", sentinel.sha]),
-            call(["git", "show", "--no-patch", "--format=%ae", sentinel.sha]),
-            call(["git", "show", "--no-patch", "--format=%cn", sentinel.sha]),
-            call(["git", "show", "--no-patch", "--format=%ce", sentinel.sha]),
-        ]
-        assert commit == Commit(
-            sha=sentinel.full_sha,
-            author=User(name=sentinel.author_name, email=sentinel.author_email),
-            committer=User(
-                name=sentinel.committer_name, email=sentinel.committer_email
-            ),
+        run.assert_called_once_with(
+            ["git", "show-ref", "refs/remotes/origin/my-branch"]
         )
+        assert exists
+
+    def test_it_returns_False_if_the_branch_doesnt_exist(self, run):
+        run.side_effect = CalledProcessError(returncode=1, cmd=sentinel.cmd)
 
+        assert not branch_exists("origin", "my-branch")
 
-class TestGitHubRepo:
-    def test_get(self, run):
-        # The JSON returned by `gh repo view`.
-        json = {
-            "name": sentinel.repo_name,
-            "nameWithOwner": sentinel.repo_name_with_owner,
-            "url": sentinel.repo_url,
-            "owner": {"login": sentinel.owner_login},
-            "defaultBranchRef": {"name": sentinel.default_branch_name},
-        }
-        run.side_effect = [sentinel.remote_url, json]
+    def test_it_raises_if_it_gets_an_unexpected_exit_code_from_git(self, run):
+        run.side_effect = CalledProcessError(returncode=2, cmd=sentinel.cmd)
+
+        with pytest.raises(CalledProcessError) as exc_info:
+            branch_exists("origin", "my-branch")
+
+        assert exc_info.value == run.side_effect
 
-        repo = GitHubRepo.get(sentinel.remote)
 
+class TestCommonDir:
+    def test_it(self, run, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        run.return_value = ".git"
+
+        assert common_dir() == str(tmp_path / ".git")
+        run.assert_called_once_with(["git", "rev-parse", "--git-common-dir"])
+
+
+class TestConfiguredUser:
+    def test_it(self, user, run):
+        run.side_effect = [user.name, user.email]
+
+        assert configured_user() == user
         assert run.call_args_list == [
-            call(["git", "remote", "get-url", sentinel.remote]),
-            call(
-                [
-                    "gh",
-                    "repo",
-                    "view",
-                    "--json",
-                    "owner,name,nameWithOwner,defaultBranchRef,url",
-                    sentinel.remote_url,
-                ],
-                json=True,
-            ),
+            call(["git", "config", "--get", "user.name"]),
+            call(["git", "config", "--get", "user.email"]),
         ]
-        assert repo == GitHubRepo(
-            remote=sentinel.remote,
-            owner=sentinel.owner_login,
-            name=sentinel.repo_name,
-            name_with_owner=sentinel.repo_name_with_owner,
-            default_branch=sentinel.default_branch_name,
-            url=sentinel.repo_url,
-            json=json,
-        )
 
 
-class TestPullRequest:
-    def test_from_json(self, json):
-        pull_request = PullRequest.from_json(
-            sentinel.base_repo, sentinel.head_repo, sentinel.head_branch, json
-        )
+class TestCurrentBranch:
+    def test_it(self, run):
+        branch = current_branch()
 
-        assert pull_request == PullRequest(
-            base_repo=sentinel.base_repo,
-            head_repo=sentinel.head_repo,
-            head_branch=sentinel.head_branch,
-            number=sentinel.number,
-            html_url=sentinel.html_url,
-            json=json,
+        run.assert_called_once_with(
+            ["git", "symbolic-ref", "--quiet", "--short", "HEAD"]
         )
+        assert branch == run.return_value
 
-    def test_create(self, base_repo, head_repo, run, json):
-        run.return_value = json
 
-        pull_request = PullRequest.create(
-            base_repo,
-            sentinel.base_branch,
-            head_repo,
-            sentinel.head_branch,
-            sentinel.title,
-            sentinel.body,
-        )
+class TestDiff:
+    def test_it(self, stream):
+        stream.return_value = iter([b"diff ", b"output"])
 
-        run.assert_called_once_with(
-            [
-                "gh",
-                "api",
-                "--header",
-                "X-GitHub-Api-Version:2022-11-28",
-                "--method",
-                "POST",
-                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
-                "-f",
-                f"base={sentinel.base_branch}",
-                "-f",
-                f"head={head_repo.owner}:{sentinel.head_branch}",
-                "-f",
-                f"title={sentinel.title}",
-                "-f",
-                f"body={sentinel.body}",
-            ],
-            json=True,
-        )
-        assert pull_request == PullRequest(
-            base_repo=base_repo,
-            head_repo=head_repo,
-            head_branch=sentinel.head_branch,
-            number=sentinel.number,
-            html_url=sentinel.html_url,
-            json=json,
+        returned = diff((sentinel.branch_1, sentinel.branch_2))
+
+        stream.assert_called_once_with(
+            ["git", "diff", sentinel.branch_1, sentinel.branch_2], separator=None
         )
+        assert returned == hashlib.sha256(b"diff output").hexdigest()
+
+    def test_it_returns_an_empty_string_if_there_are_no_changes(self, stream):
+        stream.return_value = iter([])
 
-    def test_get(self, base_repo, head_repo, run, json):
-        run.return_value = [json]
+        assert not diff((sentinel.branch_1,))
 
-        pull_request = PullRequest.get(
-            base_repo, sentinel.base_branch, head_repo, sentinel.head_branch
+    def test_it_records_the_size_of_the_diff(self, stream, metrics):
+        stream.return_value = iter(["diff\N{SNOWMAN}".encode("utf-8")])
+
+        diff((sentinel.branch_1, sentinel.branch_2))
+
+        metrics.DIFF_BYTES.inc.assert_called_once_with(7)
+
+    def test_paths(self, stream):
+        diff((sentinel.branch_1,), ("src", "*.md"))
+
+        stream.assert_called_once_with(
+            ["git", "diff", sentinel.branch_1, "--", "src", "*.md"], separator=None
         )
 
-        run.assert_called_once_with(
+
+class TestDiffStat:
+    def test_from_numstat(self):
+        stats = DiffStat.from_numstat(
             [
-                "gh",
-                "api",
-                "--header",
-                "X-GitHub-Api-Version:2022-11-28",
-                "--paginate",
-                "--method",
-                "GET",
-                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
-                "-f",
-                f"base={sentinel.base_branch}",
-                "-f",
-                f"head={head_repo.owner}:{sentinel.head_branch}",
-                "-f",
-                "state=open",
-            ],
-            json=True,
-        )
-        assert pull_request == PullRequest(
-            base_repo=base_repo,
-            head_repo=head_repo,
-            head_branch=sentinel.head_branch,
-            number=sentinel.number,
-            html_url=sentinel.html_url,
-            json=json,
+                "3\t1\tsrc/a.py",
+                "10\t0\tsrc/pkg/b.py",
+                # A renamed file.
+                "2\t2\t",
+                "docs/old.md",
+                "docs/new.md",
+                "-\t-\timage.png",
+                "1\t0\tREADME.md",
+            ]
         )
 
-    def test_get_returns_None_if_there_are_no_matching_prs(
-        self, base_repo, head_repo, run
-    ):
-        run.return_value = None
+        assert stats == DiffStat(
+            files=5,
+            insertions=16,
+            deletions=3,
+            binary_files=1,
+            directories={"src": 14, "docs": 4, ".": 1},
+        )
 
-        assert not PullRequest.get(
-            base_repo, sentinel.base_branch, head_repo, sentinel.head_branch
+    def test_template_fields(self):
+        stats = DiffStat(
+            files=3,
+            insertions=4,
+            deletions=5,
+            binary_files=1,
+            directories=Counter({"src": 8, "docs": 1, ".": 0}),
         )
 
-    def test_get_raises_if_there_are_multiple_matching_prs(
-        self, base_repo, head_repo, pull_request_factory, run
-    ):
-        # Make the GitHub API return two PRs for the same base repo, head repo
-        # and head branch. This should never happen in production: there can't
-        # be two open PRs for the same base and head branch, so get() raises
-        # AssertionError.
-        run.return_value = [
-            {"number": pr.number, "html_url": pr.html_url}
-            for pr in pull_request_factory.create_batch(
-                2,
-                base_repo=base_repo,
-                head_repo=head_repo,
-                head_branch=sentinel.head_branch,
-            )
-        ]
+        assert stats.template_fields(top=2) == {
+            "files": 3,
+            "insertions": 4,
+            "deletions": 5,
+            "binary_files": 1,
+            "top_directories": "- `src`: 8 lines changed\n- `docs`: 1 lines changed",
+        }
 
-        with pytest.raises(AssertionError):
-            PullRequest.get(
-                base_repo, sentinel.base_branch, head_repo, sentinel.head_branch
-            )
+    def test_diffstat(self, mocker):
+        stream = mocker.patch("gh_pr_upsert.git.stream", autospec=True)
+        stream.return_value = iter(["1\t2\tsrc/a.py"])
 
-    def test_close(self, pull_request, run):
-        pull_request.close(sentinel.comment)
+        stats = diffstat(("local", "^origin/main"), ("src",))
 
-        run.assert_called_once_with(
+        stream.assert_called_once_with(
             [
-                "gh",
-                "pr",
-                "close",
-                "--repo",
-                pull_request.base_repo.name_with_owner,
-                "--delete-branch",
-                "--comment",
-                sentinel.comment,
-                str(pull_request.number),
-            ]
+                "git",
+                "diff",
+                "--numstat",
+                "-z",
+                "local",
+                "^origin/main",
+                "--",
+                "src",
+            ],
+            separator=b"\0",
         )
+        assert stats.insertions == 1
+        assert stats.deletions == 2
 
-    @pytest.fixture
-    def json(self):
-        """Return a JSON representation of a pull request as from the GitHub API."""
-        return {"number": sentinel.number, "html_url": sentinel.html_url}
 
-
-class TestBranchExists:
-    def test_it_returns_True_if_the_branch_exists(self, run):
-        exists = branch_exists("origin", "my-branch")
+class TestDiffIsEmpty:
+    def test_it_returns_True_if_the_diff_is_empty(self, run):
+        is_empty = diff_is_empty((sentinel.branch_1, sentinel.branch_2))
 
         run.assert_called_once_with(
-            ["git", "show-ref", "refs/remotes/origin/my-branch"]
+            ["git", "diff", "--quiet", sentinel.branch_1, sentinel.branch_2]
         )
-        assert exists
+        assert is_empty
 
-    def test_it_returns_False_if_the_branch_doesnt_exist(self, run):
+    def test_it_returns_False_if_the_diff_isnt_empty(self, run):
         run.side_effect = CalledProcessError(returncode=1, cmd=sentinel.cmd)
 
-        assert not branch_exists("origin", "my-branch")
+        assert not diff_is_empty((sentinel.branch_1, sentinel.branch_2))
 
     def test_it_raises_if_it_gets_an_unexpected_exit_code_from_git(self, run):
-        run.side_effect = CalledProcessError(returncode=2, cmd=sentinel.cmd)
+        run.side_effect = CalledProcessError(returncode=128, cmd=sentinel.cmd)
 
         with pytest.raises(CalledProcessError) as exc_info:
-            branch_exists("origin", "my-branch")
+            diff_is_empty((sentinel.branch_1, sentinel.branch_2))
 
         assert exc_info.value == run.side_effect
 
+    def test_paths(self, run):
+        diff_is_empty((sentinel.branch_1,), ("src",))
 
-class TestConfiguredUser:
-    def test_it(self, user, run):
-        run.side_effect = [user.name, user.email]
-
-        assert configured_user() == user
-        assert run.call_args_list == [
-            call(["git", "config", "--get", "user.name"]),
-            call(["git", "config", "--get", "user.email"]),
-        ]
+        run.assert_called_once_with(
+            ["git", "diff", "--quiet", sentinel.branch_1, "--", "src"]
+        )
 
 
-class TestCurrentBranch:
+class TestFetch:
     def test_it(self, run):
-        branch = current_branch()
+        fetch(sentinel.remote_1, sentinel.remote_2)
 
         run.assert_called_once_with(
-            ["git", "symbolic-ref", "--quiet", "--short", "HEAD"]
+            ["git", "fetch", "--multiple", sentinel.remote_1, sentinel.remote_2]
         )
-        assert branch == run.return_value
 
 
-class TestDiff:
+class TestFetchBranch:
     def test_it(self, run):
-        returned = diff((sentinel.branch_1, sentinel.branch_2))
+        fetch_branch("origin", "my-branch")
 
         run.assert_called_once_with(
-            ["git", "diff", sentinel.branch_1, sentinel.branch_2]
+            [
+                "git",
+                "fetch",
+                "origin",
+                "+refs/heads/my-branch:refs/remotes/origin/my-branch",
+            ]
         )
-        assert returned == run.return_value
 
 
 class TestLog:
-    def test_it(self, commit_factory, run, get):
-        get.side_effect = commits = commit_factory.create_batch(2)
-        run.return_value = "\n".join((commit.sha for commit in commits))
+    def test_it(self, commit_factory, stream):
+        commits = commit_factory.create_batch(2)
+        stream.return_value = iter(
+            "\0".join(
+                [
+                    commit.sha,
+                    commit.author.name,
+                    commit.author.email,
+                    commit.committer.name,
+                    commit.committer.email,
+                ]
+            )
+            for commit in commits
+        )
 
         returned = log((sentinel.branch_1, sentinel.branch_2))
 
-        run.assert_called_once_with(
+        stream.assert_called_once_with(
             [
                 "git",
                 "log",
                 "--ignore-missing",
                 sentinel.branch_1,
                 sentinel.branch_2,
-                "--format=%H",
+                "--format=%H%x00%an%x00%ae%x00%cn%x00%ce",
             ]
         )
-        assert get.call_args_list == [call(commits[0].sha), call(commits[1].sha)]
         assert returned == commits
 
+    def test_paths(self, stream):
+        stream.return_value = iter([])
+
+        log((sentinel.branch_1,), ("src",))
+
+        stream.assert_called_once_with(
+            [
+                "git",
+                "log",
+                "--ignore-missing",
+                sentinel.branch_1,
+                "--format=%H%x00%an%x00%ae%x00%cn%x00%ce",
+                "--",
+                "src",
+            ]
+        )
+
+
+class TestLockBranch:
+    def test_it_locks_the_branch(self, lock_path):
+        with lock_branch("origin", "feature/branch"):
+            with open(lock_path, encoding="utf-8") as lock_file:
+                # Another process can't take the lock while it's held.
+                with pytest.raises(BlockingIOError):
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        with open(lock_path, encoding="utf-8") as lock_file:
+            # The lock is released at the end of the context.
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_it_releases_the_lock_if_theres_an_exception(self, lock_path):
+        with pytest.raises(ValueError):
+            with lock_branch("origin", "feature/branch"):
+                raise ValueError()
+
+        with open(lock_path, encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    @pytest.fixture
+    def lock_path(self, common_dir, tmp_path):
+        common_dir.return_value = str(tmp_path)
+        return tmp_path / "gh-pr-upsert" / "locks" / "origin%2Ffeature%2Fbranch.lock"
+
     @pytest.fixture(autouse=True)
-    def get(self, mocker):
-        return mocker.patch("gh_pr_upsert.git.Commit.get", autospec=True)
+    def common_dir(self, mocker):
+        return mocker.patch("gh_pr_upsert.git.common_dir", autospec=True)
 
 
 class TestPush:
@@ -322,21 +325,147 @@ class TestPush:
             ]
         )
 
+    def test_it_records_the_push_duration(self, metrics, mocker):
+        time = mocker.patch("gh_pr_upsert.git.time", autospec=True)
+        time.monotonic.side_effect = [100, 103.5]
+
+        push(sentinel.remote, sentinel.local_branch, sentinel.remote_branch)
+
+        metrics.PUSH_DURATION.observe.assert_called_once_with(3.5)
+
+
+class TestPushMany:
+    def test_it(self, run):
+        push_many("origin", [("branch_1", "branch_1"), ("local", "remote")])
+
+        run.assert_called_once_with(
+            [
+                "git",
+                "push",
+                "--atomic",
+                "--force-with-lease",
+                "origin",
+                "branch_1:branch_1",
+                "local:remote",
+            ]
+        )
+
+    def test_it_records_the_push_duration(self, metrics, mocker):
+        time = mocker.patch("gh_pr_upsert.git.time", autospec=True)
+        time.monotonic.side_effect = [100, 102]
+
+        push_many("origin", [("branch_1", "branch_1")])
+
+        metrics.PUSH_DURATION.observe.assert_called_once_with(2)
+
+
+class TestCompareCommits:
+    def test_it(self, stream, git_hub_repo_factory):
+        base_repo = git_hub_repo_factory(owner="base-owner", name="repo")
+        head_repo = git_hub_repo_factory(owner="head-owner")
+        stream.return_value = iter(
+            ["sha1\0A\0a@example.com\0C\0c@example.com", "sha2\0B\0b@\0B\0b@"]
+        )
+
+        commits = compare_commits(base_repo, "main", head_repo, "feature/branch")
+
+        assert stream.call_args[0][0][:8] == [
+            "gh",
+            "api",
+            "--header",
+            "X-GitHub-Api-Version:2022-11-28",
+            "--paginate",
+            "--method",
+            "GET",
+            "/repos/base-owner/repo/compare/main...head-owner:feature/branch",
+        ]
+        assert stream.call_args[0][0][8] == "--jq"
+        assert commits == [
+            Commit("sha1", User("A", "a@example.com"), User("C", "c@example.com")),
+            Commit("sha2", User("B", "b@"), User("B", "b@")),
+        ]
+
+    def test_it_returns_nothing_if_there_are_no_commits(self, stream, git_hub_repo):
+        stream.return_value = iter([])
+
+        assert not compare_commits(git_hub_repo, "main", git_hub_repo, "branch")
+
+
+class TestRevList:
+    def test_it(self, run):
+        run.return_value = "sha_1\nsha_2"
+
+        assert rev_list("local", "^origin/main") == ["sha_1", "sha_2"]
+        run.assert_called_once_with(["git", "rev-list", "local", "^origin/main"])
+
+
+class TestRevParse:
+    def test_it(self, run):
+        run.return_value = "sha_1\nsha_2"
+
+        shas = rev_parse("main", "origin/main")
+
+        run.assert_called_once_with(["git", "rev-parse", "main", "origin/main"])
+        assert shas == ["sha_1", "sha_2"]
+
+
+def test_clear_ref_caches(run):
+    branch_exists("origin", "my-branch")
+
+    clear_ref_caches()
+
+    branch_exists("origin", "my-branch")
+    assert run.call_count == 2
+
+
+def test_clear_local_ref_caches(run, stream):
+    branch_exists("origin", "my-branch")
+    diff(("my-branch",))
+
+    clear_local_ref_caches()
+
+    branch_exists("origin", "my-branch")
+    diff(("my-branch",))
+    assert run.call_count == 1
+    assert stream.call_count == 2
+
+
+def test_git_paths(run):
+    run.return_value = "path_1\npath_2"
+
+    assert git_paths("HEAD", "refs/heads/main") == ["path_1", "path_2"]
+    run.assert_called_once_with(
+        ["git", "rev-parse", "--git-path", "HEAD", "--git-path", "refs/heads/main"]
+    )
+
+
+def test_cached_functions():
+    for function in cached_functions():
+        assert function.cache_info()
+
 
 @pytest.fixture(autouse=True)
 def clear_caches():
+    # Tests in other modules can leave results cached.
+    for function in cached_functions():
+        function.cache_clear()
+
     yield
 
-    branch_exists.cache_clear()
-    configured_user.cache_clear()
-    current_branch.cache_clear()
-    diff.cache_clear()
-    log.cache_clear()
-    Commit.get.cache_clear()
-    PullRequest.get.cache_clear()
-    GitHubRepo.get.cache_clear()
+    for function in cached_functions():
+        function.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def metrics(mocker):
+    return mocker.patch("gh_pr_upsert.git.metrics", autospec=True)
 
 
 @pytest.fixture(autouse=True)
 def run(mocker):
     return mocker.patch("gh_pr_upsert.git.run", autospec=True)
+
+
+@pytest.fixture
+def stream(mocker):
+    return mocker.patch("gh_pr_upsert.git.stream", autospec=True)
@@ -0,0 +1,576 @@
+import json
+import re
+from dataclasses import replace
+from unittest.mock import call, sentinel
+
+import pytest
+
+from gh_pr_upsert.exceptions import NotFoundError
+from gh_pr_upsert.github import (
+    PR_MARKER,
+    PR_RECORD_JQ,
+    GitHubRepo,
+    PullRequest,
+    get_node_ids,
+    graphql,
+)
+
+
+class TestGitHubRepo:
+    def test_get(self, run):
+        # The JSON returned by `gh repo view`.
+        json = {
+            "id": sentinel.repo_node_id,
+            "name": sentinel.repo_name,
+            "nameWithOwner": sentinel.repo_name_with_owner,
+            "url": sentinel.repo_url,
+            "owner": {"login": sentinel.owner_login},
+            "defaultBranchRef": {"name": sentinel.default_branch_name},
+        }
+        run.side_effect = [sentinel.remote_url, json]
+
+        repo = GitHubRepo.get(sentinel.remote)
+
+        assert run.call_args_list == [
+            call(["git", "remote", "get-url", sentinel.remote]),
+            call(
+                [
+                    "gh",
+                    "repo",
+                    "view",
+                    "--json",
+                    "id,owner,name,nameWithOwner,defaultBranchRef,url",
+                    sentinel.remote_url,
+                ],
+                json=True,
+            ),
+        ]
+        assert repo == GitHubRepo(
+            remote=sentinel.remote,
+            owner=sentinel.owner_login,
+            name=sentinel.repo_name,
+            node_id=sentinel.repo_node_id,
+            name_with_owner=sentinel.repo_name_with_owner,
+            default_branch=sentinel.default_branch_name,
+            url=sentinel.repo_url,
+        )
+
+
+class TestPullRequest:
+    def test_from_json(self):
+        json = {
+            "number": 1,
+            "node_id": "PR_1",
+            "title": "Title",
+            "body": "Body",
+            "base": {"ref": "main"},
+            "head": {"sha": "abc"},
+            "html_url": "https://github.com/owner/repo/pull/1",
+        }
+
+        pull_request = PullRequest.from_json(
+            sentinel.base_repo, sentinel.head_repo, sentinel.head_branch, json
+        )
+
+        assert pull_request.head_branch == sentinel.head_branch
+        assert pull_request.number == 1
+        assert pull_request.node_id == "PR_1"
+        assert pull_request.base_branch == "main"
+        assert pull_request.head_sha == "abc"
+        assert pull_request.html_url == json["html_url"]
+        assert pull_request.json == {"title": "Title", "body": "Body"}
+
+    def test_from_record(self, record):
+        pull_request = PullRequest.from_record(
+            sentinel.base_repo, sentinel.head_repo, record
+        )
+
+        assert pull_request.base_repo == sentinel.base_repo
+        assert pull_request.head_repo == sentinel.head_repo
+        assert pull_request.head_branch == "branch"
+        assert pull_request.number == 1
+        assert pull_request.node_id == "PR_1"
+        assert pull_request.base_branch == "main"
+        assert pull_request.head_sha == "abc"
+        assert pull_request.html_url == "https://github.com/owner/repo/pull/1"
+        assert pull_request.updated_at == "2024-01-01T00:00:00Z"
+        # The title and body are only decoded when they're asked for.
+        assert pull_request.raw_json == '{"title": "Title", "body": "Body\\u0000"}'
+        assert pull_request.json == {"title": "Title", "body": "Body\0"}
+
+    def test_create(
+        self, base_repo, head_repo, run, record, get_node_ids, configure
+    ):  # pylint:disable=too-many-positional-arguments
+        run.return_value = record
+
+        pull_request = PullRequest.create(
+            base_repo,
+            sentinel.base_branch,
+            head_repo,
+            sentinel.head_branch,
+            sentinel.title,
+            sentinel.body,
+        )
+
+        get_node_ids.assert_called_once_with(base_repo, (), [], [])
+        run.assert_called_once_with(
+            [
+                "gh",
+                "api",
+                "--header",
+                "X-GitHub-Api-Version:2022-11-28",
+                "--method",
+                "POST",
+                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
+                "--input",
+                "-",
+                "--jq",
+                PR_RECORD_JQ,
+            ],
+            json_input={
+                "base": sentinel.base_branch,
+                "head": f"{head_repo.owner}:{sentinel.head_branch}",
+                "title": sentinel.title,
+                "body": f"{sentinel.body}\n\n{PR_MARKER}",
+                "draft": False,
+            },
+        )
+        configure.assert_called_once_with(
+            pull_request,
+            label_ids=[],
+            reviewer_ids=[],
+            team_reviewer_ids=[],
+            assignee_ids=[],
+            auto_merge=None,
+        )
+        assert pull_request == PullRequest.from_record(base_repo, head_repo, record)
+
+    def test_create_with_options(
+        self, base_repo, head_repo, run, record, get_node_ids, configure
+    ):  # pylint:disable=too-many-positional-arguments
+        run.return_value = record
+        get_node_ids.return_value = (
+            {"label": "LABEL_ID"},
+            {"reviewer": "REVIEWER_ID", "assignee": "ASSIGNEE_ID"},
+            {"org/team": "TEAM_ID"},
+        )
+
+        pull_request = PullRequest.create(
+            base_repo,
+            sentinel.base_branch,
+            head_repo,
+            sentinel.head_branch,
+            sentinel.title,
+            sentinel.body,
+            draft=True,
+            labels=["label"],
+            reviewers=["reviewer", "org/team"],
+            assignees=["assignee"],
+            auto_merge="SQUASH",
+        )
+
+        get_node_ids.assert_called_once_with(
+            base_repo, ["label"], ["reviewer", "assignee"], ["org/team"]
+        )
+        assert run.call_args[1]["json_input"]["draft"] is True
+        configure.assert_called_once_with(
+            pull_request,
+            label_ids=["LABEL_ID"],
+            reviewer_ids=["REVIEWER_ID"],
+            team_reviewer_ids=["TEAM_ID"],
+            assignee_ids=["ASSIGNEE_ID"],
+            auto_merge="SQUASH",
+        )
+
+    def test_get(self, base_repo, head_repo, stream, record):
+        stream.return_value = iter([record])
+
+        pull_request = PullRequest.get(
+            base_repo, sentinel.base_branch, head_repo, sentinel.head_branch
+        )
+
+        stream.assert_called_once_with(
+            [
+                "gh",
+                "api",
+                "--header",
+                "X-GitHub-Api-Version:2022-11-28",
+                "--paginate",
+                "--method",
+                "GET",
+                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
+                "-f",
+                f"base={sentinel.base_branch}",
+                "-f",
+                f"head={head_repo.owner}:{sentinel.head_branch}",
+                "-f",
+                "state=open",
+                "--jq",
+                f".[] | {PR_RECORD_JQ}",
+            ]
+        )
+        assert pull_request == PullRequest.from_record(base_repo, head_repo, record)
+
+    def test_get_returns_None_if_there_are_no_matching_prs(
+        self, base_repo, head_repo, stream
+    ):
+        stream.return_value = iter([])
+
+        assert not PullRequest.get(
+            base_repo, sentinel.base_branch, head_repo, sentinel.head_branch
+        )
+
+    def test_get_raises_if_there_are_multiple_matching_prs(
+        self, base_repo, head_repo, stream, record
+    ):
+        # Make the GitHub API return two PRs for the same base repo, head repo
+        # and head branch. This should never happen in production: there can't
+        # be two open PRs for the same base and head branch, so get() raises
+        # AssertionError.
+        stream.return_value = iter([record, record.replace("1", "2", 1)])
+
+        with pytest.raises(AssertionError):
+            PullRequest.get(
+                base_repo, sentinel.base_branch, head_repo, sentinel.head_branch
+            )
+
+    def test_get_upserted(self, base_repo, head_repo, stream, record):
+        # The filtering is done by gh's jq so stream() only returns matching PRs.
+        stream.return_value = iter([record])
+
+        pull_requests = PullRequest.get_upserted(base_repo, head_repo)
+
+        stream.assert_called_once_with(
+            [
+                "gh",
+                "api",
+                "--header",
+                "X-GitHub-Api-Version:2022-11-28",
+                "--paginate",
+                "--method",
+                "GET",
+                f"/repos/{base_repo.owner}/{base_repo.name}/pulls",
+                "-f",
+                "state=open",
+                "-f",
+                "per_page=100",
+                "--jq",
+                f'.[] | select(.head.repo.full_name == "{head_repo.name_with_owner}")'
+                f' | select(.body // "" | contains("{PR_MARKER}")) | {PR_RECORD_JQ}',
+            ]
+        )
+        assert pull_requests == [PullRequest.from_record(base_repo, head_repo, record)]
+
+    @pytest.mark.parametrize(
+        "title,body,expected_fields",
+        [
+            ("new_title", "old_body", {"title": "new_title"}),
+            ("old_title", "new_body", {"body": f"new_body\n\n{PR_MARKER}"}),
+            (
+                "new_title",
+                "new_body",
+                {"title": "new_title", "body": f"new_body\n\n{PR_MARKER}"},
+            ),
+        ],
+    )
+    def test_update(
+        self, pull_request_factory, run, record, title, body, expected_fields
+    ):  # pylint:disable=too-many-positional-arguments
+        pull_request = pull_request_factory(
+            raw_json=json.dumps(
+                {"title": "old_title", "body": f"old_body\n\n{PR_MARKER}"}
+            )
+        )
+        run.return_value = record
+
+        updated_pull_request = pull_request.update(title, body)
+
+        run.assert_called_once_with(
+            [
+                "gh",
+                "api",
+                "--header",
+                "X-GitHub-Api-Version:2022-11-28",
+                "--method",
+                "PATCH",
+                f"/repos/{pull_request.base_repo.owner}/{pull_request.base_repo.name}/pulls/{pull_request.number}",
+                "--input",
+                "-",
+                "--jq",
+                PR_RECORD_JQ,
+            ],
+            json_input=expected_fields,
+        )
+        assert updated_pull_request == PullRequest.from_record(
+            pull_request.base_repo, pull_request.head_repo, record
+        )
+
+    def test_update_doesnt_send_a_request_if_nothing_has_changed(
+        self, pull_request_factory, run
+    ):
+        pull_request = pull_request_factory(
+            raw_json=json.dumps({"title": "title", "body": f"body\n\n{PR_MARKER}"})
+        )
+
+        assert pull_request.update("title", "body") is pull_request
+        run.assert_not_called()
+
+    def test_changed_fields_only_decodes_the_json_once(
+        self, mocker, pull_request_factory
+    ):
+        pull_request = pull_request_factory(
+            raw_json=json.dumps({"title": "title", "body": "body"})
+        )
+        loads = mocker.spy(json, "loads")
+
+        assert pull_request.changed_fields("new_title", "body") == {
+            "title": "new_title",
+            "body": f"body\n\n{PR_MARKER}",
+        }
+        loads.assert_called_once_with(pull_request.raw_json)
+
+    def test_configure(self, pull_request, graphql):
+        pull_request.configure(
+            label_ids=["LABEL_1", "LABEL_2"],
+            reviewer_ids=["REVIEWER"],
+            team_reviewer_ids=["TEAM"],
+            assignee_ids=["ASSIGNEE"],
+            auto_merge="SQUASH",
+        )
+
+        graphql.assert_called_once()
+        query, variables = graphql.call_args[0]
+        assert query.startswith(
+            "mutation($pr: ID!, $label0: ID!, $label1: ID!, $reviewer0: ID!, "
+            "$team0: ID!, $assignee0: ID!, $mergeMethod: PullRequestMergeMethod!)"
+        )
+        assert "labelIds: [$label0, $label1]" in query
+        assert "userIds: [$reviewer0], teamIds: [$team0]" in query
+        assert "assigneeIds: [$assignee0]" in query
+        assert "enablePullRequestAutoMerge(" in query
+        assert variables == {
+            "pr": pull_request.node_id,
+            "label0": "LABEL_1",
+            "label1": "LABEL_2",
+            "reviewer0": "REVIEWER",
+            "team0": "TEAM",
+            "assignee0": "ASSIGNEE",
+            "mergeMethod": "SQUASH",
+        }
+
+    def test_configure_only_sends_the_mutations_that_are_needed(
+        self, pull_request, graphql
+    ):
+        pull_request.configure(label_ids=["LABEL"])
+
+        query, variables = graphql.call_args[0]
+        assert "addLabelsToLabelable(" in query
+        assert "requestReviews(" not in query
+        assert "addAssigneesToAssignable(" not in query
+        assert "enablePullRequestAutoMerge(" not in query
+        assert variables == {"pr": pull_request.node_id, "label0": "LABEL"}
+
+    def test_configure_does_nothing_if_theres_nothing_to_do(
+        self, pull_request, graphql
+    ):
+        pull_request.configure()
+
+        graphql.assert_not_called()
+
+    def test_pushed(self, pull_request):
+        pushed = pull_request.pushed("new_sha")
+
+        assert pushed.head_sha == "new_sha"
+        assert pushed == replace(pull_request, head_sha="new_sha")
+        assert pull_request.head_sha != "new_sha"
+
+    def test_close(self, pull_request, close_many):
+        pull_request.close(sentinel.comment)
+
+        close_many.assert_called_once_with([pull_request], sentinel.comment)
+
+    def test_close_many(self, pull_request_factory, graphql):
+        pull_requests = pull_request_factory.create_batch(2)
+
+        PullRequest.close_many(pull_requests, sentinel.comment)
+
+        graphql.assert_called_once()
+        query, variables = graphql.call_args[0]
+        # It sends a single mutation that comments on, closes and deletes the
+        # head branch of every PR.
+        for i in range(2):
+            assert f"comment{i}: addComment(" in query
+            assert f"close{i}: closePullRequest(" in query
+            assert f"deleteBranch{i}: updateRefs(" in query
+        assert variables == {
+            "comment": sentinel.comment,
+            "pr0": pull_requests[0].node_id,
+            "repo0": pull_requests[0].head_repo.node_id,
+            "ref0": f"refs/heads/{pull_requests[0].head_branch}",
+            "sha0": pull_requests[0].head_sha,
+            "pr1": pull_requests[1].node_id,
+            "repo1": pull_requests[1].head_repo.node_id,
+            "ref1": f"refs/heads/{pull_requests[1].head_branch}",
+            "sha1": pull_requests[1].head_sha,
+        }
+
+    def test_close_mutations_variable_types(self, pull_request_factory):
+        query, _ = PullRequest.close_mutation(
+            pull_request_factory.create_batch(2), sentinel.comment
+        )
+
+        # GitHub rejects the whole mutation if a variable's declared type
+        # doesn't match the type of the input field that it's used for.
+        declarations = dict(re.findall(r"\$(\w+): ([\w!]+)", query[: query.index(")")]))
+        assert declarations == {
+            "comment": "String!",
+            **{
+                f"{name}{i}": type_
+                for i in range(2)
+                for name, type_ in [
+                    ("pr", "ID!"),
+                    ("repo", "ID!"),
+                    ("ref", "GitRefname!"),
+                    ("sha", "GitObjectID!"),
+                ]
+            },
+        }
+        assert set(re.findall(r"\$(\w+)", query)) == set(declarations)
+
+    def test_close_many_does_nothing_if_there_are_no_prs(self, graphql):
+        PullRequest.close_many([], sentinel.comment)
+
+        graphql.assert_not_called()
+
+    @pytest.fixture
+    def close_many(self, mocker):
+        return mocker.patch("gh_pr_upsert.github.PullRequest.close_many", autospec=True)
+
+    @pytest.fixture
+    def graphql(self, mocker):
+        return mocker.patch("gh_pr_upsert.github.graphql", autospec=True)
+
+    @pytest.fixture
+    def get_node_ids(self, mocker):
+        return mocker.patch(
+            "gh_pr_upsert.github.get_node_ids", autospec=True, return_value=({}, {}, {})
+        )
+
+    @pytest.fixture
+    def configure(self, mocker):
+        return mocker.patch("gh_pr_upsert.github.PullRequest.configure", autospec=True)
+
+    @pytest.fixture
+    def record(self):
+        """Return a PR as output by `gh api --jq PR_RECORD_JQ`."""
+        return "\0".join(
+            [
+                "1",
+                "PR_1",
+                "main",
+                "branch",
+                "abc",
+                "https://github.com/owner/repo/pull/1",
+                "2024-01-01T00:00:00Z",
+                '{"title": "Title", "body": "Body\\u0000"}',
+            ]
+        )
+
+
+class TestGetNodeIDs:
+    def test_it(self, git_hub_repo, graphql):
+        graphql.return_value = {
+            "repository": {"label0": {"id": "LABEL_ID"}},
+            "user0": {"id": "USER_ID"},
+            "org0": {"team": {"id": "TEAM_ID"}},
+        }
+
+        node_ids = get_node_ids(
+            git_hub_repo, ["label", "label"], ["user", "user"], ["org/team"]
+        )
+
+        graphql.assert_called_once_with(
+            "query($owner: String!, $name: String!, $label0: String!, "
+            "$user0: String!, $org0: String!, $team0: String!) { "
+            "repository(owner: $owner, name: $name) { label0: label(name: $label0) { id } } "
+            "user0: user(login: $user0) { id } "
+            "org0: organization(login: $org0) { team(slug: $team0) { id } } }",
+            {
+                "owner": git_hub_repo.owner,
+                "name": git_hub_repo.name,
+                "label0": "label",
+                "user0": "user",
+                "org0": "org",
+                "team0": "team",
+            },
+        )
+        assert node_ids == (
+            {"label": "LABEL_ID"},
+            {"user": "USER_ID"},
+            {"org/team": "TEAM_ID"},
+        )
+
+    def test_it_only_queries_the_repo_if_there_are_labels(self, git_hub_repo, graphql):
+        graphql.return_value = {"user0": {"id": "USER_ID"}}
+
+        node_ids = get_node_ids(git_hub_repo, [], ["user"], [])
+
+        graphql.assert_called_once_with(
+            "query($user0: String!) { user0: user(login: $user0) { id } }",
+            {"user0": "user"},
+        )
+        assert node_ids == ({}, {"user": "USER_ID"}, {})
+
+    def test_it_doesnt_send_a_query_if_theres_nothing_to_look_up(
+        self, git_hub_repo, graphql
+    ):
+        assert get_node_ids(git_hub_repo, [], [], []) == ({}, {}, {})
+
+        graphql.assert_not_called()
+
+    def test_it_raises_if_something_isnt_found(self, git_hub_repo, graphql):
+        graphql.return_value = {"repository": {"label0": None}}
+
+        with pytest.raises(NotFoundError) as exc_info:
+            get_node_ids(git_hub_repo, ["label"], [], [])
+
+        assert exc_info.value.message == "Couldn't find the label 'label'"
+
+    @pytest.fixture
+    def graphql(self, mocker):
+        return mocker.patch("gh_pr_upsert.github.graphql", autospec=True)
+
+
+class TestGraphQL:
+    def test_it(self, run):
+        run.return_value = {"data": sentinel.data}
+
+        data = graphql("test_query", {"foo": "FOO", "bar": "BAR"})
+
+        run.assert_called_once_with(
+            ["gh", "api", "graphql", "--input", "-"],
+            json=True,
+            json_input={
+                "query": "test_query",
+                "variables": {"foo": "FOO", "bar": "BAR"},
+            },
+        )
+        assert data == sentinel.data
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    yield
+
+    PullRequest.get.cache_clear()
+    GitHubRepo.get.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def run(mocker):
+    return mocker.patch("gh_pr_upsert.github.run", autospec=True)
+
+
+@pytest.fixture
+def stream(mocker):
+    return mocker.patch("gh_pr_upsert.github.stream", autospec=True)
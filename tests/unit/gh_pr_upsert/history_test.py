@@ -0,0 +1,185 @@
+import os
+from subprocess import CalledProcessError
+from unittest.mock import call
+
+import pytest
+
+from gh_pr_upsert import history
+from gh_pr_upsert.exceptions import TimedOutError
+from gh_pr_upsert.history import bitmaps_are_stale, bound, maintain, use_history_indexes
+
+
+class TestMaintain:
+    def test_it(self, run, git, tmp_path):
+        (tmp_path / "pack-1.pack").touch()
+
+        maintain()
+
+        git.git_paths.assert_called_once_with("objects/pack")
+        assert run.call_args_list == [
+            call(
+                [
+                    "git",
+                    "commit-graph",
+                    "write",
+                    "--reachable",
+                    "--split",
+                    "--changed-paths",
+                ]
+            ),
+            call(["git", "multi-pack-index", "write", "--bitmap"]),
+        ]
+
+    def test_it_doesnt_rewrite_bitmaps_that_are_up_to_date(self, run, tmp_path):
+        (tmp_path / "pack-1.pack").touch()
+        set_mtime(tmp_path / "pack-1.pack", 1)
+        (tmp_path / "multi-pack-index-1.bitmap").touch()
+        set_mtime(tmp_path / "multi-pack-index-1.bitmap", 2)
+
+        maintain()
+
+        assert run.call_count == 1
+
+    @pytest.mark.parametrize(
+        "error",
+        [
+            # For example because another worktree's run is writing them too.
+            CalledProcessError(128, ["git"]),
+            # Because writing them takes longer than --timeout allows.
+            TimedOutError("git timed out"),
+        ],
+    )
+    def test_it_carries_on_if_git_fails_to_write_them(self, run, tmp_path, error):
+        (tmp_path / "pack-1.pack").touch()
+        run.side_effect = error
+
+        maintain()
+
+        assert run.call_count == 2
+
+    @pytest.fixture(autouse=True)
+    def git(self, git, tmp_path):
+        git.git_paths.return_value = [str(tmp_path)]
+        return git
+
+
+class TestBitmapsAreStale:
+    @pytest.mark.parametrize(
+        "files,stale",
+        [
+            ({}, False),
+            ({"pack-1.pack": 1}, True),
+            ({"pack-1.pack": 1, "multi-pack-index-1.bitmap": 2}, False),
+            (
+                {"pack-1.pack": 1, "pack-2.pack": 3, "multi-pack-index-1.bitmap": 2},
+                True,
+            ),
+        ],
+    )
+    def test_it(self, tmp_path, files, stale):
+        for name, mtime in files.items():
+            (tmp_path / name).touch()
+            set_mtime(tmp_path / name, mtime)
+
+        assert bitmaps_are_stale(str(tmp_path)) == stale
+
+
+class TestBound:
+    def test_it(self, run, maintain):
+        run.return_value = "sha_1\nsha_2\n"
+
+        assert bound(("head", "^local", "^base")) == ("head", "^sha_1", "^sha_2")
+        maintain.assert_called_once_with()
+        run.assert_called_once_with(
+            ["git", "merge-base", "--all", "head", "local", "base"]
+        )
+
+    def test_it_finds_the_merge_bases_of_each_positive_rev(self, run):
+        run.side_effect = ["sha_1\n", "sha_1\nsha_2\n"]
+
+        assert bound(("a", "b", "^base")) == ("a", "b", "^sha_1", "^sha_2")
+        assert run.call_args_list == [
+            call(["git", "merge-base", "--all", "a", "base"]),
+            call(["git", "merge-base", "--all", "b", "base"]),
+        ]
+
+    def test_it_doesnt_maintain_a_clone_again_if_maintaining_it_failed(
+        self, run, maintain
+    ):
+        run.return_value = "sha\n"
+        # For example `git rev-parse --git-path` timing out.
+        maintain.side_effect = [TimedOutError("git timed out"), None]
+
+        with pytest.raises(TimedOutError):
+            bound(("head", "^base"))
+        bound(("head", "^base"))
+
+        maintain.assert_called_once_with()
+
+    def test_it_only_maintains_each_clone_once(self, run, maintain, git):
+        run.return_value = "sha\n"
+
+        bound(("head", "^base"))
+        bound(("head", "^base"))
+        git.common_dir.return_value = "/other/.git"
+        bound(("head", "^base"))
+
+        assert maintain.call_count == 2
+
+    @pytest.mark.parametrize("revs", [("head",), ("^base",)])
+    def test_it_doesnt_bound_walks_without_positive_and_negative_revs(
+        self, run, maintain, revs
+    ):
+        assert bound(revs) == revs
+        maintain.assert_not_called()
+        run.assert_not_called()
+
+    def test_it_doesnt_bound_walks_if_the_merge_bases_cant_be_found(self, run):
+        run.side_effect = CalledProcessError(128, ["git", "merge-base"])
+
+        assert bound(("head", "^missing")) == ("head", "^missing")
+
+    def test_it_does_nothing_unless_its_turned_on(self, run, maintain):
+        use_history_indexes(False)
+
+        assert bound(("head", "^base")) == ("head", "^base")
+        maintain.assert_not_called()
+        run.assert_not_called()
+
+    @pytest.fixture(autouse=True)
+    def enabled(self):
+        previous = use_history_indexes(True)
+        yield
+        use_history_indexes(previous)
+
+    @pytest.fixture(autouse=True)
+    def maintained(self, monkeypatch):
+        monkeypatch.setattr(history, "_maintained", set())
+
+    @pytest.fixture(autouse=True)
+    def maintain(self, mocker):
+        return mocker.patch("gh_pr_upsert.history.maintain", autospec=True)
+
+    @pytest.fixture(autouse=True)
+    def git(self, git):
+        git.common_dir.return_value = "/repo/.git"
+        return git
+
+
+def test_use_history_indexes():
+    assert not use_history_indexes(True)
+    assert use_history_indexes(False)
+
+
+def set_mtime(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture(autouse=True)
+def run(mocker):
+    return mocker.patch("gh_pr_upsert.history.run", autospec=True, return_value="")
+
+
+@pytest.fixture
+def git(mocker):
+    return mocker.patch("gh_pr_upsert.history.git", autospec=True)
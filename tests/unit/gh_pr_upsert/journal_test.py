@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from gh_pr_upsert.journal import Journal, options_digest, ref_shas
+
+
+class TestJournal:
+    def test_completed(self, path):
+        Journal(path).finish("key", "digest", ["refs/heads/a"], {"action": "pushed"})
+
+        assert Journal(path).completed("key", "digest") == {"action": "pushed"}
+
+    def test_completed_returns_None_for_unknown_entries(self, path):
+        assert Journal(path).completed("key", "digest") is None
+
+    def test_completed_returns_None_for_interrupted_entries(self, path):
+        journal = Journal(path)
+        journal.finish("key", "digest", ["refs/heads/a"], {"action": "pushed"})
+        journal.start("key", "digest")
+
+        assert Journal(path).completed("key", "digest") is None
+
+    def test_completed_returns_None_if_the_entry_has_changed(self, path):
+        Journal(path).finish("key", "digest", ["refs/heads/a"], {"action": "pushed"})
+
+        assert Journal(path).completed("key", "other_digest") is None
+
+    def test_completed_returns_None_if_a_branch_has_changed(self, path, ref_shas):
+        Journal(path).finish("key", "digest", ["refs/heads/a"], {"action": "pushed"})
+
+        ref_shas.side_effect = lambda *refs: {ref: "new_sha" for ref in refs}
+
+        assert Journal(path).completed("key", "digest") is None
+
+    def test_it_ignores_records_cut_short_by_a_crash(self, path):
+        Journal(path).finish("key", "digest", ["refs/heads/a"], {"action": "pushed"})
+        with open(path, "a", encoding="utf-8") as journal_file:
+            journal_file.write('{"key": "key", "sta')
+
+        assert Journal(path).completed("key", "digest") == {"action": "pushed"}
+
+    def test_it_writes_ahead(self, path, ref_shas):
+        journal = Journal(path)
+
+        journal.start("key", "digest")
+        journal.finish("key", "digest", ["refs/heads/a"], {"action": "pushed"})
+
+        with open(path, encoding="utf-8") as journal_file:
+            assert [json.loads(line) for line in journal_file] == [
+                {"key": "key", "state": "pending", "digest": "digest"},
+                {
+                    "key": "key",
+                    "state": "done",
+                    "digest": "digest",
+                    "refs": {"refs/heads/a": "sha_refs/heads/a"},
+                    "result": {"action": "pushed"},
+                },
+            ]
+        ref_shas.assert_called_with("refs/heads/a")
+
+    @pytest.fixture
+    def path(self, tmp_path):
+        return str(tmp_path / "journal.jsonl")
+
+    @pytest.fixture(autouse=True)
+    def ref_shas(self, mocker):
+        return mocker.patch(
+            "gh_pr_upsert.journal.ref_shas",
+            autospec=True,
+            side_effect=lambda *refs: {ref: f"sha_{ref}" for ref in refs},
+        )
+
+
+def test_options_digest():
+    assert options_digest({"a": 1, "b": [2]}) == options_digest({"b": [2], "a": 1})
+    assert options_digest({"a": 1}) != options_digest({"a": 2})
+
+
+def test_ref_shas(mocker):
+    run = mocker.patch(
+        "gh_pr_upsert.journal.run",
+        autospec=True,
+        return_value="refs/heads/a\0sha_a\nrefs/heads/a/b\0sha_a_b\n",
+    )
+
+    assert ref_shas("refs/heads/a", "refs/remotes/origin/a") == {
+        "refs/heads/a": "sha_a",
+        "refs/remotes/origin/a": None,
+    }
+    run.assert_called_once_with(
+        [
+            "git",
+            "for-each-ref",
+            "--format=%(refname)%00%(objectname)",
+            "refs/heads/a",
+            "refs/remotes/origin/a",
+        ]
+    )
@@ -0,0 +1,83 @@
+import importlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from gh_pr_upsert.lazy import lazy_import
+
+
+def test_it_doesnt_load_the_module_until_its_used(package):
+    module = lazy_import("lazy_test_package.module")
+
+    assert sys.modules["lazy_test_package.module"] is module
+    assert sys.modules["lazy_test_package"].module is module
+    assert "loaded" not in package
+
+    assert module.VALUE == 42
+    assert package == ["loaded"]
+
+
+def test_it_is_thread_safe(package, tmp_path):
+    # A module that's slow to load, so that other threads try to use it while
+    # the first one is still loading it.
+    (tmp_path / "lazy_test_package" / "module.py").write_text(
+        "import builtins, time\n"
+        "builtins.lazy_test_loads.append('loaded')\n"
+        "time.sleep(0.1)\n"
+        "VALUE = 42\n"
+    )
+    module = lazy_import("lazy_test_package.module")
+
+    with ThreadPoolExecutor(8) as executor:
+        values = list(executor.map(lambda _: module.VALUE, range(8)))
+
+    assert values == [42] * 8
+    assert package == ["loaded"]
+
+
+def test_it_returns_modules_that_have_already_been_imported(package):
+    module = importlib.import_module("lazy_test_package.module")
+
+    assert lazy_import("lazy_test_package.module") is module
+    assert package == ["loaded"]
+
+
+def test_it_imports_modules_normally_if_their_loader_cant_be_lazy(package, mocker):
+    find_spec = mocker.patch(
+        "gh_pr_upsert.lazy.importlib.util.find_spec", autospec=True
+    )
+    find_spec.return_value.loader = object()
+
+    module = lazy_import("lazy_test_package.module")
+
+    assert package == ["loaded"]
+    assert module.VALUE == 42
+
+
+def test_it_imports_top_level_modules(tmp_path, monkeypatch):
+    (tmp_path / "lazy_test_module.py").write_text("VALUE = 42\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "lazy_test_module", raising=False)
+
+    assert lazy_import("lazy_test_module").VALUE == 42
+
+    del sys.modules["lazy_test_module"]
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    """Make an importable package whose submodule records when it's loaded."""
+    loads = []
+    (tmp_path / "lazy_test_package").mkdir()
+    (tmp_path / "lazy_test_package" / "__init__.py").write_text("")
+    (tmp_path / "lazy_test_package" / "module.py").write_text(
+        "import builtins\nbuiltins.lazy_test_loads.append('loaded')\nVALUE = 42\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr("builtins.lazy_test_loads", loads, raising=False)
+
+    yield loads
+
+    for name in ("lazy_test_package.module", "lazy_test_package"):
+        sys.modules.pop(name, None)
@@ -0,0 +1,706 @@
+import json
+import os
+from dataclasses import asdict, replace
+from subprocess import CalledProcessError
+from unittest.mock import call, create_autospec, sentinel
+
+import pytest
+
+from gh_pr_upsert.core import Action, Plan, Result
+from gh_pr_upsert.exceptions import (
+    BatchError,
+    ManifestError,
+    NoChangesError,
+    OtherPeopleError,
+    SameBranchError,
+    TimedOutError,
+)
+from gh_pr_upsert.git import PullRequest
+from gh_pr_upsert.journal import Journal
+from gh_pr_upsert.manifest import (
+    ENTRY_FIELDS,
+    Entry,
+    EntryResult,
+    chdir,
+    in_shard,
+    parse_shard,
+    plan_all,
+    plan_entry,
+    read,
+    resume_entry,
+    upsert_all,
+    upsert_entry,
+)
+
+
+class TestRead:
+    def test_it(self, tmp_path):
+        path = write_manifest(
+            tmp_path,
+            '{"local_branch": "a"}',
+            "",
+            '{"local_branch": "b", "head_branch": "c", "directory": "repo", "labels": ["x"]}',
+        )
+
+        entries = read(
+            path,
+            defaults={
+                "title": "Title",
+                "body": "Body",
+                "close_comment": "Closing",
+                "labels": ["default"],
+            },
+        )
+
+        assert entries == [
+            make_entry(
+                index=0,
+                directory=".",
+                local_branch="a",
+                head_branch="a",
+                title="Title",
+                labels=("default",),
+            ),
+            make_entry(
+                index=1,
+                directory="repo",
+                local_branch="b",
+                head_branch="c",
+                title="Title",
+                labels=("x",),
+            ),
+        ]
+
+    @pytest.mark.parametrize("auto_merge", ["squash", "REBASE", None])
+    def test_auto_merge(self, tmp_path, auto_merge):
+        path = write_manifest(
+            tmp_path, json.dumps({"local_branch": "a", "auto_merge": auto_merge})
+        )
+
+        assert read(path, defaults={})[0].auto_merge == auto_merge
+
+    @pytest.mark.parametrize(
+        "line",
+        [
+            '{"local_branch": "a", "base_branch": "dev"}',
+            '{"local_branch": "a", "head_remote": "fork"}',
+        ],
+    )
+    def test_it_allows_prs_from_the_same_branch_to_other_bases_or_remotes(
+        self, tmp_path, line
+    ):
+        path = write_manifest(tmp_path, '{"local_branch": "a"}', line)
+
+        assert len(read(path, defaults={})) == 2
+
+    def test_local_branch_can_come_from_the_defaults(self, tmp_path):
+        path = write_manifest(tmp_path, '{"directory": "repo"}')
+
+        entries = read(path, defaults={"local_branch": "main"})
+
+        assert entries[0].local_branch == entries[0].head_branch == "main"
+
+    @pytest.mark.parametrize(
+        "line,message",
+        [
+            ("{", "invalid JSON"),
+            ("[]", "entries must be JSON objects"),
+            (
+                '{"local_branch": "a", "foo": 1, "bar": 2}',
+                "unknown fields: 'bar', 'foo'",
+            ),
+            ('{"title": "Title"}', "no local_branch"),
+            (
+                '{"local_branch": "b", "paths": "src"}',
+                "paths must be a list of strings",
+            ),
+            (
+                '{"local_branch": "b", "labels": "frontend"}',
+                "labels must be a list of strings",
+            ),
+            (
+                '{"local_branch": "b", "reviewers": ["a", 1]}',
+                "reviewers must be a list of strings",
+            ),
+            (
+                '{"local_branch": "b", "assignees": {"a": 1}}',
+                "assignees must be a list of strings",
+            ),
+            (
+                '{"local_branch": "b", "auto_merge": "fast-forward"}',
+                "auto_merge must be one of: merge, squash, rebase",
+            ),
+            (
+                '{"local_branch": "b", "auto_merge": true}',
+                "auto_merge must be one of: merge, squash, rebase",
+            ),
+            ('{"local_branch": "b", "head_branch": "a"}', "same PR as line 1"),
+            ('{"local_branch": "a", "directory": "./"}', "same PR as line 1"),
+        ],
+    )
+    def test_it_raises_if_the_manifest_is_invalid(self, tmp_path, line, message):
+        path = write_manifest(tmp_path, '{"local_branch": "a"}', line)
+
+        with pytest.raises(ManifestError) as exc_info:
+            read(path, defaults={})
+
+        assert exc_info.value.message.startswith(f"{path}:2: {message}")
+
+
+class TestEntry:
+    def test_key(self):
+        assert (
+            make_entry(
+                directory="./repo/", base_branch="main", head_branch="branch"
+            ).key
+            == "repo\0origin\0main\0origin\0branch"
+        )
+
+    def test_digest_ignores_where_the_entry_is_in_the_manifest(self):
+        assert (
+            make_entry(index=0, directory="repo").digest
+            == make_entry(index=5, directory="./repo/").digest
+        )
+
+    def test_digest_changes_when_the_options_do(self):
+        assert make_entry(title="A").digest != make_entry(title="B").digest
+
+
+class TestParseShard:
+    @pytest.mark.parametrize("shard,expected", [("1/1", (1, 1)), ("3/4", (3, 4))])
+    def test_it(self, shard, expected):
+        assert parse_shard(shard) == expected
+
+    @pytest.mark.parametrize("shard", ["1", "1/", "/2", "a/2", "0/2", "3/2", "1/0"])
+    def test_it_raises_if_the_shard_is_invalid(self, shard):
+        with pytest.raises(ValueError):
+            parse_shard(shard)
+
+
+class TestInShard:
+    def test_each_entry_is_in_exactly_one_shard(self):
+        entries = [
+            make_entry(directory=f"repo-{i % 7}", head_branch=f"branch-{i}")
+            for i in range(200)
+        ]
+
+        shards = [
+            [entry for entry in entries if in_shard(entry, (index, 4))]
+            for index in range(1, 5)
+        ]
+
+        assert sorted(
+            (entry for shard in shards for entry in shard), key=lambda e: e.head_branch
+        ) == sorted(entries, key=lambda e: e.head_branch)
+        # The hash spreads the entries out over all the shards.
+        assert all(shards)
+
+    def test_it_is_stable(self):
+        # The same entry is always in the same shard, whatever process is
+        # asking and however it's written.
+        assert in_shard(make_entry(directory="repo", head_branch="branch"), (1, 3))
+        assert in_shard(make_entry(directory="./repo/", head_branch="branch"), (1, 3))
+
+    def test_it_ignores_everything_but_the_base_repo_and_head_branch(self):
+        entry = make_entry(directory="repo", head_branch="branch")
+
+        assert in_shard(
+            make_entry(
+                directory="repo",
+                base_branch="dev",
+                head_branch="branch",
+                local_branch="other",
+                index=5,
+            ),
+            (2, 3),
+        ) == in_shard(entry, (2, 3))
+
+
+class TestUpsertAll:
+    def test_it(self, tmp_path, upsert_entry, entries, git):
+        results = upsert_all(entries)
+
+        # Each clone's entries are done together, with the caches cleared
+        # before moving to a different clone.
+        assert upsert_entry.call_args_list == [
+            call(entries[0], (1, 1)),
+            call(entries[2], (1, 1)),
+            call(entries[1], (1, 1)),
+        ]
+        assert upsert_entry.cwds == [
+            str(tmp_path / "repo-1"),
+            str(tmp_path / "repo-1"),
+            str(tmp_path / "repo-2"),
+        ]
+        assert git.cached_functions.return_value[0].cache_clear.call_count == 2
+        assert results == [upsert_entry.results[index] for index in (0, 2, 1)]
+
+    @pytest.mark.usefixtures("upsert_entry")
+    def test_it_only_upserts_the_entries_in_the_shard(self, entries):
+        results = upsert_all(entries, shard=(1, 2))
+
+        assert {result.index for result in results} == {
+            entry.index for entry in entries if in_shard(entry, (1, 2))
+        }
+        assert len(results) < len(entries)
+
+    def test_it_writes_a_summary_file(self, tmp_path, upsert_entry, entries):
+        summary_file = tmp_path / "summary.jsonl"
+        summary_file.write_text('{"from": "another shard"}\n')
+
+        upsert_all(entries, summary_file=str(summary_file))
+
+        assert [json.loads(line) for line in summary_file.read_text().splitlines()] == [
+            {"from": "another shard"},
+            *(
+                json.loads(json.dumps(upsert_entry.results[index].__dict__))
+                for index in (0, 2, 1)
+            ),
+        ]
+
+    def test_it_journals(self, tmp_path, mocker, upsert_entry, entries):
+        resume_entry = mocker.patch(
+            "gh_pr_upsert.manifest.resume_entry",
+            autospec=True,
+            side_effect=lambda _progress, entry, shard: upsert_entry(entry, shard),
+        )
+        journal_file = str(tmp_path / "journal.jsonl")
+
+        results = upsert_all(entries, journal_file=journal_file)
+
+        progress = resume_entry.call_args[0][0]
+        assert progress.path == journal_file
+        assert resume_entry.call_args_list == [
+            call(progress, entries[index], (1, 1)) for index in (0, 2, 1)
+        ]
+        assert results == [upsert_entry.results[index] for index in (0, 2, 1)]
+
+    def test_it_raises_if_any_entries_failed(self, upsert_entry, entries):
+        upsert_entry.results[1] = make_result(1, OtherPeopleError.exit_status)
+        upsert_entry.results[2] = make_result(2, NoChangesError.exit_status)
+
+        with pytest.raises(BatchError) as exc_info:
+            upsert_all(entries)
+
+        assert exc_info.value.message == "1 of 3 entries failed"
+        # The other entries are still done.
+        assert upsert_entry.call_count == 3
+
+    @pytest.fixture
+    def entries(self, tmp_path):
+        for name in ("repo-1", "repo-2"):
+            (tmp_path / name).mkdir()
+
+        return [
+            make_entry(index=0, directory="repo-1", head_branch="a"),
+            make_entry(index=1, directory="repo-2", head_branch="b"),
+            make_entry(index=2, directory="repo-1/", head_branch="c"),
+        ]
+
+    @pytest.fixture
+    def upsert_entry(self, mocker, monkeypatch, tmp_path):
+        monkeypatch.chdir(tmp_path)
+        results = {index: make_result(index) for index in range(3)}
+        cwds = []
+
+        def side_effect(entry, _shard):
+            cwds.append(os.getcwd())
+            return results[entry.index]
+
+        upsert_entry = mocker.patch(
+            "gh_pr_upsert.manifest.upsert_entry", autospec=True, side_effect=side_effect
+        )
+        upsert_entry.results = results
+        upsert_entry.cwds = cwds
+        return upsert_entry
+
+    @pytest.fixture(autouse=True)
+    def git(self, mocker):
+        git = mocker.patch("gh_pr_upsert.manifest.git", autospec=True)
+        git.cached_functions.return_value = [mocker.Mock()]
+        return git
+
+
+class TestUpsertEntry:
+    def test_it(
+        self, capsys, core, git, metrics, base_repo, head_repo
+    ):  # pylint:disable=too-many-positional-arguments
+        git.GitHubRepo.get.side_effect = [base_repo, head_repo]
+        entry = make_entry(
+            base_remote="upstream", head_remote="fork", auto_merge="squash"
+        )
+
+        result = upsert_entry(entry, (2, 3))
+
+        assert git.GitHubRepo.get.call_args_list == [call("upstream"), call("fork")]
+        core.upsert.assert_called_once_with(
+            base_repo,
+            base_repo.default_branch,
+            entry.local_branch,
+            head_repo,
+            entry.head_branch,
+            entry.title,
+            entry.body,
+            entry.close_comment,
+            draft=entry.draft,
+            labels=entry.labels,
+            reviewers=entry.reviewers,
+            assignees=entry.assignees,
+            auto_merge="SQUASH",
+            update=entry.update,
+            paths=entry.paths,
+        )
+        core.print_result.assert_called_once_with(core.upsert.return_value)
+        metrics.OUTCOMES.inc.assert_called_once_with(outcome="success")
+        assert not capsys.readouterr().out
+        assert result == EntryResult(
+            index=entry.index,
+            directory=entry.directory,
+            base_remote="upstream",
+            base_branch=base_repo.default_branch,
+            head_branch=entry.head_branch,
+            shard="2/3",
+            action="pushed",
+            url=core.upsert.return_value.url,
+            error=None,
+            exit_status=0,
+        )
+
+    def test_it_uses_the_entrys_base_branch(self, core):
+        upsert_entry(make_entry(base_branch="develop"), (1, 1))
+
+        assert core.upsert.call_args[0][1] == "develop"
+
+    def test_it_records_PRUpsertErrors(self, capsys, core, metrics):
+        core.print_result.side_effect = NoChangesError()
+
+        result = upsert_entry(make_entry(head_branch="branch"), (1, 1))
+
+        assert capsys.readouterr().out == f"repo: branch: {NoChangesError.message}\n"
+        metrics.OUTCOMES.inc.assert_called_once_with(outcome="NoChangesError")
+        assert result.action == "pushed"
+        assert result.error == NoChangesError.message
+        assert result.exit_status == NoChangesError.exit_status
+        assert not result.failed
+
+    @pytest.mark.parametrize(
+        "stderr,message", [(b"fatal: oops\n", "fatal: oops"), (None, None)]
+    )
+    def test_it_records_CalledProcessErrors(self, core, metrics, stderr, message):
+        error = CalledProcessError(128, ["git", "push"], stderr=stderr)
+        core.upsert.side_effect = error
+
+        result = upsert_entry(make_entry(), (1, 1))
+
+        metrics.OUTCOMES.inc.assert_called_once_with(outcome="CalledProcessError")
+        assert result.action is None
+        assert result.url is None
+        assert result.error == (message or str(error))
+        assert result.exit_status == 1
+        assert result.failed
+
+    def test_it_records_commands_that_timed_out(self, core, run):
+        core.upsert.side_effect = TimedOutError("Timed out after 5s: ['git']")
+        run.deadline_exceeded.return_value = False
+
+        result = upsert_entry(make_entry(), (1, 1))
+
+        assert result.exit_status == TimedOutError.exit_status
+
+    def test_it_stops_the_batch_if_the_deadline_has_passed(self, core, metrics, run):
+        core.upsert.side_effect = TimedOutError("Deadline exceeded")
+        run.deadline_exceeded.return_value = True
+
+        with pytest.raises(TimedOutError):
+            upsert_entry(make_entry(), (1, 1))
+
+        metrics.OUTCOMES.inc.assert_called_once_with(outcome="TimedOutError")
+
+    @pytest.fixture(autouse=True)
+    def core(self, mocker):
+        core = mocker.patch("gh_pr_upsert.manifest.core", autospec=True)
+        core.upsert.return_value = Result(
+            Action.PUSHED,
+            True,
+            create_autospec(PullRequest, instance=True),
+            sentinel.local_sha,
+            sentinel.base_sha,
+            sentinel.remote_sha,
+        )
+        return core
+
+    @pytest.fixture(autouse=True)
+    def git(self, mocker, base_repo):
+        git = mocker.patch("gh_pr_upsert.manifest.git", autospec=True)
+        git.GitHubRepo.get.return_value = base_repo
+        return git
+
+    @pytest.fixture(autouse=True)
+    def metrics(self, mocker):
+        return mocker.patch("gh_pr_upsert.manifest.metrics", autospec=True)
+
+
+class TestPlanAll:
+    def test_it(self, capsys, tmp_path, plan_entry, entries, git):
+        plans = plan_all(entries)
+
+        # Like upsert_all() each clone's entries are planned together.
+        assert sorted(plan_entry.call_args_list, key=lambda c: c[0][0].index) == [
+            call(entry) for entry in entries
+        ]
+        assert sorted(plan_entry.cwds) == [
+            str(tmp_path / "repo-1"),
+            str(tmp_path / "repo-1"),
+            str(tmp_path / "repo-2"),
+        ]
+        assert git.cached_functions.return_value[0].cache_clear.call_count == 2
+        # But the plans are always printed and returned in the same order.
+        assert plans == [{"index": index} for index in (0, 2, 1)]
+        assert capsys.readouterr().out == "".join(
+            f"{json.dumps(plan)}\n" for plan in plans
+        )
+
+    @pytest.mark.usefixtures("plan_entry")
+    def test_it_only_plans_the_entries_in_the_shard(self, entries):
+        plans = plan_all(entries, shard=(1, 2))
+
+        assert {plan["index"] for plan in plans} == {
+            entry.index for entry in entries if in_shard(entry, (1, 2))
+        }
+
+    @pytest.fixture
+    def entries(self, tmp_path):
+        for name in ("repo-1", "repo-2"):
+            (tmp_path / name).mkdir()
+
+        return [
+            make_entry(index=0, directory="repo-1", head_branch="a"),
+            make_entry(index=1, directory="repo-2", head_branch="b"),
+            make_entry(index=2, directory="repo-1/", head_branch="c"),
+        ]
+
+    @pytest.fixture
+    def plan_entry(self, mocker, monkeypatch, tmp_path):
+        monkeypatch.chdir(tmp_path)
+        cwds = []
+
+        def side_effect(entry):
+            cwds.append(os.getcwd())
+            return {"index": entry.index}
+
+        plan_entry = mocker.patch(
+            "gh_pr_upsert.manifest.plan_entry", autospec=True, side_effect=side_effect
+        )
+        plan_entry.cwds = cwds
+        return plan_entry
+
+    @pytest.fixture(autouse=True)
+    def git(self, mocker):
+        git = mocker.patch("gh_pr_upsert.manifest.git", autospec=True)
+        git.cached_functions.return_value = [mocker.Mock()]
+        return git
+
+
+class TestPlanEntry:
+    def test_it(self, core, git, base_repo, head_repo):
+        git.GitHubRepo.get.side_effect = [base_repo, head_repo]
+        entry = make_entry(base_remote="upstream", head_remote="fork", update=True)
+
+        entry_plan = plan_entry(entry)
+
+        assert git.GitHubRepo.get.call_args_list == [call("upstream"), call("fork")]
+        core.plan.assert_called_once_with(
+            base_repo,
+            base_repo.default_branch,
+            entry.local_branch,
+            head_repo,
+            entry.head_branch,
+            entry.title,
+            entry.body,
+            update=True,
+            paths=entry.paths,
+        )
+        assert entry_plan == {
+            "index": entry.index,
+            "directory": entry.directory,
+            "base_remote": "upstream",
+            "base_branch": base_repo.default_branch,
+            "head_branch": entry.head_branch,
+            "error": None,
+            **core.plan.return_value.to_dict(),
+        }
+
+    def test_it_uses_the_entrys_base_branch(self, core):
+        entry_plan = plan_entry(make_entry(base_branch="develop"))
+
+        assert core.plan.call_args[0][1] == "develop"
+        assert entry_plan["base_branch"] == "develop"
+
+    def test_it_records_PRUpsertErrors(self, core):
+        core.plan.side_effect = SameBranchError()
+
+        entry_plan = plan_entry(make_entry())
+
+        assert entry_plan["action"] is None
+        assert entry_plan["error"] == SameBranchError.message
+
+    def test_it_stops_the_batch_if_the_deadline_has_passed(self, core, run):
+        core.plan.side_effect = TimedOutError("Deadline exceeded")
+        run.deadline_exceeded.return_value = True
+
+        with pytest.raises(TimedOutError):
+            plan_entry(make_entry())
+
+    @pytest.mark.parametrize(
+        "stderr,message", [(b"fatal: oops\n", "fatal: oops"), (None, None)]
+    )
+    def test_it_records_CalledProcessErrors(self, core, stderr, message):
+        error = CalledProcessError(128, ["git", "fetch"], stderr=stderr)
+        core.plan.side_effect = error
+
+        entry_plan = plan_entry(make_entry())
+
+        assert entry_plan["action"] is None
+        assert entry_plan["error"] == (message or str(error))
+
+    @pytest.fixture(autouse=True)
+    def core(self, mocker):
+        core = mocker.patch("gh_pr_upsert.manifest.core", autospec=True)
+        core.plan.return_value = Plan(
+            Action.PUSHED,
+            "the remote branch doesn't have the changes",
+            True,
+            True,
+            None,
+            "local_sha",
+            "base_sha",
+            "remote_sha",
+        )
+        return core
+
+    @pytest.fixture(autouse=True)
+    def git(self, mocker, base_repo):
+        git = mocker.patch("gh_pr_upsert.manifest.git", autospec=True)
+        git.GitHubRepo.get.return_value = base_repo
+        return git
+
+
+class TestResumeEntry:
+    def test_it_upserts_new_entries(self, progress, upsert_entry):
+        entry = make_entry(local_branch="local", head_branch="head")
+
+        result = resume_entry(progress, entry, (1, 1))
+
+        upsert_entry.assert_called_once_with(entry, (1, 1))
+        assert result == upsert_entry.return_value
+        assert progress.records[entry.key]["refs"] == {
+            "refs/heads/local": "sha",
+            "refs/remotes/origin/head": "sha",
+            "refs/remotes/origin/main": "sha",
+        }
+        assert progress.records[entry.key]["result"] == asdict(result)
+
+    def test_it_skips_entries_that_are_already_done(
+        self, capsys, progress, upsert_entry
+    ):
+        resume_entry(progress, make_entry(index=3, head_branch="head"), (1, 1))
+        upsert_entry.reset_mock()
+
+        result = resume_entry(progress, make_entry(index=4, head_branch="head"), (2, 2))
+
+        upsert_entry.assert_not_called()
+        assert result == replace(
+            upsert_entry.return_value, index=4, shard="2/2", resumed=True
+        )
+        assert capsys.readouterr().out == "repo: head: unchanged, skipping\n"
+
+    def test_it_retries_entries_that_failed(self, progress, upsert_entry):
+        entry = make_entry()
+        upsert_entry.return_value = make_result(0, OtherPeopleError.exit_status)
+        resume_entry(progress, entry, (1, 1))
+        upsert_entry.return_value = make_result(0)
+
+        result = resume_entry(progress, entry, (1, 1))
+
+        assert upsert_entry.call_count == 2
+        assert result == upsert_entry.return_value
+
+    def test_it_doesnt_journal_the_base_branch_if_it_wasnt_found(
+        self, progress, upsert_entry
+    ):
+        entry = make_entry()
+        upsert_entry.return_value = replace(make_result(0), base_branch=None)
+
+        resume_entry(progress, entry, (1, 1))
+
+        assert list(progress.records[entry.key]["refs"]) == [
+            "refs/heads/local",
+            "refs/remotes/origin/head",
+        ]
+
+    @pytest.fixture
+    def progress(self, tmp_path, mocker):
+        mocker.patch(
+            "gh_pr_upsert.journal.ref_shas",
+            autospec=True,
+            side_effect=lambda *refs: dict.fromkeys(refs, "sha"),
+        )
+        return Journal(str(tmp_path / "journal.jsonl"))
+
+    @pytest.fixture
+    def upsert_entry(self, mocker):
+        return mocker.patch(
+            "gh_pr_upsert.manifest.upsert_entry",
+            autospec=True,
+            return_value=replace(make_result(0), base_branch="main"),
+        )
+
+
+@pytest.fixture
+def run(mocker):
+    return mocker.patch("gh_pr_upsert.manifest.run", autospec=True)
+
+
+def test_chdir(tmp_path):
+    cwd = os.getcwd()
+
+    with chdir(tmp_path):
+        assert os.getcwd() == str(tmp_path)
+
+    assert os.getcwd() == cwd
+
+
+def make_entry(**kwargs):
+    fields = {
+        **ENTRY_FIELDS,
+        "index": 0,
+        "directory": "repo",
+        "local_branch": "local",
+        "head_branch": "head",
+        "title": "Title",
+        "body": "Body",
+        "close_comment": "Closing",
+        **kwargs,
+    }
+    return Entry(**fields)
+
+
+def make_result(index, exit_status=0):
+    return EntryResult(
+        index=index,
+        directory="repo",
+        base_remote="origin",
+        base_branch=None,
+        head_branch="head",
+        shard="1/1",
+        action=None if exit_status else "created",
+        url=None,
+        error="error" if exit_status else None,
+        exit_status=exit_status,
+    )
+
+
+def write_manifest(tmp_path, *lines):
+    path = tmp_path / "manifest.jsonl"
+    path.write_text("".join(f"{line}\n" for line in lines))
+    return str(path)
@@ -0,0 +1,226 @@
+import asyncio
+import os
+import stat
+from functools import cache
+from unittest.mock import sentinel
+
+import pytest
+
+from gh_pr_upsert import metrics
+
+
+class TestCounter:
+    def test_it(self, counter):
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        counter.inc(kind="b")
+
+        assert list(counter.samples()) == [
+            ("test_counter_total", {"kind": "a"}, 3),
+            ("test_counter_total", {"kind": "b"}, 1),
+        ]
+
+    def test_set(self, counter):
+        counter.inc(kind="a")
+        counter.set(42, kind="a")
+
+        assert list(counter.samples()) == [("test_counter_total", {"kind": "a"}, 42)]
+
+    def test_reset(self, counter):
+        counter.inc(kind="a")
+
+        counter.reset()
+
+        assert not list(counter.samples())
+
+    @pytest.fixture
+    def counter(self):
+        return metrics.Counter("test_counter_total", "A test counter.", ["kind"])
+
+
+class TestHistogram:
+    def test_it(self, histogram):
+        histogram.observe(0.5, kind="a")
+        histogram.observe(2, kind="a")
+        histogram.observe(20, kind="a")
+
+        assert list(histogram.samples()) == [
+            ("test_seconds_bucket", {"kind": "a", "le": "1"}, 1),
+            ("test_seconds_bucket", {"kind": "a", "le": "10"}, 2),
+            ("test_seconds_bucket", {"kind": "a", "le": "+Inf"}, 3),
+            ("test_seconds_sum", {"kind": "a"}, 22.5),
+            ("test_seconds_count", {"kind": "a"}, 3),
+        ]
+
+    def test_reset(self, histogram):
+        histogram.observe(0.5, kind="a")
+
+        histogram.reset()
+
+        assert not list(histogram.samples())
+
+    @pytest.fixture
+    def histogram(self):
+        return metrics.Histogram(
+            "test_seconds", "A test histogram.", ["kind"], buckets=(1, 10)
+        )
+
+
+class TestAPIEndpoint:
+    @pytest.mark.parametrize(
+        "cmd,endpoint",
+        [
+            (["gh", "repo", "view", "--json", "name"], "repo view"),
+            (["gh", "api", "graphql", "--input", "-"], "graphql"),
+            (
+                ["gh", "api", "--method", "GET", "/repos/foo/bar/pulls", "-f", "x=y"],
+                "/repos/{owner}/{repo}/pulls",
+            ),
+            (
+                ["gh", "api", "--method", "PATCH", "/repos/foo/bar/pulls/23"],
+                "/repos/{owner}/{repo}/pulls/{number}",
+            ),
+            (
+                ["gh", "api", "/repos/foo/bar/compare/main...o:feature/x-123"],
+                "/repos/{owner}/{repo}/compare/{basehead}",
+            ),
+            (["gh", "api", "/user?per_page=1"], "/user"),
+        ],
+    )
+    def test_it(self, cmd, endpoint):
+        assert metrics.api_endpoint(cmd) == endpoint
+
+
+class TestRecordOutcome:
+    def test_it_records_successes(self):
+        function = metrics.record_outcome(lambda: sentinel.result)
+
+        assert function() == sentinel.result
+        assert metrics.OUTCOMES.values == {("success",): 1}
+
+    def test_it_records_exceptions(self):
+        @metrics.record_outcome
+        def function():
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            function()
+
+        assert metrics.OUTCOMES.values == {("ValueError",): 1}
+
+    def test_it_records_the_outcomes_of_coroutine_functions(self):
+        @metrics.record_outcome
+        async def succeed():
+            return sentinel.result
+
+        @metrics.record_outcome
+        async def fail():
+            raise ValueError()
+
+        assert asyncio.run(succeed()) == sentinel.result
+        with pytest.raises(ValueError):
+            asyncio.run(fail())
+
+        assert metrics.OUTCOMES.values == {("success",): 1, ("ValueError",): 1}
+
+
+def test_timed(mocker):
+    time = mocker.patch("gh_pr_upsert.metrics.time", autospec=True)
+    time.monotonic.side_effect = [100, 101.5]
+    timings = {}
+
+    with pytest.raises(ValueError):
+        with metrics.timed(timings, "step"):
+            raise ValueError()
+
+    assert timings == {"step": 1.5}
+
+
+def test_record_cache_info():
+    @cache
+    def cached_function(arg):
+        return arg
+
+    cached_function(1)
+    cached_function(1)
+    cached_function(2)
+
+    metrics.record_cache_info([cached_function])
+
+    function_name = "test_record_cache_info.<locals>.cached_function"
+    assert metrics.CACHE_HITS.values == {(function_name,): 1}
+    assert metrics.CACHE_MISSES.values == {(function_name,): 2}
+
+
+def test_to_text():
+    metrics.SUBPROCESSES.inc(program='git "quoted"\\\n')
+    metrics.DIFF_BYTES.inc(12345678)
+    metrics.PUSH_DURATION.observe(1.5)
+
+    text = metrics.to_text()
+
+    assert (
+        "# HELP gh_pr_upsert_subprocesses_total Subprocesses spawned, by program.\n"
+        "# TYPE gh_pr_upsert_subprocesses_total counter\n"
+        'gh_pr_upsert_subprocesses_total{program="git \\"quoted\\"\\\\\\n"} 1\n'
+    ) in text
+    assert "gh_pr_upsert_diff_bytes_total 12345678\n" in text
+    assert "gh_pr_upsert_push_duration_seconds_sum 1.5\n" in text
+
+
+def test_write_textfile(tmp_path):
+    metrics.DIFF_BYTES.inc(1024)
+    path = tmp_path / "gh_pr_upsert.prom"
+
+    metrics.write_textfile(str(path))
+
+    assert path.read_text(encoding="utf-8") == metrics.to_text()
+    assert [p.name for p in tmp_path.iterdir()] == ["gh_pr_upsert.prom"]
+
+
+@pytest.mark.parametrize("umask,mode", [(0o022, 0o644), (0o077, 0o600)])
+def test_write_textfile_mode(tmp_path, umask, mode):
+    path = tmp_path / "gh_pr_upsert.prom"
+    old_umask = os.umask(umask)
+
+    try:
+        metrics.write_textfile(str(path))
+    finally:
+        os.umask(old_umask)
+
+    assert stat.S_IMODE(path.stat().st_mode) == mode
+
+
+def test_write_textfile_cleans_up_if_it_fails(tmp_path, mocker):
+    mocker.patch("gh_pr_upsert.metrics.os.replace", side_effect=OSError)
+
+    with pytest.raises(OSError):
+        metrics.write_textfile(str(tmp_path / "gh_pr_upsert.prom"))
+
+    assert not list(tmp_path.iterdir())
+
+
+def test_push(urlopen):
+    metrics.push("http://pushgateway:9091/", job="my job")
+
+    request = urlopen.call_args[0][0]
+    assert request.full_url == "http://pushgateway:9091/metrics/job/my%20job"
+    assert request.get_method() == "PUT"
+    assert request.data == metrics.to_text().encode("utf-8")
+    assert request.get_header("Content-type") == "text/plain; version=0.0.4"
+    assert urlopen.call_args[1] == {"timeout": 10}
+
+
+@pytest.fixture
+def urlopen(mocker):
+    return mocker.patch("gh_pr_upsert.metrics.urllib_request.urlopen", autospec=True)
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    # Don't leave the test metrics created by these tests in the registry.
+    registry = list(metrics.REGISTRY)
+    metrics.reset()
+    yield
+    metrics.REGISTRY[:] = registry
+    metrics.reset()
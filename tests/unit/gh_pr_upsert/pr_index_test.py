@@ -0,0 +1,449 @@
+import hashlib
+import hmac
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from gh_pr_upsert import git
+from gh_pr_upsert.pr_index import SYNC_JQ, PRIndex, WebhookServer, replay
+
+
+class TestPRIndex:
+    def test_get(self, index, base_repo, head_repo):
+        index.apply(make_pr_json(base_repo, head_repo, number=7, title="Title"))
+
+        hit, pull_request = index.get(base_repo, "main", head_repo, "branch")
+
+        assert hit
+        assert pull_request.base_repo == base_repo
+        assert pull_request.head_repo == head_repo
+        assert pull_request.head_branch == "branch"
+        assert pull_request.number == 7
+        assert pull_request.node_id == "PR_7"
+        assert pull_request.base_branch == "main"
+        assert pull_request.head_sha == "sha-7"
+        assert (
+            pull_request.html_url
+            == f"https://github.com/{base_repo.name_with_owner}/pull/7"
+        )
+        assert pull_request.json == {"title": "Title", "body": "Body"}
+
+    def test_get_misses_if_the_pr_isnt_indexed(self, index, base_repo, head_repo):
+        assert index.get(base_repo, "main", head_repo, "branch") == (False, None)
+
+    def test_get_hits_if_the_repo_was_synced_and_the_pr_isnt_indexed(
+        self, index, base_repo, head_repo, stream
+    ):
+        stream.return_value = []
+        index.sync(base_repo.name_with_owner)
+
+        assert index.get(base_repo, "main", head_repo, "branch") == (True, None)
+
+    def test_get_misses_if_the_repo_was_synced_too_long_ago(
+        self, index, base_repo, head_repo, stream, now
+    ):
+        stream.return_value = []
+        index.sync(base_repo.name_with_owner)
+
+        now.return_value += index.max_age + 1
+
+        assert index.get(base_repo, "main", head_repo, "branch") == (False, None)
+
+    def test_get_misses_if_the_pr_was_indexed_too_long_ago(
+        self, index, base_repo, head_repo, now
+    ):
+        index.apply(make_pr_json(base_repo, head_repo))
+
+        now.return_value += index.max_age + 1
+
+        assert index.get(base_repo, "main", head_repo, "branch") == (False, None)
+
+    def test_get_trusts_old_prs_if_the_repo_was_synced_recently(
+        self, index, base_repo, head_repo, stream, now
+    ):
+        index.apply(
+            make_pr_json(base_repo, head_repo, updated_at="2024-01-02T00:00:00Z")
+        )
+        now.return_value += index.max_age + 1
+        # The listing is older than the index's version of the PR (because a
+        # webhook overtook it) so the PR itself isn't written again.
+        stream.return_value = [
+            json.dumps(
+                make_pr_json(base_repo, head_repo, updated_at="2024-01-01T00:00:00Z")
+            )
+        ]
+        index.sync(base_repo.name_with_owner)
+
+        hit, pull_request = index.get(base_repo, "main", head_repo, "branch")
+
+        assert hit
+        assert pull_request.number == 1
+
+    def test_get_ignores_closed_prs(self, index, base_repo, head_repo):
+        index.apply(make_pr_json(base_repo, head_repo, state="closed"))
+
+        assert index.get(base_repo, "main", head_repo, "branch") == (False, None)
+
+    def test_get_misses_if_several_prs_match(self, index, base_repo, head_repo):
+        index.apply(make_pr_json(base_repo, head_repo, number=1))
+        index.apply(make_pr_json(base_repo, head_repo, number=2))
+
+        assert index.get(base_repo, "main", head_repo, "branch") == (False, None)
+
+    def test_apply_ignores_out_of_date_prs(self, index, base_repo, head_repo):
+        index.apply(
+            make_pr_json(base_repo, head_repo, updated_at="2024-01-02T00:00:00Z")
+        )
+        index.apply(
+            make_pr_json(
+                base_repo, head_repo, state="closed", updated_at="2024-01-01T00:00:00Z"
+            )
+        )
+
+        assert index.get(base_repo, "main", head_repo, "branch")[0]
+
+    def test_record(self, index, pull_request):
+        index.record(pull_request)
+
+        assert index.get(
+            pull_request.base_repo,
+            pull_request.base_branch,
+            pull_request.head_repo,
+            pull_request.head_branch,
+        ) == (True, pull_request)
+
+    def test_record_closed(self, index, pull_request):
+        index.record(pull_request)
+        index.record(pull_request, state="closed")
+
+        assert index.get(
+            pull_request.base_repo,
+            pull_request.base_branch,
+            pull_request.head_repo,
+            pull_request.head_branch,
+        ) == (False, None)
+
+    def test_record_doesnt_block_later_webhooks(self, index, base_repo, head_repo):
+        # The recorded PR was last updated at 2024-01-01T00:00:00Z by GitHub's
+        # clock, however far ahead of that ours is.
+        index.record(
+            git.PullRequest.from_record(base_repo, head_repo, record(base_repo))
+        )
+        index.apply(
+            make_pr_json(
+                base_repo, head_repo, state="closed", updated_at="2024-01-02T00:00:00Z"
+            )
+        )
+
+        assert index.get(base_repo, "main", head_repo, "branch") == (False, None)
+
+    def test_sync(self, index, base_repo, head_repo, stream):
+        # A PR that was closed without the index being told.
+        index.apply(make_pr_json(base_repo, head_repo, number=1, head="closed"))
+        stream.return_value = [
+            json.dumps(make_pr_json(base_repo, head_repo, number=2, head="a")),
+            json.dumps(make_pr_json(base_repo, head_repo, number=3, head="b")),
+        ]
+
+        count = index.sync(base_repo.name_with_owner)
+
+        stream.assert_called_once_with(
+            [
+                "gh",
+                "api",
+                "--header",
+                "X-GitHub-Api-Version:2022-11-28",
+                "--paginate",
+                "--method",
+                "GET",
+                f"/repos/{base_repo.name_with_owner}/pulls",
+                "-f",
+                "state=open",
+                "-f",
+                "per_page=100",
+                "--jq",
+                SYNC_JQ,
+            ]
+        )
+        assert count == 2
+        assert index.get(base_repo, "main", head_repo, "closed") == (True, None)
+        assert index.get(base_repo, "main", head_repo, "a")[1].number == 2
+        assert index.get(base_repo, "main", head_repo, "b")[1].number == 3
+
+    def test_handle_event(self, index, base_repo, head_repo):
+        assert index.handle_event(
+            "pull_request", {"pull_request": make_pr_json(base_repo, head_repo)}
+        )
+
+        assert index.get(base_repo, "main", head_repo, "branch")[0]
+
+    def test_handle_event_ignores_other_events(self, index):
+        assert not index.handle_event("push", {})
+
+    def test_the_database_is_shared(self, index, base_repo, head_repo):
+        index.apply(make_pr_json(base_repo, head_repo))
+
+        assert PRIndex(index.path).get(base_repo, "main", head_repo, "branch")[0]
+
+
+def test_replay(tmp_path, index, base_repo, head_repo):
+    path = tmp_path / "deliveries.jsonl"
+    path.write_text(
+        "\n".join(
+            [
+                json.dumps(
+                    {
+                        "event": "pull_request",
+                        "payload": {
+                            "pull_request": make_pr_json(base_repo, head_repo, head="a")
+                        },
+                    }
+                ),
+                "",
+                json.dumps({"event": "push", "payload": {}}),
+                json.dumps(
+                    {
+                        "pull_request": make_pr_json(
+                            base_repo, head_repo, number=2, head="b"
+                        )
+                    }
+                ),
+            ]
+        )
+    )
+
+    assert replay(index, str(path)) == 2
+
+    assert index.get(base_repo, "main", head_repo, "a")[0]
+    assert index.get(base_repo, "main", head_repo, "b")[0]
+
+
+class TestWebhookServer:
+    def test_it(self, server, base_repo, head_repo, tmp_path):
+        payload = {"pull_request": make_pr_json(base_repo, head_repo)}
+
+        status = post(server, json.dumps(payload).encode(), "pull_request")
+
+        assert status == 204
+        assert server.index.get(base_repo, "main", head_repo, "branch")[0]
+        assert json.loads((tmp_path / "deliveries.jsonl").read_text()) == {
+            "event": "pull_request",
+            "payload": payload,
+        }
+
+    def test_it_doesnt_have_to_record(self, server, base_repo, head_repo, tmp_path):
+        server.record = None
+        payload = {"pull_request": make_pr_json(base_repo, head_repo)}
+
+        assert post(server, json.dumps(payload).encode(), "pull_request") == 204
+
+        assert not (tmp_path / "deliveries.jsonl").exists()
+
+    def test_it_rejects_invalid_signatures(self, server, tmp_path):
+        assert post(server, b"{}", "pull_request", secret="wrong") == 401
+
+        assert not (tmp_path / "deliveries.jsonl").exists()
+
+    def test_it_rejects_invalid_json(self, server):
+        assert post(server, b"{", "pull_request") == 400
+
+    @pytest.fixture
+    def server(self, index, tmp_path):
+        server = WebhookServer(
+            ("127.0.0.1", 0), index, "secret", str(tmp_path / "deliveries.jsonl")
+        )
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield server
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+class TestGitHooks:
+    """Tests for how git.PullRequest uses the index set with git.use_pr_index()."""
+
+    def test_use_pr_index(self, index):
+        assert git.use_pr_index(None) is index
+        assert git.use_pr_index(index) is None
+
+    def test_get_uses_the_index(self, index, pull_request, git_stream):
+        index.record(pull_request)
+
+        assert (
+            git.PullRequest.get(
+                pull_request.base_repo,
+                pull_request.base_branch,
+                pull_request.head_repo,
+                pull_request.head_branch,
+            )
+            == pull_request
+        )
+        git_stream.assert_not_called()
+
+    def test_get_asks_github_if_the_index_misses(self, pull_request, git_stream):
+        git_stream.return_value = iter([])
+
+        assert not git.PullRequest.get(
+            pull_request.base_repo,
+            pull_request.base_branch,
+            pull_request.head_repo,
+            pull_request.head_branch,
+        )
+        git_stream.assert_called_once()
+
+    def test_create_records_the_pr(self, mocker, index, base_repo, head_repo, git_run):
+        mocker.patch("gh_pr_upsert.github.PullRequest.configure", autospec=True)
+        git_run.return_value = record(base_repo)
+
+        pull_request = git.PullRequest.create(
+            base_repo, "main", head_repo, "branch", "Title", "Body"
+        )
+
+        assert index.get(base_repo, "main", head_repo, "branch") == (
+            True,
+            pull_request,
+        )
+
+    def test_update_records_the_pr(self, index, pull_request_factory, git_run):
+        pull_request = pull_request_factory(
+            raw_json=json.dumps({"title": "Title", "body": "Body"})
+        )
+        git_run.return_value = record(
+            pull_request.base_repo, pull_request.head_branch, pull_request.base_branch
+        )
+
+        updated = pull_request.update("New title", "New body")
+
+        hit, indexed = index.get(
+            pull_request.base_repo,
+            pull_request.base_branch,
+            pull_request.head_repo,
+            pull_request.head_branch,
+        )
+        assert hit
+        assert indexed == updated
+        assert indexed.json == updated.json
+
+    def test_pushed_records_the_new_head_sha(self, index, pull_request):
+        index.record(pull_request)
+
+        pushed = pull_request.pushed("new_sha")
+
+        assert index.get(
+            pull_request.base_repo,
+            pull_request.base_branch,
+            pull_request.head_repo,
+            pull_request.head_branch,
+        ) == (True, pushed)
+        assert pushed.head_sha == "new_sha"
+
+    def test_close_many_records_the_prs_as_closed(self, mocker, index, pull_request):
+        mocker.patch(
+            "gh_pr_upsert.github.graphql",
+            autospec=True,
+            return_value={"close0": {"pullRequest": {"updatedAt": "2024-01-02"}}},
+        )
+        index.record(pull_request)
+
+        git.PullRequest.close_many([pull_request], "Closing")
+
+        assert index.get(
+            pull_request.base_repo,
+            pull_request.base_branch,
+            pull_request.head_repo,
+            pull_request.head_branch,
+        ) == (False, None)
+
+    @pytest.fixture(autouse=True)
+    def use_pr_index(self, index):
+        git.PullRequest.get.cache_clear()
+        previous = git.use_pr_index(index)
+        yield
+        git.use_pr_index(previous)
+        git.PullRequest.get.cache_clear()
+
+    @pytest.fixture
+    def git_run(self, mocker):
+        return mocker.patch("gh_pr_upsert.github.run", autospec=True)
+
+    @pytest.fixture
+    def git_stream(self, mocker):
+        return mocker.patch("gh_pr_upsert.github.stream", autospec=True)
+
+
+def record(base_repo, head_branch="branch", base_branch="main"):
+    """Return a PR as output by `gh api --jq git.PR_RECORD_JQ`."""
+    return "\0".join(
+        [
+            "1",
+            "PR_1",
+            base_branch,
+            head_branch,
+            "abc",
+            f"https://github.com/{base_repo.name_with_owner}/pull/1",
+            "2024-01-01T00:00:00Z",
+            json.dumps({"title": "New title", "body": "New body"}),
+        ]
+    )
+
+
+def make_pr_json(  # pylint:disable=too-many-arguments
+    base_repo,
+    head_repo,
+    *,
+    number=1,
+    head="branch",
+    state="open",
+    title="Title",
+    updated_at="2024-01-01T00:00:00Z",
+):
+    return {
+        "number": number,
+        "node_id": f"PR_{number}",
+        "state": state,
+        "html_url": f"https://github.com/{base_repo.name_with_owner}/pull/{number}",
+        "title": title,
+        "body": "Body",
+        "updated_at": updated_at,
+        "base": {"ref": "main", "repo": {"full_name": base_repo.name_with_owner}},
+        "head": {"label": f"{head_repo.owner}:{head}", "sha": f"sha-{number}"},
+    }
+
+
+def post(server, body, event, secret="secret"):
+    signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{server.server_port}/",
+        data=body,
+        headers={
+            "X-GitHub-Event": event,
+            "X-Hub-Signature-256": f"sha256={signature}",
+        },
+    )
+
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as err:
+        return err.code
+
+
+@pytest.fixture
+def index(tmp_path):
+    return PRIndex(str(tmp_path / "index.db"))
+
+
+@pytest.fixture
+def now(mocker):
+    return mocker.patch(
+        "gh_pr_upsert.pr_index.time.time", autospec=True, return_value=1_700_000_000.0
+    )
+
+
+@pytest.fixture
+def stream(mocker):
+    return mocker.patch("gh_pr_upsert.pr_index.stream", autospec=True)
@@ -1,48 +1,609 @@
+import asyncio
 import json
-from subprocess import CompletedProcess
+import posixpath
+import signal
+from subprocess import PIPE, CalledProcessError, TimeoutExpired
+from unittest.mock import AsyncMock, Mock, create_autospec
 
 import pytest
 
-from gh_pr_upsert.run import run
+from gh_pr_upsert.cassette import Player, Recorder
+from gh_pr_upsert.exceptions import TimedOutError
+from gh_pr_upsert.run import (
+    deadline_exceeded,
+    run,
+    run_async,
+    set_timeouts,
+    stream,
+    stream_async,
+    use_cassette,
+)
 
 
-def test_run(subprocess):
-    subprocess.run.return_value = CompletedProcess(
-        "args", returncode=42, stdout=b"test_output\n"
-    )
+def test_run(Popen, process):
+    process.communicate.return_value = (b"test_output\n", b"")
 
-    result = run("test_command")
+    result = run(["test_command"])
 
-    subprocess.run.assert_called_once_with(
-        "test_command", check=True, capture_output=True
+    # Commands that can't time out stay in our session, so that they can
+    # prompt on the terminal (for example for credentials).
+    Popen.assert_called_once_with(
+        ["test_command"], stdin=None, stdout=PIPE, stderr=PIPE, start_new_session=False
     )
+    process.communicate.assert_called_once_with(None, timeout=None)
     assert result == "test_output"
 
 
+def test_run_starts_commands_that_can_time_out_in_a_new_session(Popen):
+    set_timeouts(timeout=30)
+
+    run(["test_command"])
+
+    assert Popen.call_args[1]["start_new_session"]
+
+
+def test_run_sends_json_input_to_stdin(Popen, process):
+    run(["test_command"], json_input={"foo": "bar"})
+
+    assert Popen.call_args[1]["stdin"] == PIPE
+    process.communicate.assert_called_once_with(b'{"foo": "bar"}', timeout=None)
+
+
 def test_run_prints_commands_in_debug_mode(capsys, os):
     os.environ["DEBUG"] = "yes"
 
-    run("test_command")
+    run(["test_command"])
 
-    assert capsys.readouterr().out.strip() == "test_command"
+    assert capsys.readouterr().out.strip() == "['test_command']"
 
 
-def test_run_loads_json(subprocess):
+def test_run_loads_json(process):
     expected_result = {"foo": "bar"}
-    subprocess.run.return_value = CompletedProcess(
-        "args", returncode=42, stdout=json.dumps(expected_result)
+    process.communicate.return_value = (json.dumps(expected_result).encode(), b"")
+
+    assert run(["test_command"], json=True) == expected_result
+
+
+def test_run_records_metrics(metrics, time):
+    time.monotonic.side_effect = [100, 102.5]
+
+    run(["/usr/bin/git", "status"])
+
+    metrics.SUBPROCESSES.inc.assert_called_once_with(program="git")
+    metrics.API_REQUESTS.inc.assert_not_called()
+    metrics.SUBPROCESS_DURATION.observe.assert_called_once_with(2.5, program="git")
+
+
+def test_run_records_gh_api_requests(metrics):
+    run(["gh", "api", "/user"])
+
+    metrics.api_endpoint.assert_called_once_with(["gh", "api", "/user"])
+    metrics.API_REQUESTS.inc.assert_called_once_with(
+        endpoint=metrics.api_endpoint.return_value
+    )
+
+
+def test_run_raises_if_the_command_fails(process):
+    process.returncode = 23
+    process.communicate.return_value = (b"output", b"errors")
+
+    with pytest.raises(CalledProcessError) as exc_info:
+        run(["test_command"])
+
+    assert exc_info.value.returncode == 23
+    assert exc_info.value.cmd == ["test_command"]
+    assert exc_info.value.stdout == b"output"
+    assert exc_info.value.stderr == b"errors"
+
+
+def test_run_uses_the_timeout(process):
+    set_timeouts(timeout=30)
+
+    run(["test_command"])
+
+    process.communicate.assert_called_once_with(None, timeout=30)
+
+
+def test_run_uses_the_time_remaining_before_the_deadline(process, time):
+    time.monotonic.return_value = 100
+    set_timeouts(timeout=30, deadline=20)
+    time.monotonic.return_value = 105
+
+    run(["test_command"])
+
+    process.communicate.assert_called_once_with(None, timeout=15)
+
+
+def test_run_uses_the_timeout_if_its_before_the_deadline(process, time):
+    time.monotonic.return_value = 100
+    set_timeouts(timeout=10, deadline=20)
+
+    run(["test_command"])
+
+    process.communicate.assert_called_once_with(None, timeout=10)
+
+
+def test_deadline_exceeded(time):
+    time.monotonic.return_value = 100
+    assert not deadline_exceeded()
+
+    set_timeouts(deadline=20)
+    assert not deadline_exceeded()
+
+    time.monotonic.return_value = 120
+    assert deadline_exceeded()
+
+
+def test_run_raises_if_the_deadline_has_already_passed(Popen, time):
+    time.monotonic.return_value = 100
+    set_timeouts(deadline=20)
+    time.monotonic.return_value = 120
+
+    with pytest.raises(TimedOutError):
+        run(["test_command"])
+
+    Popen.assert_not_called()
+
+
+def test_run_kills_the_process_group_if_the_command_times_out(os, process):
+    set_timeouts(timeout=30)
+    process.communicate.side_effect = [TimeoutExpired("test_command", 30), (b"", b"")]
+
+    with pytest.raises(TimedOutError) as exc_info:
+        run(["test_command"])
+
+    assert exc_info.value.message == "Timed out after 30s: ['test_command']"
+    os.killpg.assert_called_once_with(process.pid, signal.SIGKILL)
+
+
+def test_run_kills_the_process_group_if_interrupted(os, process):
+    set_timeouts(timeout=30)
+    process.communicate.side_effect = [KeyboardInterrupt(), (b"", b"")]
+
+    with pytest.raises(KeyboardInterrupt):
+        run(["test_command"])
+
+    os.killpg.assert_called_once_with(process.pid, signal.SIGKILL)
+
+
+def test_run_kills_the_process_if_interrupted_without_a_timeout(os, process):
+    process.communicate.side_effect = [KeyboardInterrupt(), (b"", b"")]
+
+    with pytest.raises(KeyboardInterrupt):
+        run(["test_command"])
+
+    process.kill.assert_called_once_with()
+    os.killpg.assert_not_called()
+
+
+@pytest.mark.parametrize("timeout", [None, 30])
+def test_run_ignores_processes_that_have_already_exited_when_killing(
+    os, process, timeout
+):
+    set_timeouts(timeout=timeout)
+    os.killpg.side_effect = process.kill.side_effect = ProcessLookupError
+    process.communicate.side_effect = [KeyboardInterrupt(), (b"", b"")]
+
+    with pytest.raises(KeyboardInterrupt):
+        run(["test_command"])
+
+
+def test_run_records_commands_to_the_cassette(process, recorder, time):
+    time.monotonic.side_effect = [100, 102.5]
+    process.communicate.return_value = (b"output", b"errors")
+
+    run(["test_command"], json_input={"foo": "bar"})
+
+    recorder.record.assert_called_once_with(
+        ["test_command"], b'{"foo": "bar"}', 0, b"output", b"errors", 2.5
     )
 
-    assert run("test_command", json=True) == expected_result
+
+def test_run_replays_commands_from_the_cassette(Popen, player, time):
+    player.play.return_value = (0, b"output", b"", 1.5)
+
+    result = run(["test_command"])
+
+    Popen.assert_not_called()
+    player.play.assert_called_once_with(["test_command"], None)
+    time.sleep.assert_called_once_with(1.5)
+    assert result == "output"
+
+
+class TestRunAsync:
+    def test_it(self, create_subprocess_exec, async_process):
+        async_process.communicate.return_value = (b"test_output\n", b"")
+
+        result = asyncio.run(run_async(["test_command", "arg"]))
+
+        create_subprocess_exec.assert_called_once_with(
+            "test_command",
+            "arg",
+            stdin=None,
+            stdout=PIPE,
+            stderr=PIPE,
+            start_new_session=False,
+        )
+        async_process.communicate.assert_called_once_with(None)
+        assert result == "test_output"
+
+    def test_it_sends_json_input_and_loads_json(
+        self, create_subprocess_exec, async_process
+    ):
+        async_process.communicate.return_value = (b'{"foo": "bar"}', b"")
+
+        result = asyncio.run(
+            run_async(["test_command"], json=True, json_input={"foo": "bar"})
+        )
+
+        assert create_subprocess_exec.call_args[1]["stdin"] == PIPE
+        async_process.communicate.assert_called_once_with(b'{"foo": "bar"}')
+        assert result == {"foo": "bar"}
+
+    def test_it_records_metrics(self, metrics, time):
+        time.monotonic.side_effect = [100, 102.5]
+
+        asyncio.run(run_async(["git", "status"]))
+
+        metrics.SUBPROCESSES.inc.assert_called_once_with(program="git")
+        metrics.SUBPROCESS_DURATION.observe.assert_called_once_with(2.5, program="git")
+
+    def test_it_raises_if_the_command_fails(self, async_process):
+        async_process.returncode = 23
+
+        with pytest.raises(CalledProcessError) as exc_info:
+            asyncio.run(run_async(["test_command"]))
+
+        assert exc_info.value.returncode == 23
+
+    def test_it_kills_the_process_group_if_the_command_times_out(
+        self, os, async_process
+    ):
+        set_timeouts(timeout=0.01)
+
+        async def communicate(_stdin):
+            await asyncio.sleep(10)
+
+        async_process.communicate.side_effect = communicate
+
+        with pytest.raises(TimedOutError) as exc_info:
+            asyncio.run(run_async(["test_command"]))
+
+        assert exc_info.value.message == "Timed out after 0.01s: ['test_command']"
+        os.killpg.assert_called_once_with(async_process.pid, signal.SIGKILL)
+        async_process.wait.assert_awaited_once_with()
+
+    def test_it_kills_the_process_if_cancelled(self, os, async_process):
+        started = asyncio.Event()
+
+        async def communicate(_stdin):
+            started.set()
+            await asyncio.sleep(10)
+
+        async_process.communicate.side_effect = communicate
+
+        async def cancel():
+            task = asyncio.ensure_future(run_async(["test_command"]))
+            await started.wait()
+            task.cancel()
+            await task
+
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(cancel())
+
+        async_process.kill.assert_called_once_with()
+        os.killpg.assert_not_called()
+        async_process.wait.assert_awaited_once_with()
+
+    def test_it_records_commands_to_the_cassette(self, async_process, recorder, time):
+        time.monotonic.side_effect = [100, 102.5]
+        async_process.communicate.return_value = (b"output", b"")
+
+        asyncio.run(run_async(["test_command"]))
+
+        recorder.record.assert_called_once_with(
+            ["test_command"], None, 0, b"output", b"", 2.5
+        )
+
+    def test_it_replays_commands_from_the_cassette(
+        self, create_subprocess_exec, mocker, player
+    ):
+        sleep = mocker.patch("gh_pr_upsert.run.asyncio.sleep")
+        player.play.return_value = (0, b"output", b"", 1.5)
+
+        result = asyncio.run(run_async(["test_command"]))
+
+        create_subprocess_exec.assert_not_called()
+        sleep.assert_called_once_with(1.5)
+        assert result == "output"
+
+    @pytest.fixture(autouse=True)
+    def create_subprocess_exec(self, mocker, async_process):
+        return mocker.patch(
+            "gh_pr_upsert.run.asyncio.create_subprocess_exec",
+            return_value=async_process,
+        )
+
+    @pytest.fixture
+    def async_process(self):
+        process = AsyncMock(returncode=0, pid=42)
+        # asyncio.subprocess.Process.kill() isn't a coroutine.
+        process.kill = Mock()
+        process.communicate.return_value = (b"", b"")
+        return process
+
+
+class TestStream:
+    def test_it(self, Popen, process):
+        process.stdout.read1.side_effect = [b"one\0tw", b"o\0\0three", b""]
+
+        records = list(stream(["test_command"], separator=b"\0"))
+
+        Popen.assert_called_once_with(
+            ["test_command"], stdout=PIPE, stderr=PIPE, start_new_session=False
+        )
+        assert records == ["one", "two", "three"]
+
+    def test_chunks(self, process):
+        process.stdout.read1.side_effect = [b"one\ntw", b"o\n", b""]
+
+        assert list(stream(["test_command"], separator=None)) == [b"one\ntw", b"o\n"]
+
+    def test_it_only_keeps_the_end_of_stderr(self, mocker, process):
+        mocker.patch("gh_pr_upsert.run.STDERR_LIMIT", 5)
+        process.stderr.read1.side_effect = [b"abc", b"defgh", b"ij", b""]
+        process.returncode = 1
+
+        with pytest.raises(CalledProcessError) as exc_info:
+            list(stream(["test_command"]))
+
+        assert exc_info.value.stderr == b"fghij"
+
+    def test_it_records_metrics(self, metrics, time):
+        time.monotonic.side_effect = [100, 101.5]
+
+        list(stream(["/usr/bin/git", "diff"]))
+
+        metrics.SUBPROCESSES.inc.assert_called_once_with(program="git")
+        metrics.SUBPROCESS_DURATION.observe.assert_called_once_with(1.5, program="git")
+
+    def test_it_raises_if_the_command_fails(self, process):
+        process.stdout.read1.side_effect = [b"output", b""]
+        process.stderr.read1.side_effect = [b"error", b""]
+        process.returncode = 1
+
+        records = stream(["test_command"])
+
+        assert next(records) == "output"
+        with pytest.raises(CalledProcessError) as exc_info:
+            next(records)
+        assert exc_info.value.stderr == b"error"
+
+    def test_it_kills_the_process_if_the_caller_stops_early(self, os, process):
+        process.stdout.read1.side_effect = [b"one\ntwo\n", b""]
+
+        records = stream(["test_command"])
+        next(records)
+        records.close()
+
+        process.kill.assert_called_once_with()
+        os.killpg.assert_not_called()
+
+    def test_it_kills_the_process_group_if_the_command_times_out(
+        self, os, process, mocker
+    ):
+        Timer = mocker.patch("gh_pr_upsert.run.threading.Timer", autospec=True)
+        set_timeouts(timeout=5)
+
+        with pytest.raises(
+            TimedOutError, match=r"^Timed out after 5s: \['test_command'\]$"
+        ):
+            for _ in stream(["test_command"]):
+                # Simulate the timer expiring while the output is being read.
+                Timer.call_args[0][1]()
+
+        assert Timer.call_args[0][0] == 5
+        Timer.return_value.cancel.assert_called_once_with()
+        os.killpg.assert_called_once_with(process.pid, signal.SIGKILL)
+
+    def test_it_records_commands_to_the_cassette(self, process, recorder, time):
+        time.monotonic.side_effect = [100, 102.5]
+        process.stdout.read1.side_effect = [b"out", b"put", b""]
+        process.stderr.read1.side_effect = [b"err", b"ors", b""]
+
+        list(stream(["test_command"]))
+
+        recorder.record.assert_called_once_with(
+            ["test_command"], None, 0, b"output", b"errors", 2.5
+        )
+
+    def test_it_replays_commands_from_the_cassette(self, Popen, player, time):
+        player.play.return_value = (1, b"one\ntwo\n", b"", 1.5)
+
+        records = stream(["test_command"])
+
+        assert [next(records), next(records)] == ["one", "two"]
+        with pytest.raises(CalledProcessError):
+            next(records)
+        Popen.assert_not_called()
+        time.sleep.assert_called_once_with(1.5)
+
+    def test_it_replays_successful_commands(self, player):
+        player.play.return_value = (0, b"output", b"", 0)
+
+        assert list(stream(["test_command"])) == ["output"]
+
+    @pytest.mark.parametrize("stdout,chunks", [(b"output", [b"output"]), (b"", [])])
+    def test_it_replays_chunks(self, player, stdout, chunks):
+        player.play.return_value = (0, stdout, b"", 0)
+
+        assert list(stream(["test_command"], separator=None)) == chunks
+
+    @pytest.fixture
+    def process(self, process):
+        process.stdout.read1.side_effect = [b"output\n", b""]
+        process.stderr.read1.side_effect = [b""]
+        return process
+
+
+class TestStreamAsync:
+    def test_it(self, create_subprocess_exec):
+        chunks = asyncio.run(self.collect(["test_command"]))
+
+        create_subprocess_exec.assert_called_once_with(
+            "test_command", stdout=PIPE, stderr=PIPE, start_new_session=False
+        )
+        assert chunks == [b"out", b"put"]
+
+    def test_it_only_keeps_the_end_of_stderr(self, mocker, async_process):
+        mocker.patch("gh_pr_upsert.run.STDERR_LIMIT", 5)
+        async_process.stderr.read.side_effect = [b"abc", b"defgh", b"ij", b""]
+        async_process.returncode = 1
+
+        with pytest.raises(CalledProcessError) as exc_info:
+            asyncio.run(self.collect(["test_command"]))
+
+        assert exc_info.value.stderr == b"fghij"
+
+    def test_it_raises_after_the_last_chunk_if_the_command_fails(self, async_process):
+        async_process.returncode = 23
+        chunks = []
+
+        async def collect():
+            async for chunk in stream_async(["test_command"]):
+                chunks.append(chunk)
+
+        with pytest.raises(CalledProcessError) as exc_info:
+            asyncio.run(collect())
+
+        assert chunks == [b"out", b"put"]
+        assert exc_info.value.returncode == 23
+
+    def test_it_kills_the_process_if_the_caller_stops_early(self, os, async_process):
+        async def stop_early():
+            chunks = stream_async(["test_command"])
+            await chunks.__anext__()
+            await chunks.aclose()
+
+        asyncio.run(stop_early())
+
+        async_process.kill.assert_called_once_with()
+        os.killpg.assert_not_called()
+        async_process.wait.assert_awaited_once_with()
+
+    def test_it_kills_the_process_group_if_the_command_times_out(
+        self, os, async_process
+    ):
+        set_timeouts(timeout=0.01)
+
+        async def read(_size):
+            await asyncio.sleep(10)
+
+        async_process.stdout.read.side_effect = read
+
+        with pytest.raises(TimedOutError) as exc_info:
+            asyncio.run(self.collect(["test_command"]))
+
+        assert exc_info.value.message == "Timed out after 0.01s: ['test_command']"
+        os.killpg.assert_called_once_with(async_process.pid, signal.SIGKILL)
+
+    def test_it_records_commands_to_the_cassette(self, async_process, recorder, time):
+        time.monotonic.side_effect = [100, 102.5]
+        async_process.stderr.read.side_effect = [b"errors", b""]
+
+        asyncio.run(self.collect(["test_command"]))
+
+        recorder.record.assert_called_once_with(
+            ["test_command"], None, 0, b"output", b"errors", 2.5
+        )
+
+    @pytest.mark.parametrize("stdout,chunks", [(b"output", [b"output"]), (b"", [])])
+    def test_it_replays_commands_from_the_cassette(
+        self, create_subprocess_exec, mocker, player, stdout, chunks
+    ):
+        sleep = mocker.patch("gh_pr_upsert.run.asyncio.sleep")
+        player.play.return_value = (0, stdout, b"", 1.5)
+
+        assert asyncio.run(self.collect(["test_command"])) == chunks
+
+        create_subprocess_exec.assert_not_called()
+        sleep.assert_called_once_with(1.5)
+
+    def test_it_replays_failed_commands(self, mocker, player):
+        mocker.patch("gh_pr_upsert.run.asyncio.sleep")
+        player.play.return_value = (1, b"", b"error", 0)
+
+        with pytest.raises(CalledProcessError):
+            asyncio.run(self.collect(["test_command"]))
+
+    async def collect(self, cmd):
+        return [chunk async for chunk in stream_async(cmd)]
+
+    @pytest.fixture(autouse=True)
+    def create_subprocess_exec(self, mocker, async_process):
+        return mocker.patch(
+            "gh_pr_upsert.run.asyncio.create_subprocess_exec",
+            return_value=async_process,
+        )
+
+    @pytest.fixture
+    def async_process(self):
+        process = AsyncMock(returncode=0, pid=42)
+        # asyncio.subprocess.Process.kill() isn't a coroutine.
+        process.kill = Mock()
+        process.stdout.read.side_effect = [b"out", b"put", b""]
+        process.stderr.read.side_effect = [b""]
+        return process
+
+
+@pytest.fixture
+def recorder():
+    recorder = create_autospec(Recorder, instance=True, replaying=False)
+    use_cassette(recorder)
+    yield recorder
+    use_cassette(None)
+
+
+@pytest.fixture
+def player():
+    player = create_autospec(Player, instance=True, replaying=True)
+    use_cassette(player)
+    yield player
+    use_cassette(None)
+
+
+@pytest.fixture(autouse=True)
+def reset_timeouts():
+    yield
+    set_timeouts()
 
 
 @pytest.fixture(autouse=True)
 def os(mocker):
     os = mocker.patch("gh_pr_upsert.run.os", autospec=True)
     os.environ = {}
+    os.path.basename.side_effect = posixpath.basename
     return os
 
 
 @pytest.fixture(autouse=True)
-def subprocess(mocker):
-    return mocker.patch("gh_pr_upsert.run.subprocess", autospec=True)
+def metrics(mocker):
+    return mocker.patch("gh_pr_upsert.run.metrics", autospec=True)
+
+
+@pytest.fixture
+def time(mocker):
+    return mocker.patch("gh_pr_upsert.run.time", autospec=True)
+
+
+@pytest.fixture(autouse=True)
+def Popen(mocker):
+    return mocker.patch("gh_pr_upsert.run.Popen", autospec=True)
+
+
+@pytest.fixture(autouse=True)
+def process(Popen):
+    process = Popen.return_value.__enter__.return_value
+    process.returncode = 0
+    process.communicate.return_value = (b"", b"")
+    return process
@@ -0,0 +1,108 @@
+"""Start-up time budgets for the command line interface.
+
+A short gh-pr-upsert run spends a noticeable part of its time starting
+Python and importing modules, so these tests fail if importing the CLI takes
+longer than its budget or if a run loads modules that its command doesn't
+need (see gh_pr_upsert.lazy). They run Python in a subprocess so that the
+modules that the tests themselves have imported don't count.
+"""
+
+import subprocess
+import sys
+
+import pytest
+
+# The maximum number of seconds that `import gh_pr_upsert.cli` can take, as
+# measured by `python -X importtime`. It's several times what it takes on a
+# developer's laptop so that the test isn't flaky on slow CI machines, but
+# much less than it took before the CLI's imports were made lazy (~0.15s).
+COLD_START_BUDGET = 0.1
+
+# Modules that a normal upsert shouldn't load.
+NOT_NEEDED_TO_UPSERT = [
+    "asyncio",
+    "gh_pr_upsert.aio",
+    "gh_pr_upsert.cassette",
+    "gh_pr_upsert.manifest",
+    "gh_pr_upsert.pr_index",
+    "gh_pr_upsert.watcher",
+    "http.server",
+    "importlib.metadata",
+    "sqlite3",
+    "tempfile",
+    "urllib.request",
+]
+
+# A script that imports the CLI, runs `code`, and prints the names of all
+# the modules that have actually been loaded to stderr (lazily imported
+# modules that haven't been used yet don't count).
+LOADED_MODULES_SCRIPT = """
+import sys
+from gh_pr_upsert import cli
+
+try:
+    {code}
+except SystemExit:
+    pass
+
+for name, module in list(sys.modules.items()):
+    if type(module).__name__ != "_LazyModule":
+        print(name, file=sys.stderr)
+"""
+
+
+def test_cold_start_time():
+    # Take the best of a few runs to filter out noise from the machine.
+    durations = [import_time("gh_pr_upsert.cli") for _ in range(3)]
+
+    assert min(durations) <= COLD_START_BUDGET
+
+
+def test_upserting_doesnt_load_unneeded_modules():
+    # Use what a normal upsert uses, without actually running one.
+    loaded = loaded_modules(
+        "cli.run.set_timeouts, cli.git.GitHubRepo, cli.core.pr_upsert, cli.metrics.OUTCOMES"
+    )
+
+    assert "gh_pr_upsert.core" in loaded
+    assert not set(NOT_NEEDED_TO_UPSERT) & loaded
+
+
+@pytest.mark.parametrize("option", ["--help", "--version"])
+def test_help_and_version_dont_load_gh_pr_upsert_itself(option):
+    loaded = loaded_modules(f"cli.cli([{option!r}])")
+
+    assert (
+        not {
+            "gh_pr_upsert.core",
+            "gh_pr_upsert.git",
+            "gh_pr_upsert.run",
+            "json",
+            "subprocess",
+        }
+        & loaded
+    )
+
+
+def loaded_modules(code):
+    """Return the names of the modules loaded by running `code` after importing the CLI."""
+    return set(python("-c", LOADED_MODULES_SCRIPT.format(code=code)).stderr.split())
+
+
+def import_time(module):
+    """Return how many seconds importing `module` takes in a fresh Python."""
+    importtime = python("-X", "importtime", "-c", f"import {module}").stderr
+
+    for line in importtime.splitlines():
+        # Lines look like: "import time:  self [us] | cumulative | module".
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative) / 1_000_000
+
+    raise AssertionError(f"{module} wasn't imported")  # pragma: no cover
+
+
+def python(*args):
+    return subprocess.run(
+        [sys.executable, *args], capture_output=True, text=True, check=True
+    )
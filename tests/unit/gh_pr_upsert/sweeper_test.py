@@ -0,0 +1,173 @@
+from subprocess import CalledProcessError
+from unittest.mock import call, sentinel
+
+import pytest
+
+from gh_pr_upsert import sweeper
+
+
+class TestSweep:
+    def test_it(self, base_repo, capsys, git, head_repo, pull_requests):
+        closed = sweeper.sweep(base_repo, head_repo, sentinel.close_comment)
+
+        git.PullRequest.get_upserted.assert_called_once_with(base_repo, head_repo)
+        assert git.lock_branch.call_args_list == [
+            call(head_repo.remote, "branch_0"),
+            call(head_repo.remote, "branch_1"),
+        ]
+        git.fetch.assert_called_once_with(head_repo.remote, base_repo.remote)
+        # It checks the diff and the log of each PR's head commit (in parallel,
+        # so not necessarily in order).
+        expected_calls = [
+            call(
+                (
+                    pull_request.head_sha,
+                    f"^{base_repo.remote}/{pull_request.base_branch}",
+                )
+            )
+            for pull_request in pull_requests
+        ]
+        git.diff_is_empty.assert_has_calls(expected_calls, any_order=True)
+        git.log.assert_has_calls(expected_calls, any_order=True)
+        git.PullRequest.close_many.assert_called_once_with(
+            pull_requests, sentinel.close_comment
+        )
+        assert capsys.readouterr().out.splitlines() == [
+            f"Closed PR {pull_request.html_url}" for pull_request in pull_requests
+        ]
+        assert closed == pull_requests
+
+    def test_it_holds_the_branch_locks_while_it_closes_the_prs(
+        self, base_repo, git, head_repo, pull_requests
+    ):
+        sweeper.sweep(base_repo, head_repo, sentinel.close_comment)
+
+        names = [name for name, _args, _kwargs in git.mock_calls]
+        assert (
+            names.index("lock_branch().__enter__")
+            < names.index("fetch")
+            < names.index("PullRequest.close_many")
+            < names.index("lock_branch().__exit__")
+        )
+        assert names.count("lock_branch().__exit__") == len(pull_requests)
+
+    @pytest.mark.usefixtures("pull_requests")
+    def test_it_only_fetches_once_if_the_base_and_head_remotes_are_the_same(
+        self, git, head_repo
+    ):
+        sweeper.sweep(head_repo, head_repo, sentinel.close_comment)
+
+        git.fetch.assert_called_once_with(head_repo.remote)
+
+    def test_it_does_nothing_if_there_are_no_prs(self, base_repo, head_repo, git):
+        git.PullRequest.get_upserted.return_value = []
+
+        assert not sweeper.sweep(base_repo, head_repo, sentinel.close_comment)
+
+        git.lock_branch.assert_not_called()
+        git.fetch.assert_not_called()
+        git.PullRequest.close_many.assert_not_called()
+
+    def test_it_doesnt_close_prs_that_have_changes(
+        self, base_repo, head_repo, git, pull_requests
+    ):
+        git.diff_is_empty.side_effect = lambda branches: (
+            branches[0] == pull_requests[1].head_sha
+        )
+
+        closed = sweeper.sweep(base_repo, head_repo, sentinel.close_comment)
+
+        git.PullRequest.close_many.assert_called_once_with(
+            [pull_requests[1]], sentinel.close_comment
+        )
+        assert closed == [pull_requests[1]]
+
+    @pytest.mark.usefixtures("pull_requests")
+    def test_it_doesnt_close_prs_that_have_other_contributors(
+        self, base_repo, head_repo, core, git, user
+    ):
+        core.get_other_contributors.return_value = {user}
+
+        closed = sweeper.sweep(base_repo, head_repo, sentinel.close_comment)
+
+        core.get_other_contributors.assert_called_with(git.log.return_value)
+        git.PullRequest.close_many.assert_not_called()
+        assert not closed
+
+    # A sha of None means that the branch has been deleted.
+    @pytest.mark.parametrize("sha", [None, "moved_sha"])
+    def test_it_doesnt_close_prs_whose_branches_have_moved(
+        self, base_repo, head_repo, git, pull_requests, sha
+    ):
+        moved, unmoved = pull_requests
+        git.branch_exists.side_effect = lambda _remote, branch: (
+            sha is not None or branch != moved.head_branch
+        )
+        git.rev_parse.side_effect = lambda rev: (
+            [sha] if rev.endswith(moved.head_branch) else [unmoved.head_sha]
+        )
+
+        closed = sweeper.sweep(base_repo, head_repo, sentinel.close_comment)
+
+        git.PullRequest.close_many.assert_called_once_with(
+            [unmoved], sentinel.close_comment
+        )
+        assert closed == [unmoved]
+
+    @pytest.mark.usefixtures("one_pr_per_batch")
+    def test_it_reports_the_prs_it_closed_before_a_batch_fails(
+        self, base_repo, capsys, head_repo, git, pull_requests
+    ):
+        git.PullRequest.close_many.side_effect = [
+            None,
+            CalledProcessError(1, sentinel.cmd),
+        ]
+
+        with pytest.raises(CalledProcessError):
+            sweeper.sweep(base_repo, head_repo, sentinel.close_comment)
+
+        assert git.PullRequest.close_many.call_args_list == [
+            call([pull_request], sentinel.close_comment)
+            for pull_request in pull_requests
+        ]
+        assert capsys.readouterr().out.splitlines() == [
+            f"Closed PR {pull_requests[0].html_url}"
+        ]
+        # The locks are released.
+        assert git.lock_branch.return_value.__exit__.call_count == 2
+
+
+@pytest.fixture
+def base_repo(git_hub_repo_factory):
+    return git_hub_repo_factory(remote="upstream")
+
+
+@pytest.fixture
+def one_pr_per_batch(mocker):
+    mocker.patch.object(sweeper, "CLOSE_BATCH_SIZE", 1)
+
+
+@pytest.fixture
+def pull_requests(git, head_repo, pull_request_factory):
+    pull_requests = git.PullRequest.get_upserted.return_value = [
+        pull_request_factory(head_branch=f"branch_{i}") for i in (1, 0)
+    ]
+    # Make the remote-tracking branches up to date with the PRs.
+    head_shas = {
+        f"{head_repo.remote}/{pull_request.head_branch}": pull_request.head_sha
+        for pull_request in pull_requests
+    }
+    git.rev_parse.side_effect = lambda rev: [head_shas[rev]]
+    return pull_requests
+
+
+@pytest.fixture(autouse=True)
+def core(mocker):
+    core = mocker.patch("gh_pr_upsert.sweeper.core", autospec=True)
+    core.get_other_contributors.return_value = set()
+    return core
+
+
+@pytest.fixture(autouse=True)
+def git(mocker):
+    return mocker.patch("gh_pr_upsert.sweeper.git", autospec=True)
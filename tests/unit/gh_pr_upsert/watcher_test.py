@@ -0,0 +1,170 @@
+from subprocess import CalledProcessError
+from unittest.mock import call, sentinel
+
+import pytest
+
+from gh_pr_upsert import watcher
+from gh_pr_upsert.exceptions import NoChangesError, TimedOutError
+
+
+class TestWatch:
+    def test_it(self, capsys, core, git, stat, wait_for_change):
+        git.rev_parse.side_effect = [["sha_1"], ["sha_2"]]
+
+        with pytest.raises(KeyboardInterrupt):
+            self.watch()
+
+        git.git_paths.assert_called_once_with(
+            "HEAD", "refs/heads/local_branch", "packed-refs"
+        )
+        stat.assert_called_once_with(git.git_paths.return_value)
+        assert wait_for_change.call_args_list == [
+            call(git.git_paths.return_value, stat.return_value, sentinel.debounce),
+            call(git.git_paths.return_value, sentinel.files, sentinel.debounce),
+        ]
+        assert git.clear_local_ref_caches.call_count == 2
+        assert (
+            core.upsert.call_args_list
+            == [
+                call(
+                    sentinel.base_repo,
+                    sentinel.base_branch,
+                    "local_branch",
+                    sentinel.head_repo,
+                    sentinel.head_branch,
+                    sentinel.title,
+                    sentinel.body,
+                    sentinel.close_comment,
+                    update=sentinel.update,
+                )
+            ]
+            * 2
+        )
+        assert core.print_result.call_args_list == [call(core.upsert.return_value)] * 2
+        assert not capsys.readouterr().out
+
+    def test_it_doesnt_upsert_if_the_branch_still_points_at_the_same_commit(
+        self, core, git
+    ):
+        git.rev_parse.side_effect = [["sha_1"], ["sha_1"]]
+
+        with pytest.raises(KeyboardInterrupt):
+            self.watch()
+
+        core.upsert.assert_called_once()
+
+    def test_it_prints_errors_and_keeps_watching(self, capsys, core, git):
+        git.rev_parse.side_effect = [["sha_1"], ["sha_2"]]
+        core.print_result.side_effect = [NoChangesError(), None]
+
+        with pytest.raises(KeyboardInterrupt):
+            self.watch()
+
+        assert capsys.readouterr().out == f"{NoChangesError().message}\n"
+        assert core.upsert.call_count == 2
+
+    def test_it_prints_timeouts_and_keeps_watching(self, capsys, core, git, run):
+        git.rev_parse.side_effect = [["sha_1"], ["sha_2"]]
+        core.upsert.side_effect = [TimedOutError("git timed out"), None]
+        run.deadline_exceeded.return_value = False
+
+        with pytest.raises(KeyboardInterrupt):
+            self.watch()
+
+        assert capsys.readouterr().out == "git timed out\n"
+        assert core.upsert.call_count == 2
+
+    def test_it_stops_if_the_deadline_has_passed(self, core, git, run):
+        git.rev_parse.return_value = ["sha_1"]
+        core.upsert.side_effect = TimedOutError("git timed out")
+        run.deadline_exceeded.return_value = True
+
+        with pytest.raises(TimedOutError):
+            self.watch()
+
+    @pytest.mark.parametrize("stderr", [None, b"rejected"])
+    def test_it_prints_command_errors_and_keeps_watching(
+        self, capsys, core, git, stderr
+    ):
+        git.rev_parse.side_effect = [["sha_1"], ["sha_2"]]
+        error = CalledProcessError(1, ["git", "push"], stderr=stderr)
+        core.upsert.side_effect = [error, None]
+
+        with pytest.raises(KeyboardInterrupt):
+            self.watch()
+
+        assert capsys.readouterr().out.splitlines() == [
+            str(error),
+            *([stderr.decode("utf-8")] if stderr else []),
+        ]
+        assert core.upsert.call_count == 2
+
+    def watch(self):
+        watcher.watch(
+            sentinel.base_repo,
+            sentinel.base_branch,
+            "local_branch",
+            sentinel.head_repo,
+            sentinel.head_branch,
+            sentinel.title,
+            sentinel.body,
+            sentinel.close_comment,
+            debounce=sentinel.debounce,
+            update=sentinel.update,
+        )
+
+    @pytest.fixture(autouse=True)
+    def core(self, mocker):
+        return mocker.patch("gh_pr_upsert.watcher.core", autospec=True)
+
+    @pytest.fixture(autouse=True)
+    def git(self, mocker):
+        return mocker.patch("gh_pr_upsert.watcher.git", autospec=True)
+
+    @pytest.fixture(autouse=True)
+    def run(self, mocker):
+        return mocker.patch("gh_pr_upsert.watcher.run", autospec=True)
+
+    @pytest.fixture(autouse=True)
+    def stat(self, mocker):
+        return mocker.patch("gh_pr_upsert.watcher.stat", autospec=True)
+
+    @pytest.fixture(autouse=True)
+    def wait_for_change(self, mocker):
+        return mocker.patch(
+            "gh_pr_upsert.watcher.wait_for_change",
+            autospec=True,
+            side_effect=[sentinel.files, KeyboardInterrupt],
+        )
+
+
+class TestWaitForChange:
+    def test_it_waits_for_a_change_and_then_for_the_changes_to_stop(self, stat, time):
+        stat.side_effect = ["old", "old", "new_1", "new_2", "new_2"]
+        time.monotonic.side_effect = [0, 0.5, 1.5, 2.5, 3.5]
+
+        assert watcher.wait_for_change(sentinel.paths, "old", 2) == "new_2"
+
+        assert stat.call_args_list == [call(sentinel.paths)] * 5
+        assert time.sleep.call_args_list == [call(watcher.POLL_INTERVAL)] * 4
+
+    @pytest.fixture
+    def stat(self, mocker):
+        return mocker.patch("gh_pr_upsert.watcher.stat", autospec=True)
+
+    @pytest.fixture(autouse=True)
+    def time(self, mocker):
+        return mocker.patch("gh_pr_upsert.watcher.time", autospec=True)
+
+
+class TestStat:
+    def test_it(self, tmp_path):
+        path = tmp_path / "ref"
+        path.write_text("sha_1")
+        missing_path = tmp_path / "missing"
+
+        before = watcher.stat([path, missing_path])
+        path.write_text("sha_2 ")
+
+        assert before[1] is None
+        assert watcher.stat([path, missing_path]) != before